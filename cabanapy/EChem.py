@@ -1,7 +1,652 @@
 # -*- coding: utf-8 -*-
 #EChem technique
 
+import os, re, json, glob, zipfile
 import numpy as np, matplotlib.pyplot as plt, pandas as pd
+from matplotlib.collections import LineCollection
+from scipy import interpolate, optimize, signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import general
+
+# Header lines of EC-Lab files -> attribute names
+header_keys = [
+    ("Run on channel : ", 'channel'),
+    ("Acquisition started on : ", 'date'),
+    ("Device : ", 'device'),
+    ("Electrode material : ", 'material'),
+    ("Initial state : ", 'initial_state'),
+    ("Electrolyte : ", 'electrolyte'),
+    ("Comments : ", 'comments'),
+    ("Mass of active material : ", 'mass_am'),
+    ("Electrode surface area : ", 'surface_area'),
+    ("Molecular weight of active material (at x = 0) : ", 'mol_weight'),
+]
+# Columns stored as integers, and float columns that keep double precision, when reading with downcast=True
+integer_columns = ['mode', 'ox/red', 'error', 'control changes', 'Ns changes', 'counter inc.', 'Ns', 'half cycle', 'cycle number', 'z cycle']
+double_columns = ['time/s']
+
+def read_mpt_header(filename):
+    """Reads the header of an EC-Lab/BT-Lab text file in one pass, stopping at the column names ('Nb header lines' long). Files without an 'ASCII FILE' header start with the column names.
+
+    Returns a dict of the header attributes of MPTFile (channel, date, ..., comments as a list), 'skip_line' (line number of the column names), 'start_of_method', 'columns' and 'header' (the header lines)."""
+    header = dict((attribute, "") for key, attribute in header_keys)
+    header.update({'comments': [], 'skip_line': 1, 'start_of_method': 3})
+    lines = []
+    with open(filename, 'r', encoding='latin-1') as file:
+        for line in file:
+            line = line.rstrip('\r\n')
+            lines.append(line)
+            if len(lines) == 1 and 'ASCII FILE' not in line:
+                break
+            if "Nb header lines : " in line:
+                header['skip_line'] = int(line.split(':', 1)[1])
+            else:
+                for key, attribute in header_keys:
+                    if key in line:
+                        value = line.split(key, 1)[1].replace('\t', ' ')
+                        if attribute == 'comments':
+                            header['comments'].append(value)
+                        else:
+                            header[attribute] = value
+                        if attribute == 'surface_area':
+                            header['start_of_method'] = len(lines) + 2
+                        break
+            if len(lines) >= header['skip_line'] > 1:
+                break
+    header['header'] = lines
+    # EC-Lab ends the column names with a tab
+    header['columns'] = [column for column in lines[-1].split('\t') if column]
+    return header
+
+def _mpt_dtypes(columns, downcast):
+    """Internal function. Dtypes read_csv uses for the columns: float32 (float64 for double_columns) when downcasting. Integer columns are cast after parsing as EC-Lab writes them as floats."""
+    if not downcast:
+        return None
+    return dict((column, 'float64' if column in double_columns else 'float32') for column in columns)
+
+def _downcast(dataframe):
+    """Internal function. Casts the integer_columns of dataframe (and its index) to int32."""
+    for column in dataframe.columns.intersection(integer_columns):
+        dataframe[column] = dataframe[column].astype('int32')
+    if dataframe.index.name in integer_columns:
+        dataframe.index = dataframe.index.astype('int32')
+    return dataframe
+
+def iter_mpt(filename, chunksize=1000000, usecols=None, downcast=True, header=None):
+    """Streams the data of an EC-Lab .mpt file as DataFrames of 'chunksize' rows, so files larger than memory can be reduced chunk by chunk.
+
+    Arguments
+    ---------
+    filename : str
+        Name of the file you wish to import.
+    chunksize : int
+        number of rows per DataFrame, or None for a single DataFrame
+    usecols : list
+        names of the columns to read, all by default
+    downcast : bool
+        store floats as float32 (time/s stays float64) and integer_columns as int32
+    header : dict
+        header from read_mpt_header, read from the file if None
+    """
+    header = header or read_mpt_header(filename)
+    columns = header['columns'] if usecols is None else usecols
+    reader = pd.read_csv(filename, sep='\t', skiprows=header['skip_line']-1, header=0, usecols=columns, dtype=_mpt_dtypes(columns, downcast), encoding='latin-1', chunksize=chunksize)
+    for chunk in (reader if chunksize else [reader]):
+        yield _downcast(chunk) if downcast else chunk
+
+def _cache_stamp(filename):
+    """Internal function. Size and modification time of filename, which a cache has to match."""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def write_column_cache(dataframe, cache_file, stamp=None):
+    """Writes the index and columns of dataframe to an uncompressed .npz file, one array per column, so that single columns can be loaded without the others. Only numeric columns are written (others would have to be pickled), leaving out the 'Unnamed: N' columns pandas makes of trailing separators; nothing is written if the index is not numeric."""
+    if dataframe.index.values.dtype.kind not in 'biufc':
+        return
+    numeric = [column for column in dataframe.columns if dataframe[column].values.dtype.kind in 'biufc' and not str(column).startswith('Unnamed: ')]
+    columns = [dataframe.index.name] + numeric
+    arrays = [dataframe.index.values] + [dataframe[column].values for column in numeric]
+    meta = json.dumps({'columns': columns, 'stamp': stamp})
+    np.savez(cache_file, meta=np.array(meta), **dict(('c{0}'.format(i), array) for i, array in enumerate(arrays)))
+
+def cached_columns(cache_file, stamp=None):
+    """Returns the names of the columns (index first) held by a cache written by write_column_cache, or an empty list if there is no cache for stamp."""
+    try:
+        with np.load(cache_file) as cache:
+            meta = json.loads(str(cache['meta']))
+    except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+        return []
+    return meta['columns'] if stamp is None or meta['stamp'] == stamp else []
+
+def read_column_cache(cache_file, usecols=None, stamp=None):
+    """Reads a DataFrame written by write_column_cache (only the columns in usecols, and the index). Returns None if the cache does not exist, cannot be read, was written for a different stamp or lacks a column."""
+    try:
+        with np.load(cache_file) as cache:
+            meta = json.loads(str(cache['meta']))
+            columns = meta['columns']
+            if stamp is not None and meta['stamp'] != stamp:
+                return None
+            wanted = columns[1:] if usecols is None else [column for column in usecols if column != columns[0]]
+            if not set(wanted) <= set(columns):
+                return None
+            data = dict((column, cache['c{0}'.format(columns.index(column))]) for column in wanted)
+            index = pd.Index(cache['c0'], name=columns[0])
+    except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    return pd.DataFrame(data, index=index, columns=wanted)
+
+
+# Cycle summaries
+summary_columns = ['Q charge/mA.h', 'Q discharge/mA.h', 'Energy charge/mW.h', 'Energy discharge/mW.h']
+
+def _segment_starts(cycles, cells=None):
+    """Internal function. First row of every run of constant cycle (and cell)."""
+    change = cycles[1:] != cycles[:-1]
+    if cells is not None:
+        change |= cells[1:] != cells[:-1]
+    return np.concatenate(([0], np.flatnonzero(change) + 1))
+
+def _summary_table(starts, values, cycles, cells, mass, how='sum'):
+    """Internal function. Combines the segments of each cycle ('sum' of integrals or 'max' of counters) and derives the cycle metrics."""
+    table = pd.DataFrame(values, columns=summary_columns)
+    table.insert(0, 'cycle', cycles[starts])
+    keys = ['cycle']
+    if cells is not None:
+        table.insert(0, 'cell', cells[starts])
+        keys = ['cell', 'cycle']
+    table = table.groupby(keys, sort=False).agg(how)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['Coulombic efficiency/%'] = 100*table['Q discharge/mA.h']/table['Q charge/mA.h']
+        table['Energy efficiency/%'] = 100*table['Energy discharge/mW.h']/table['Energy charge/mW.h']
+        table['<E> charge/V'] = table['Energy charge/mW.h']/table['Q charge/mA.h']
+        table['<E> discharge/V'] = table['Energy discharge/mW.h']/table['Q discharge/mA.h']
+    table['Polarization/V'] = table['<E> charge/V'] - table['<E> discharge/V']
+    # Retention relative to the first cycle with a discharge
+    discharge = table['Q discharge/mA.h'].where(table['Q discharge/mA.h'] > 0)
+    if cells is not None:
+        first = discharge.groupby(level='cell', sort=False).transform('first')
+    else:
+        first = discharge.dropna().iloc[0] if discharge.notna().any() else np.nan
+    table['Retention/%'] = 100*table['Q discharge/mA.h']/first
+    if mass is not None:
+        # mass in mg, per cell if a dict
+        grams = table.index.get_level_values('cell').map(mass).values/1000. if isinstance(mass, dict) else mass/1000.
+        table['Q charge/mA.h/g'] = table['Q charge/mA.h']/grams
+        table['Q discharge/mA.h/g'] = table['Q discharge/mA.h']/grams
+    return table
+
+def cycle_summary(cycles, current, time, voltage, cells=None, mass=None):
+    """Computes one row of battery metrics per cycle from the raw data, with segmented reductions (np.add.reduceat) over the runs of constant cycle number rather than loops over rows or cycles.
+
+    Charge and discharge are the parts of each cycle with positive and negative current. Capacities are the integrals of the current over time (mA.h), energies the integrals of voltage times current (mW.h). Coulombic and energy efficiencies are discharge over charge, polarization is the difference of the average charge and discharge voltages and retention is relative to the first cycle with a discharge.
+
+    Arguments
+    ---------
+    cycles : numpy.array
+        cycle number of every row
+    current : numpy.array
+        current in mA
+    time : numpy.array
+        time in s
+    voltage : numpy.array
+        cell voltage in V
+    cells : numpy.array
+        cell label of every row to summarise many cells at once (rows of a cell must be contiguous), or None
+    mass : float or dict
+        active mass in mg (a dict of cell -> mass with cells) to add specific capacities
+
+    Returns a DataFrame indexed by cycle, or by (cell, cycle).
+    """
+    cycles = np.asarray(cycles)
+    current = np.asarray(current, dtype=float)
+    time = np.asarray(time, dtype=float)
+    starts = _segment_starts(cycles, cells)
+    dt = np.diff(time, prepend=time[0])
+    dt[~(dt > 0)] = 0
+    if cells is not None:
+        cells = np.asarray(cells)
+        dt[np.flatnonzero(cells[1:] != cells[:-1]) + 1] = 0
+    dq = current*dt/3600.
+    de = dq*np.asarray(voltage, dtype=float)
+    charge = current > 0
+    rows = np.column_stack((np.where(charge, dq, 0), np.where(charge, 0, -dq), np.where(charge, de, 0), np.where(charge, 0, -de)))
+    return _summary_table(starts, np.add.reduceat(rows, starts, axis=0), cycles, cells, mass)
+
+def cycle_summary_from_counters(cycles, q_charge, q_discharge, energy_charge=None, energy_discharge=None, cells=None, mass=None):
+    """Same as cycle_summary for data that already holds per-cycle counters (e.g. Q charge/mA.h, Q discharge/mA.h and Energy charge/W.h of processed EC-Lab files): the largest value of each counter in every cycle is taken with np.maximum.reduceat. Energies are given in W.h."""
+    cycles = np.asarray(cycles)
+    if cells is not None:
+        cells = np.asarray(cells)
+    starts = _segment_starts(cycles, cells)
+    missing = np.full(len(cycles), np.nan)
+    counters = [q_charge, q_discharge, 1000*np.asarray(energy_charge) if energy_charge is not None else missing, 1000*np.asarray(energy_discharge) if energy_discharge is not None else missing]
+    rows = np.abs(np.column_stack([np.asarray(counter, dtype=float) for counter in counters]))
+    return _summary_table(starts, np.maximum.reduceat(rows, starts, axis=0), cycles, cells, mass, how='max')
+
+def _mass_mg(text):
+    """Internal function. Active mass in mg from a header value such as '10.000 mg', or None."""
+    try:
+        value, unit = text.split()[:2]
+        return float(value)*{'mg': 1., 'g': 1000., 'µg': 0.001}[unit]
+    except (ValueError, KeyError, AttributeError):
+        return None
+
+def cycle_summaries(cells, mass=None):
+    """Cycle summaries of many cells (MPTFile, MPRFile or processedMPTFile objects) as one DataFrame indexed by (cell, cycle), cells being named by shortname (or filename).
+
+    The raw data of MPTFile and MPRFile cells are concatenated and summarised in one pass of cycle_summary. mass is a dict of cell name -> mass in mg; by default each cell's 'Mass of active material' is used."""
+    names = [cell.shortname or cell.filename for cell in cells]
+    masses = dict((name, _mass_mg(cell.mass_am)) for name, cell in zip(names, cells))
+    masses.update(mass or {})
+    raw = [(name, cell) for name, cell in zip(names, cells) if isinstance(cell, MPTFile)]
+    tables = []
+    if raw:
+        arrays = [cell._summary_arrays() for name, cell in raw]
+        labels = np.repeat(np.arange(len(raw)), [len(array[0]) for array in arrays])
+        columns = [np.concatenate([array[i] for array in arrays]) for i in range(4)]
+        table = cycle_summary(*columns, cells=labels, mass=dict((i, masses[name]) for i, (name, cell) in enumerate(raw)) if all(masses[name] for name, cell in raw) else None)
+        tables.append(table.rename(index=dict(enumerate(name for name, cell in raw)), level='cell'))
+    for name, cell in zip(names, cells):
+        if not isinstance(cell, MPTFile):
+            table = cell.cycle_summary(mass=masses[name])
+            tables.append(pd.concat([table], keys=[name], names=['cell']))
+    return pd.concat(tables).reindex(pd.unique(np.array(names)), level='cell')
+
+
+# Differential capacity
+def _curve_rows(starts, stops):
+    """Internal function. Row numbers of the concatenated curves and the curve number of each row."""
+    lengths = stops - starts
+    labels = np.repeat(np.arange(len(starts)), lengths)
+    rows = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return rows, labels
+
+def differential_capacity(voltage, capacity, starts, stops, dv=0.005, vmin=None, vmax=None, method='histogram', window=11, polyorder=3, smoothing=None):
+    """Differential capacity |dQ/dV| of many curves (cycles or half cycles) on a common voltage grid.
+
+    Arguments
+    ---------
+    voltage, capacity : numpy.array
+        cell voltage (V) and capacity of every row
+    starts, stops : numpy.array
+        first and last + 1 rows of each curve
+    dv : float
+        voltage step of the grid (V)
+    vmin, vmax : float
+        range of the grid, the range of the data by default
+    method : str
+        'histogram' adds the capacity passed in each voltage bin and divides by dv, all curves with one bincount (robust to noise and to voltage steps of zero);
+        'savgol' interpolates Q(V) of each curve on the grid and differentiates all curves at once with a Savitzky-Golay filter of 'window' points and order 'polyorder';
+        'spline' differentiates a smoothing spline of Q(V) of each curve ('smoothing' is the s argument of scipy.interpolate.UnivariateSpline)
+
+    The capacity of a curve is taken as its cumulative |dQ|, so charge and discharge both give positive values. Returns (grid, dqdv): the bin centers and an array of shape (n_curves, n_bins), NaN where a curve has no data with 'savgol' and 'spline'.
+    """
+    voltage = np.asarray(voltage, dtype=float)
+    capacity = np.asarray(capacity, dtype=float)
+    starts, stops = np.asarray(starts), np.asarray(stops)
+    rows, labels = _curve_rows(starts, stops)
+    v, q = voltage[rows], capacity[rows]
+    vmin = np.nanmin(v) if vmin is None else vmin
+    vmax = np.nanmax(v) if vmax is None else vmax
+    n_bins = max(int(np.ceil((vmax - vmin)/dv)), 1)
+    grid = vmin + dv*(np.arange(n_bins) + 0.5)
+    same = labels[1:] == labels[:-1]
+    dq = np.where(same, np.abs(np.diff(q)), 0)
+    if method == 'histogram':
+        bins = np.floor(((v[1:] + v[:-1])/2 - vmin)/dv).astype(int)
+        valid = same & (bins >= 0) & (bins < n_bins) & np.isfinite(dq)
+        dqdv = np.bincount(labels[1:][valid]*n_bins + bins[valid], weights=dq[valid], minlength=len(starts)*n_bins)
+        return grid, dqdv.reshape(len(starts), n_bins)/dv
+    # Cumulative |dQ| of each curve, starting from 0
+    cumulative = np.concatenate(([0], np.cumsum(dq)))
+    cumulative -= cumulative[np.repeat(np.cumsum(stops - starts) - (stops - starts), stops - starts)]
+    curves = np.full((len(starts), n_bins), np.nan)
+    offsets = np.concatenate(([0], np.cumsum(stops - starts)))
+    for k in range(len(starts)):
+        x, y = v[offsets[k]:offsets[k + 1]], cumulative[offsets[k]:offsets[k + 1]]
+        if len(x) < 2:
+            continue
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+        inside = (grid >= x[0]) & (grid <= x[-1])
+        if method == 'savgol':
+            curves[k, inside] = np.interp(grid[inside], x, y)
+        elif method == 'spline':
+            x, first = np.unique(x, return_index=True)
+            if len(x) > 3:
+                spline = interpolate.UnivariateSpline(x, y[first], s=smoothing)
+                curves[k, inside] = np.abs(spline.derivative()(grid[inside]))
+        else:
+            raise ValueError("method must be 'histogram', 'savgol' or 'spline'")
+    if method == 'savgol':
+        # NaN outside each curve: filter the filled stack and blank the edges again
+        filled = pd.DataFrame(curves.T).ffill().bfill().fillna(0).values.T
+        curves = np.where(np.isnan(curves), np.nan, np.abs(signal.savgol_filter(filled, window, polyorder, deriv=1, delta=dv, axis=1)))
+    return grid, curves
+
+def track_peaks(grid, dqdv, labels=None, window=0.05, prominence=0.05, reference=0):
+    """Follows the peaks of differential capacity curves from one cycle to the next, for degradation analysis.
+
+    Peaks are found on the 'reference' curve with scipy.signal.find_peaks ('prominence' as a fraction of its maximum). In each following curve every peak is moved to the maximum within 'window' volts of its position in the previous curve, all peaks at once.
+
+    Returns a DataFrame with one row per curve (indexed by labels) and columns (peak, 'voltage'/'dQ/dV')."""
+    dqdv = np.asarray(dqdv, dtype=float)
+    curve = np.nan_to_num(dqdv[reference])
+    peaks, properties = signal.find_peaks(curve, prominence=prominence*curve.max())
+    positions = grid[peaks]
+    voltages = np.full((len(dqdv), len(peaks)), np.nan)
+    heights = np.full((len(dqdv), len(peaks)), np.nan)
+    # Forward from the reference curve, then backward from it
+    for k in list(range(reference, len(dqdv))) + list(range(reference - 1, -1, -1)):
+        if k == reference - 1:
+            positions = grid[peaks]
+        near = np.abs(grid - positions[:, np.newaxis]) <= window
+        values = np.where(near, np.nan_to_num(dqdv[k], nan=-np.inf), -np.inf)
+        best = values.argmax(axis=1)
+        found = np.isfinite(values[np.arange(len(peaks)), best]) & (values[np.arange(len(peaks)), best] > 0)
+        voltages[k] = np.where(found, grid[best], np.nan)
+        heights[k] = np.where(found, dqdv[k, best], np.nan)
+        positions = np.where(found, grid[best], positions)
+    columns = pd.MultiIndex.from_product([range(len(peaks)), ['voltage', 'dQ/dV']], names=['peak', None])
+    data = np.stack((voltages, heights), axis=2).reshape(len(dqdv), -1)
+    return pd.DataFrame(data, index=labels, columns=columns)
+
+
+# Impedance
+# Circuit elements -> parameter names. Impedances are given for s = jω:
+#   R: R    C: 1/(sC)    CPE: 1/(Q s^alpha)    W: sigma (1 - j)/sqrt(ω), the semi-infinite Warburg element
+circuit_elements = {
+    'R': ['R'],
+    'C': ['C'],
+    'CPE': ['Q', 'alpha'],
+    'W': ['sigma'],
+}
+
+def _element_impedance(kind, s, p):
+    """Internal function. Impedance of one element and its derivatives with respect to its parameters, for parameters p of shape (..., n) broadcast against s."""
+    if kind == 'R':
+        R = p[..., 0:1]
+        return R + 0j*s, [np.ones_like(R) + 0j*s]
+    if kind == 'C':
+        Z = 1/(s*p[..., 0:1])
+        return Z, [-Z/p[..., 0:1]]
+    if kind == 'CPE':
+        Q, alpha = p[..., 0:1], p[..., 1:2]
+        Z = 1/(Q*s**alpha)
+        return Z, [-Z/Q, -Z*np.log(s)]
+    if kind == 'W':
+        dZ = (1 - 1j)/np.sqrt(s.imag) + 0*p[..., 0:1]
+        return p[..., 0:1]*dZ, [dZ]
+
+class Circuit(object):
+    """Equivalent circuit built from R, C, CPE and W elements, written as in 'R0-p(R1,CPE1)-W1': '-' joins elements in series and p(a,b,...) in parallel. Every element is numbered so that its parameters have distinct names (R0, R1, CPE1 Q, CPE1 alpha, W1 sigma).
+
+    Impedances are evaluated for every frequency at once, and for many parameter sets at once when parameters has leading dimensions, together with the analytic derivatives with respect to every parameter.
+
+    Arguments
+    ---------
+    description : str
+        the circuit, e.g. 'R0-p(R1,C1)'.
+    """
+
+    def __init__(self, description):
+        self.description = description
+        self._tokens = re.findall(r'p\(|CPE\d*|[RCW]\d*|[-,)]', description.replace(' ', ''))
+        if ''.join(self._tokens) != description.replace(' ', ''):
+            raise ValueError('Cannot read the circuit ' + description)
+        self._position = 0
+        self.elements = []
+        self.tree = self._series()
+        if self._position != len(self._tokens):
+            raise ValueError('Cannot read the circuit ' + description)
+        self.names = []
+        for label, kind in self.elements:
+            self.names += [label] if kind in ['R', 'C'] else [label + ' ' + name for name in circuit_elements[kind]]
+
+    def __repr__(self):
+        return "Circuit('{0}')".format(self.description)
+
+    def _next(self):
+        token = self._tokens[self._position] if self._position < len(self._tokens) else ''
+        self._position += 1
+        return token
+
+    def _series(self):
+        """Internal function. Parses terms joined by '-' into ('series', [terms])."""
+        terms = [self._term()]
+        while self._position < len(self._tokens) and self._tokens[self._position] == '-':
+            self._position += 1
+            terms.append(self._term())
+        return terms[0] if len(terms) == 1 else ('series', terms)
+
+    def _term(self):
+        """Internal function. Parses an element or a p(...) group into the circuit tree."""
+        token = self._next()
+        if token == 'p(':
+            branches = [self._series()]
+            token = self._next()
+            while token == ',':
+                branches.append(self._series())
+                token = self._next()
+            if token != ')' or len(branches) < 2:
+                raise ValueError('Cannot read the circuit ' + self.description)
+            return ('parallel', branches)
+        kind = re.match(r'CPE|[RCW]', token or ' ')
+        if kind is None:
+            raise ValueError('Cannot read the circuit ' + self.description)
+        n_before = sum(len(circuit_elements[k]) for label, k in self.elements)
+        self.elements.append((token, kind.group()))
+        return (kind.group(), slice(n_before, n_before + len(circuit_elements[kind.group()])))
+
+    def _evaluate(self, node, s, parameters):
+        """Internal function. Returns the impedance of a node of the tree and a list of (parameter position, derivative)."""
+        kind, content = node
+        if kind in circuit_elements:
+            Z, dZ = _element_impedance(kind, s, parameters[..., content])
+            return Z, list(zip(range(content.start, content.stop), dZ))
+        results = [self._evaluate(child, s, parameters) for child in content]
+        if kind == 'series':
+            return sum(Z for Z, dZ in results), [d for Z, dZ in results for d in dZ]
+        Z = 1/sum(1/Zi for Zi, dZi in results)
+        return Z, [(i, (Z/Zi)**2*d) for Zi, dZi in results for i, d in dZi]
+
+    def impedance(self, frequency, parameters):
+        """Returns the complex impedance at frequency (Hz) for parameters of shape (n_parameters,) or (..., n_parameters)."""
+        return self.jacobian(frequency, parameters)[0]
+
+    def jacobian(self, frequency, parameters):
+        """Returns the complex impedance (..., n_frequencies) and its derivatives with respect to the parameters (..., n_frequencies, n_parameters)."""
+        s = 2j*np.pi*np.asarray(frequency, dtype=float)
+        parameters = np.asarray(parameters, dtype=float)
+        Z, derivatives = self._evaluate(self.tree, s, parameters)
+        J = np.zeros(Z.shape + (len(self.names),), dtype=complex)
+        for i, d in derivatives:
+            J[..., i] = d
+        return Z, J
+
+    def guess(self, frequency, Z):
+        """Returns starting parameters for a spectrum: the first resistance is the high frequency intercept and the others share the width of the spectrum on the real axis, capacitances and CPEs get the time constant of the top of the arc."""
+        f_top = frequency[np.argmax(-Z.imag)]
+        width = max(np.ptp(Z.real), 1e-3)
+        n_R = sum(kind == 'R' for label, kind in self.elements)
+        resistances = [max(Z.real.min(), 1e-3)] + [width/(n_R - 1)]*(n_R - 1) if n_R > 1 else [max(Z.real.max(), 1e-3)]
+        values = []
+        for label, kind in self.elements:
+            if kind == 'R':
+                values.append(resistances.pop(0))
+            elif kind == 'C':
+                values.append(1/(2*np.pi*f_top*width))
+            elif kind == 'CPE':
+                values += [1/(2*np.pi*f_top*width), 0.9]
+            else:
+                values.append(width/10)
+        return np.array(values)
+
+    def fit(self, frequency, Z, initial=None):
+        """Fits the circuit to one spectrum by least squares on the real and imaginary parts weighted by 1/|Z|, with the analytic Jacobian. Parameters are fitted as logarithms so that they stay positive (and alpha of CPEs at most 1).
+
+        Returns the parameters and the relative root mean square residual."""
+        frequency = np.asarray(frequency, dtype=float)
+        Z = np.asarray(Z, dtype=complex)
+        initial = self.guess(frequency, Z) if initial is None or not np.all(np.isfinite(initial)) else np.asarray(initial, dtype=float)
+        weight = 1/np.abs(Z)
+        upper = np.array([0 if name.endswith('alpha') else np.inf for name in self.names])
+
+        def residuals(log_parameters):
+            difference = (self.impedance(frequency, np.exp(log_parameters)) - Z)*weight
+            return np.concatenate([difference.real, difference.imag])
+
+        def jacobian(log_parameters):
+            parameters = np.exp(log_parameters)
+            J = self.jacobian(frequency, parameters)[1]*parameters*weight[:, None]
+            return np.concatenate([J.real, J.imag])
+
+        start = np.minimum(np.log(np.maximum(initial, 1e-300)), upper - 1e-9)
+        result = optimize.least_squares(residuals, start, jac=jacobian, bounds=(-np.inf, upper), method='trf')
+        return np.exp(result.x), np.sqrt(np.mean(result.fun**2))
+
+def _fit_spectra(description, spectra, initial, warm_start):
+    """Internal function. Fits spectra one after the other, each starting from the parameters of the previous one if warm_start. Runs in the worker processes of fit_spectra."""
+    circuit = Circuit(description)
+    results = []
+    for frequency, Z in spectra:
+        parameters, residual = circuit.fit(frequency, Z, initial)
+        results.append(np.append(parameters, residual))
+        if warm_start:
+            initial = parameters
+    return results
+
+def fit_spectra(circuit, spectra, initial=None, warm_start=True, processes=1):
+    """Fits an equivalent circuit to many impedance spectra, e.g. one per cycle.
+
+    Arguments
+    ---------
+    circuit : str or Circuit
+        the equivalent circuit, e.g. 'R0-p(R1,CPE1)-W1'.
+    spectra : list
+        (frequency, complex impedance) of every spectrum, in cycling order.
+    initial : array
+        starting parameters of the first spectrum, guessed from the data by default.
+    warm_start : bool
+        start each fit from the result of the previous spectrum, which changes little from one cycle to the next.
+    processes : int
+        number of worker processes. The spectra are split into as many consecutive runs, each fitted with warm starts in its own process.
+
+    Returns a DataFrame with one row per spectrum and one column per parameter, plus 'residual' (relative root mean square).
+    """
+    circuit = circuit if isinstance(circuit, Circuit) else Circuit(circuit)
+    spectra = [(np.asarray(frequency, dtype=float), np.asarray(Z, dtype=complex)) for frequency, Z in spectra]
+    runs = [run.tolist() for run in np.array_split(np.arange(len(spectra)), max(min(processes, len(spectra)), 1))]
+    if processes == 1:
+        results = _fit_spectra(circuit.description, spectra, initial, warm_start)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(_fit_spectra, circuit.description, [spectra[i] for i in run], initial, warm_start) for run in runs]
+            results = [row for future in futures for row in future.result()]
+    return pd.DataFrame(np.array(results).reshape(len(spectra), -1), columns=circuit.names + ['residual'])
+
+def split_spectra(frequency, Z, labels=None):
+    """Splits impedance data into spectra, at every change of labels (e.g. the cycle number) or, by default, wherever the frequency sweep starts again. Rows without a frequency (other techniques in the same file) are dropped. Returns a list of (frequency, Z)."""
+    frequency = np.asarray(frequency, dtype=float)
+    Z = np.asarray(Z)
+    keep = frequency > 0
+    if labels is None:
+        # Sweeps go from high to low frequency (or the other way round): a spectrum ends where the direction changes
+        direction = np.sign(np.diff(frequency[keep]))
+        main = np.sign(np.sum(direction)) or -1
+        breaks = np.flatnonzero(direction == -main) + 1
+    else:
+        breaks = np.flatnonzero(np.diff(np.asarray(labels)[keep]) != 0) + 1
+    return list(zip(np.split(frequency[keep], breaks), np.split(Z[keep], breaks)))
+
+def plot_nyquist(Z, ax=None, *args, **kwargs):
+    """Plots -Im(Z) against Re(Z) with equal axes. Returns the Line2D."""
+    ax = ax or plt.gca()
+    line, = ax.plot(np.real(Z), -np.imag(Z), *args, **kwargs)
+    ax.set_aspect('equal', adjustable='datalim')
+    ax.set_xlabel('Re(Z)/Ohm', fontsize=12)
+    ax.set_ylabel('-Im(Z)/Ohm', fontsize=12)
+    return line
+
+def plot_bode(frequency, Z, axes=None, *args, **kwargs):
+    """Plots |Z| and -Phase(Z) against frequency on log axes, on two axes (created on the current figure by default). Returns the two axes."""
+    axes = axes if axes is not None else plt.gcf().subplots(2, 1, sharex=True)
+    axes[0].loglog(frequency, np.abs(Z), *args, **kwargs)
+    axes[1].semilogx(frequency, -np.degrees(np.angle(Z)), *args, **kwargs)
+    axes[0].set_ylabel('|Z|/Ohm', fontsize=12)
+    axes[1].set_ylabel('-Phase(Z)/deg', fontsize=12)
+    axes[1].set_xlabel('freq/Hz', fontsize=12)
+    return axes
+
+
+half_cycle_names = {'ox': 1, 'charge': 1, 'red': 0, 'discharge': 0}
+
+class CycleIndex(object):
+    """Row boundaries of the cycles and half cycles of a cycling dataset, found once from the cycle number (and ox/red) columns.
+
+    Rows of a cycle are contiguous in EC-Lab files, so every cycle or half cycle is a slice of the data: cycle(n) and half_cycle(n, 'charge') return slices in O(1) and split returns zero-copy views of any column. Half cycles are the runs of constant ox/red within a cycle; 'charge' and 'discharge' follow the cathode convention (oxidation is charge).
+
+    Arguments
+    ---------
+    cycles : numpy.array
+        cycle number of every row
+    ox_red : numpy.array
+        ox/red flag of every row (1 oxidation, 0 reduction), or None
+    """
+
+    def __init__(self, cycles, ox_red=None):
+        cycles = np.asarray(cycles)
+        change = cycles[1:] != cycles[:-1]
+        if ox_red is not None:
+            ox_red = np.asarray(ox_red)
+            change |= ox_red[1:] != ox_red[:-1]
+        starts = np.concatenate(([0], np.flatnonzero(change) + 1))
+        stops = np.append(starts[1:], len(cycles))
+        # One row per run of constant cycle number (and ox/red)
+        self.segments = pd.DataFrame({'cycle': cycles[starts], 'start': starts, 'stop': stops})
+        if ox_red is not None:
+            self.segments.insert(1, 'ox/red', ox_red[starts])
+        self.table, self._cycles = self._bounds(['cycle'])
+        self.half_table, self._half_cycles = self._bounds(['cycle', 'ox/red']) if ox_red is not None else (None, {})
+
+    def _bounds(self, keys):
+        """Internal function. First and last row of each group of segments ('contiguous' is False when other rows fall in between) and a dict of key -> rows."""
+        groups = self.segments.assign(rows=self.segments['stop'] - self.segments['start']).groupby(keys, sort=False)
+        table = groups.agg(start=('start', 'min'), stop=('stop', 'max'), rows=('rows', 'sum'))
+        table['contiguous'] = table['stop'] - table['start'] == table['rows']
+        rows = {}
+        for key, start, stop in zip(table.index, table['start'], table['stop']):
+            rows[key] = slice(start, stop)
+        for key in table.index[~table['contiguous'].values]:
+            # Interrupted runs: the rows of every segment (indexing with these copies)
+            segments = self.segments.iloc[groups.indices[key]]
+            rows[key] = np.concatenate([np.arange(start, stop) for start, stop in zip(segments['start'], segments['stop'])])
+        return table, rows
+
+    @property
+    def cycles(self):
+        """Cycle numbers in the order they appear."""
+        return self.table.index.values
+
+    def __len__(self):
+        return len(self.table)
+
+    def cycle(self, number):
+        """Returns the rows of a cycle as a slice (an index array if the cycle is interrupted by other rows)."""
+        return self._cycles[number]
+
+    def half_cycle(self, number, half):
+        """Returns the rows of the 'ox'/'charge' (1) or 'red'/'discharge' (0) half of a cycle as a slice."""
+        if self.half_table is None:
+            raise ValueError('No ox/red column was given for half cycles')
+        return self._half_cycles[(number, half_cycle_names.get(half, half))]
+
+    def split(self, array, cycles=None, half=None):
+        """Returns a list of views of array, one per cycle (all cycles by default) or per half cycle if half is given."""
+        cycles = self.cycles if cycles is None else cycles
+        if half is None:
+            return [array[self.cycle(number)] for number in cycles]
+        return [array[self.half_cycle(number, half)] for number in cycles]
 
 class processedMPTFile(object):
     """Loads data from a processed (IQxnE) .mpt file produced in EC-Lab or BT-Lab. Will also work for .txt files exported by the software."""
@@ -20,31 +665,25 @@ class processedMPTFile(object):
     skip_line = 1
     dataframe = ""
     start_of_method = 3
+    column_list = []            # Column names, assigned in __init__
+    header = []                 # Header lines, assigned in __init__
     efficiency_column = 0
     capacity_column = 0
     cycle_number_column = 0
        
-    def _lines_to_skip(self, filename):
-        file = open(filename, 'r', encoding='latin-1')
-        for line in file:
-            if "Nb header lines : " in line:
-                return int(line.strip("Nb header lines : "))
-                break
-        return 1
-    
     def _get_columns(self):
-        file = open(self.filename, 'r', encoding='latin-1')
-        line = file.readlines()[self.skip_line-1]
-        columns = line.split('\t')
-        return columns
+        return self.column_list
     
     def __init__(self, filename, shortname=""):
-        columns = []
-        self.comments = []
         self.filename = filename
         self.shortname = shortname
-        self.skip_line = self._lines_to_skip(filename)
-        file = open(filename, 'r', encoding='latin-1')
+        header = read_mpt_header(filename)
+        for key, attribute in header_keys:
+            setattr(self, attribute, header[attribute])
+        self.skip_line = header['skip_line']
+        self.start_of_method = header['start_of_method']
+        self.header = header['header']
+        self.column_list = header['columns']
         columns = self._get_columns()
         for column in range(0, len(columns)):
             if 'cycle number' in columns[column]:             
@@ -53,31 +692,8 @@ class processedMPTFile(object):
                 self.capacity_column = column
             if 'Efficiency' in columns[column]:
                 self.efficiency_column = column
-        i = 0
-        for line in file:
-            i += 1
-            if "Run on channel : " in line:
-                self.channel = line.strip("Run on channel : ").strip('\n')
-            elif "Acquisition started on : " in line:
-                self.date = line.strip("Acquisition started on : ").strip('\n').replace('\t', ' ')
-            elif "Device : " in line:
-                self.device = line.strip("Device : ").strip('\n').replace('\t', ' ')
-            elif "Electrode material : " in line:
-                self.material = line.strip("Electrode material : ").strip('\n').replace('\t', ' ')
-            elif "Initial state : " in line:
-                self.initial_state = line.strip("Initial state : ").strip('\n').replace('\t', ' ')
-            elif "Electrolyte : " in line:
-                self.electrolyte = line.strip("Electrolyte : ").strip('\n').replace('\t', ' ')
-            elif "Comments : " in line:
-                self.comments.append(line.strip("Comments : ").replace('\t', ' '))
-            elif "Mass of active material : " in line:
-                self.mass_am = line.strip("Mass of active material : ").strip('\n').replace('\t', ' ')
-            elif "Electrode surface area : " in line:
-                self.surface_area = line.strip("Electrode surface area : ").strip('\n').replace('\t', ' ')
-                self.start_of_method = i + 2
-            elif "Molecular weight of active material (at x = 0) : " in line:
-                self.mol_weight = line.strip("Molecular weight of active material (at x = 0) : ").strip('\n').replace('\t', ' ')
-        self.dataframe = np.genfromtxt(filename, delimiter=None, skip_header=self.skip_line, autostrip=True, unpack=True)
+        # One row per column, as np.genfromtxt(..., unpack=True) returned
+        self.dataframe = pd.read_csv(filename, sep=r'\s+', skiprows=self.skip_line, header=None, encoding='latin-1').values.astype(float).T
                 
     @property
     def all(self):
@@ -98,15 +714,8 @@ class processedMPTFile(object):
     
     @property
     def method(self):
-        with open(self.filename, encoding='latin-1') as file:
-            for lines in file.readlines()[self.start_of_method:self.skip_line-1]:
-                print (lines.strip('\n'))
-    
-    def _get_columns(self):
-        file = open(self.filename, 'r', encoding='latin-1')
-        line = file.readlines()[self.skip_line-1]
-        columns = line.split('\t')
-        return columns
+        for lines in self.header[self.start_of_method:self.skip_line-1]:
+            print (lines)
 
     @property
     def show_columns(self):
@@ -114,9 +723,39 @@ class processedMPTFile(object):
         for column in range (0,len(columns)):
             print (str(column).zfill(2) +' | ' +columns[column])
 
+    def _find_column(self, name):
+        """Internal function. Position of the first column whose name contains name, or None."""
+        for column in range(0, len(self.column_list)):
+            if name in self.column_list[column]:
+                return column
+        return None
+
+    def cycle_summary(self, mass=None):
+        """Returns one row per cycle of the metrics of cycle_summary, taken from the Q charge, Q discharge and Energy charge/discharge counters of the processed file. Specific capacities are added using mass (mg), the 'Mass of active material' of the header by default."""
+        mass = mass if mass is not None else _mass_mg(self.mass_am)
+        columns = [self._find_column(name) for name in ['Q charge/mA.h', 'Q discharge/mA.h', 'Energy charge/W.h', 'Energy discharge/W.h']]
+        counters = [self.dataframe[column] if column is not None else None for column in columns]
+        return cycle_summary_from_counters(self.dataframe[self.cycle_number_column], *counters, mass=mass)
+
 #class to import ASCII .txt and .mpt files produced in EC-Lab and BT-Lab
 class MPTFile(object):
-    """Loads data from a .mpt file produced in EC-Lab or BT-Lab. Will also work for .txt files exported by the software."""
+    """Loads data from a .mpt file produced in EC-Lab or BT-Lab. Will also work for .txt files exported by the software.
+
+    Arguments
+    ---------
+    filename : str
+        Name of the file you wish to import.
+    shortname : str
+        The name used in legend plotting and other identifying information.
+    usecols : list
+        names of the columns to read, all by default. The first column of the file is always read as the index
+    downcast : bool
+        store floats as float32 (time/s stays float64) and cycle numbers and flags as int32
+    chunksize : int
+        parse the data this many rows at a time, which bounds the memory used by the parser
+    cache : bool
+        keep the columns in a '.npz' file next to the .mpt file and read them from there while the .mpt file is unchanged
+    """
     filename = ""
     shortname = ""
     channel = ""
@@ -132,50 +771,40 @@ class MPTFile(object):
     skip_line = 0
     dataframe = ""
     start_of_method = 3
-    column_list = []            # Assigned in _lines_to_skip
+    column_list = []            # Column names, assigned in __init__
+    header = []                 # Header lines, assigned in __init__
        
-    def _lines_to_skip(self, filename):
-        file = open(filename, 'r', encoding='latin-1')
-        for line in file:
-            if "Nb header lines : " in line:
-                self.column_list = line.strip("Nb header lines : ").split('\t')
-                return int(line.strip("Nb header lines : "))
-    
-    def __init__(self, filename, shortname=""):
-        self.comments = []
+    def __init__(self, filename, shortname="", usecols=None, downcast=False, chunksize=None, cache=False):
         self.filename = filename
         self.shortname = shortname
-        self.skip_line = self._lines_to_skip(filename)
-        file = open(filename, 'r', encoding='latin-1')
-        i = 0
-        for line in file:
-            i += 1
-            if "Run on channel : " in line:
-                self.channel = line.strip("Run on channel : ").strip('\n')
-            elif "Acquisition started on : " in line:
-                self.date = line.strip("Acquisition started on : ").strip('\n').replace('\t', ' ')
-            elif "Device : " in line:
-                self.device = line.strip("Device : ").strip('\n').replace('\t', ' ')
-            elif "Electrode material : " in line:
-                self.material = line.strip("Electrode material : ").strip('\n').replace('\t', ' ')
-            elif "Initial state : " in line:
-                self.initial_state = line.strip("Initial state : ").strip('\n').replace('\t', ' ')
-            elif "Electrolyte : " in line:
-                self.electrolyte = line.strip("Electrolyte : ").strip('\n').replace('\t', ' ')
-            elif "Comments : " in line:
-                self.comments.append(line.strip("Comments : ").replace('\t', ' '))
-            elif "Mass of active material : " in line:
-                self.mass_am = line.strip("Mass of active material : ").strip('\n').replace('\t', ' ')
-            elif "Electrode surface area : " in line:
-                self.surface_area = line.strip("Electrode surface area : ").strip('\n').replace('\t', ' ')
-                self.start_of_method = i + 2
-            elif "Molecular weight of active material (at x = 0) : " in line:
-                self.mol_weight = line.strip("Molecular weight of active material (at x = 0) : ").strip('\n').replace('\t', ' ')
-        # self.dataframe = np.genfromtxt(filename, delimiter=None, skip_header=self.skip_line, autostrip=True, unpack=True)
-        # line = file.readlines()[self.skip_line-1]
-        # self.column_list = line.split('\t')
-        self.dataframe = pd.read_csv(filename, sep='\t', skiprows=self.skip_line-1, header=0, index_col=0, encoding='latin-1')
-        file.close()
+        header = read_mpt_header(filename)
+        for key, attribute in header_keys:
+            setattr(self, attribute, header[attribute])
+        self.skip_line = header['skip_line']
+        self.start_of_method = header['start_of_method']
+        self.header = header['header']
+        self.column_list = header['columns']
+        if usecols is not None and self.column_list[0] not in usecols:
+            usecols = [self.column_list[0]] + list(usecols)
+        cache_file = os.path.splitext(filename)[0] + '.npz'
+        stamp = dict(_cache_stamp(filename), downcast=bool(downcast))
+        # A full read needs every column of the file in the cache, not whatever an earlier restricted read left there
+        self.dataframe = read_column_cache(cache_file, usecols or self.column_list, stamp) if cache else None
+        if self.dataframe is None:
+            parse = usecols
+            if cache and usecols is not None:
+                # Parse the columns already cached as well, so that the cache holds the union of the columns read
+                wanted = set(usecols) | set(cached_columns(cache_file, stamp))
+                parse = [column for column in self.column_list if column in wanted]
+            if parse is None and not downcast and not chunksize:
+                self.dataframe = pd.read_csv(filename, sep='\t', skiprows=self.skip_line-1, header=0, usecols=self.column_list, index_col=0, encoding='latin-1')
+            else:
+                self.dataframe = pd.concat(iter_mpt(filename, chunksize, parse, downcast, header)).set_index(self.column_list[0])
+            if cache:
+                write_column_cache(self.dataframe, cache_file, stamp)
+            if parse != usecols:
+                self.dataframe = self.dataframe[[column for column in self.dataframe.columns if column in usecols]]
+        self._cycle_indexes = {}
         
     @property
     def all(self):
@@ -196,15 +825,12 @@ class MPTFile(object):
     
     @property
     def method(self):
-        with open(self.filename, encoding='latin-1') as file:
-            for lines in file.readlines()[self.start_of_method:self.skip_line-1]:
-                print (lines.strip('\n'))
+        for lines in self.header[self.start_of_method:self.skip_line-1]:
+            print (lines)
     
     @property
     def show_columns(self):
-        file = open(self.filename, 'r', encoding='latin-1')
-        line = file.readlines()[self.skip_line-1]
-        columns = line.split('\t')
+        columns = self.column_list
         for column in range (0,len(columns)):
             print (str(column).zfill(2) +' | ' +columns[column])
     
@@ -215,17 +841,59 @@ class MPTFile(object):
     
     def specific_capacity(self, capacity_column, mass_am):
         self.dataframe = self.dataframe.assign(specific_capacity=self.dataframe[capacity_column]/mass_am)
+
+    def _summary_arrays(self, cycle_column='cycle number', current_column=None, time_column='time/s', voltage_column='Ewe/V'):
+        """Internal function. Returns the cycle, current, time and voltage columns used by cycle_summary."""
+        if current_column is None:
+            current_column = 'I/mA' if 'I/mA' in self.dataframe.columns else '<I>/mA'
+        return [self._values(column) for column in (cycle_column, current_column, time_column, voltage_column)]
+
+    def cycle_summary(self, mass=None, cycle_column='cycle number', current_column=None, time_column='time/s', voltage_column='Ewe/V'):
+        """Returns one row per cycle of charge and discharge capacities and energies, coulombic and energy efficiencies, average voltages, polarization and capacity retention (see cycle_summary). Specific capacities are added using mass (mg), the 'Mass of active material' of the header by default. current_column defaults to I/mA, or <I>/mA if absent."""
+        mass = mass if mass is not None else _mass_mg(self.mass_am)
+        return cycle_summary(*self._summary_arrays(cycle_column, current_column, time_column, voltage_column), mass=mass)
                         
+    def _values(self, column):
+        """Internal function. Returns the values of a column, the index (first column of the file) included. Integers that are not column names are positions as listed by show_columns."""
+        if column == self.dataframe.index.name:
+            return self.dataframe.index.values
+        if isinstance(column, int) and column not in self.dataframe.columns:
+            return self._values(self.column_list[column])
+        return self.dataframe[column].values
+
+    def cycle_index(self, cycle_column='cycle number', ox_red_column='ox/red'):
+        """Returns the CycleIndex of the data. It is built on first use and kept, so selecting cycles afterwards does not scan the data. Half cycles are available if the file has an ox/red column."""
+        key = (cycle_column, ox_red_column)
+        if key not in self._cycle_indexes:
+            has_ox_red = ox_red_column in self.dataframe.columns or ox_red_column == self.dataframe.index.name
+            self._cycle_indexes[key] = CycleIndex(self._values(cycle_column), self._values(ox_red_column) if has_ox_red else None)
+        return self._cycle_indexes[key]
+
+    def cycle(self, number, half=None, cycle_column='cycle number'):
+        """Returns the rows of one cycle, or of its 'charge'/'discharge' half if half is given, as a DataFrame."""
+        index = self.cycle_index(cycle_column)
+        return self.dataframe.iloc[index.cycle(number) if half is None else index.half_cycle(number, half)]
+
+    def plot_cycles(self, x, y, cycles=None, half=None, cmap='viridis', cycle_column='cycle number', linewidth=1.5, colorbar=True):
+        """Plots many cycles (all by default) at once as a LineCollection colored by cycle number. half='charge' or 'discharge' plots only that half of each cycle."""
+        index = self.cycle_index(cycle_column)
+        cycles = index.cycles if cycles is None else np.asarray(cycles)
+        xdata = index.split(self._values(x), cycles, half)
+        ydata = index.split(self._values(y), cycles, half)
+        lines = LineCollection([np.column_stack((a, b)) for a, b in zip(xdata, ydata)], cmap=cmap, linewidth=linewidth)
+        lines.set_array(np.asarray(cycles, dtype=float))
+        ax = plt.gca()
+        ax.add_collection(lines)
+        ax.autoscale_view()
+        if colorbar:
+            plt.colorbar(lines, ax=ax, label=cycle_column)
+        return lines
+
     def plot(self, x, y, legend="", color="red", cycle='', cycle_column="", disconnect=False, end_point=False, end_point_color='', linewidth=1.5, *args, **kwargs):
         if cycle or cycle is 0:
-            xdata, ydata=[],[]
-            for data_point in range (0, len(self.dataframe[cycle_column])):
-                if self.dataframe[cycle_column].values[data_point] == cycle:
-                    xdata.append(self.dataframe[x].values[data_point])
-                    ydata.append(self.dataframe[y].values[data_point])
-                    #print (xdata, ydata)
-                else:
-                    pass 
+            rows = self.cycle_index(cycle_column or 'cycle number').cycle(cycle)
+            xdata = self._values(x)[rows]
+            ydata = self._values(y)[rows]
             if disconnect:
                 pos = np.where(np.abs(np.diff(xdata)) >= 0.001 )[0]+1
                 xdata = np.insert(xdata, pos, np.nan)
@@ -233,30 +901,30 @@ class MPTFile(object):
             else:
                 pass            
             if legend is "None":
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth)
             elif legend:
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth, label=legend)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label=legend)
             elif self.shortname:
-                plt.plot(xdata,ydata, color=color, linewidth=linewidth, label=self.shortname)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label=self.shortname)
             else:
-                plt.plot(xdata,ydata, color=color, linewidth=linewidth, label="no_label")
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label="no_label")
         
         else:
             xdata, ydata = self.dataframe[x], self.dataframe[y]
             if disconnect:
                 pos = np.where(np.abs(np.diff(xdata)) >= 0.01 )[0]+1
                 xdata = np.insert(xdata, pos, np.nan)
-                ydata = np.insert(xdata, pos, np.nan)
+                ydata = np.insert(ydata, pos, np.nan)
             else:
                 pass
             if legend is "None":
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth)
             elif legend:
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth, label=legend)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label=legend)
             elif self.shortname:
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth, label=self.shortname)
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label=self.shortname)
             else:
-                plt.plot(xdata, ydata, color=color, linewidth=linewidth, label="no_label")
+                general.plot_downsampled(xdata, ydata, color=color, linewidth=linewidth, label="no_label")
         if end_point:
             if end_point_color:
                 plt.scatter(self.dataframe[x][-1], self.dataframe[y][-1], color=end_point_color, *args, **kwargs)
@@ -269,22 +937,370 @@ class MPTFile(object):
 
     def plot_diffcap(self, x=10, y=22, n=5, legend="", color="red"):
         """Plots differential capacity. Moving average of n=5 by default"""
-        Ecell = self.dataframe[x]
-        q = self.dataframe[y]
-        qo = self.dataframe[x][0]
-        q = [x-qo for x in q]
-        dE = [x-y for x,y in zip(Ecell, Ecell[2:])]
-        dq = [x-y for x,y in zip(q,q[2:])]
-        dE = np.array(dE)
-        dq = np.array(dq)
-        dqdv = dq/dE
-        dqdv[dqdv == 0] = None
-        Ecell = Ecell[np.logical_not(np.isnan(dqdv))] #removes None data from corresponding data in the other axis
-        dqdv = dqdv[np.logical_not(np.isnan(dqdv))] #removes None data from original data to make arrays the same size 
-        ma = self._moving_average(abs(dqdv), n=n)
+        Ecell = self._values(x).astype(float)
+        q = self._values(y).astype(float)
+        q = q - q[0]
+        dE = Ecell[:-2] - Ecell[2:]
+        dq = q[:-2] - q[2:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dqdv = dq/dE
+        # Points without a voltage change (or without a capacity change) carry no information
+        keep = np.isfinite(dqdv) & (dqdv != 0)
+        Ecell = Ecell[:-2][keep]
+        ma = self._moving_average(np.abs(dqdv[keep]), n=n)
         if legend:
             plt.plot(Ecell[n-1:],ma, color=color, linewidth=1.5, label=legend)
         elif self.shortname:
             plt.plot(Ecell[n-1:],ma, color=color, linewidth=1.5, label=self.shortname)
         else:
             plt.plot(Ecell[n-1:],ma, color=color, linewidth=1.5, label="no_label")
+
+    def diffcap(self, half='discharge', cycles=None, method='histogram', dv=0.005, voltage_column='Ewe/V', capacity_column='(Q-Qo)/mA.h', cycle_column='cycle number', **kwargs):
+        """Returns the differential capacity |dQ/dV| of the 'charge' or 'discharge' half (or the whole, half=None) of each cycle as a DataFrame indexed by voltage with one column per cycle. See differential_capacity for method, dv and the keyword arguments."""
+        index = self.cycle_index(cycle_column)
+        cycles = index.cycles if cycles is None else np.asarray(cycles)
+        rows = [index.cycle(number) if half is None else index.half_cycle(number, half) for number in cycles]
+        if not all(isinstance(row, slice) for row in rows):
+            raise ValueError('Cycles interrupted by other rows are not supported')
+        starts = np.array([row.start for row in rows], dtype=int)
+        stops = np.array([row.stop for row in rows], dtype=int)
+        grid, dqdv = differential_capacity(self._values(voltage_column), self._values(capacity_column), starts, stops, dv=dv, method=method, **kwargs)
+        return pd.DataFrame(dqdv.T, index=pd.Index(grid, name=voltage_column), columns=pd.Index(cycles, name=cycle_column))
+
+    def track_diffcap_peaks(self, half='discharge', window=0.05, prominence=0.05, **kwargs):
+        """Follows the dQ/dV peaks of the first cycle through the following cycles (see track_peaks). Keyword arguments are passed to diffcap. Returns a DataFrame indexed by cycle with the voltage and height of every peak."""
+        curves = self.diffcap(half=half, **kwargs)
+        return track_peaks(curves.index.values, curves.values.T, labels=curves.columns, window=window, prominence=prominence)
+
+    def impedance_spectra(self, by=None, frequency_column='freq/Hz', re_column='Re(Z)/Ohm', im_column='-Im(Z)/Ohm'):
+        """Returns the impedance spectra of PEIS/GEIS data as a list of (frequency, complex impedance), split at every change of the column 'by' (e.g. 'cycle number') or wherever the frequency sweep starts again (see split_spectra)."""
+        Z = self._values(re_column) - 1j*self._values(im_column)
+        return split_spectra(self._values(frequency_column), Z, None if by is None else self._values(by))
+
+    def plot_nyquist(self, spectra=None, by=None, cmap='viridis', *args, **kwargs):
+        """Plots every impedance spectrum (or the positions given in spectra) as a Nyquist plot, coloured along cmap."""
+        data = self.impedance_spectra(by)
+        spectra = range(len(data)) if spectra is None else spectra
+        colors = plt.get_cmap(cmap)(np.linspace(0, 1, max(len(spectra), 2)))
+        for color, i in zip(colors, spectra):
+            plot_nyquist(data[i][1], None, *args, color=color, **kwargs)
+
+    def plot_bode(self, spectra=None, by=None, cmap='viridis', *args, **kwargs):
+        """Plots every impedance spectrum (or the positions given in spectra) as a Bode plot, coloured along cmap. Returns the two axes."""
+        data = self.impedance_spectra(by)
+        spectra = range(len(data)) if spectra is None else spectra
+        colors = plt.get_cmap(cmap)(np.linspace(0, 1, max(len(spectra), 2)))
+        axes = None
+        for color, i in zip(colors, spectra):
+            axes = plot_bode(data[i][0], data[i][1], axes, *args, color=color, **kwargs)
+        return axes
+
+    def fit_impedance(self, circuit, by=None, initial=None, warm_start=True, processes=1):
+        """Fits an equivalent circuit (e.g. 'R0-p(R1,CPE1)-W1') to every impedance spectrum with fit_spectra. Returns a DataFrame of the parameters with one row per spectrum, indexed by the values of 'by' if given."""
+        result = fit_spectra(circuit, self.impedance_spectra(by), initial, warm_start, processes)
+        if by is not None:
+            labels = self._values(by)[self._values('freq/Hz') > 0]
+            result.index = pd.Index(labels[np.append(0, np.flatnonzero(np.diff(labels) != 0) + 1)], name=by)
+        return result
+
+
+# Binary EC-Lab files
+mpr_magic = b'BIO-LOGIC MODULAR FILE\x1a'.ljust(48) + b'\x00\x00\x00\x00'
+mpr_module_header = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('length', '<u4'), ('version', '<u4'), ('date', 'S8')])
+# Newer EC-Lab versions write 0xFFFFFFFF in place of the length and the real length after it
+mpr_module_header_v2 = np.dtype([('shortname', 'S10'), ('longname', 'S25'), ('max length', '<u4'), ('length', '<u4'), ('version', '<u4'), ('unknown', '<u4'), ('date', 'S8')])
+# Column IDs of the data module packed as bits of one flags byte -> (name, mask)
+mpr_flags = {
+    1: ('mode', 0x03),
+    2: ('ox/red', 0x04),
+    3: ('error', 0x08),
+    21: ('control changes', 0x10),
+    31: ('Ns changes', 0x20),
+    65: ('counter inc.', 0x80),
+}
+# Column IDs of the data module -> (name as in .mpt files, dtype)
+mpr_columns = {
+    4: ('time/s', '<f8'),
+    5: ('control/V/mA', '<f4'),
+    6: ('Ewe/V', '<f4'),
+    7: ('dq/mA.h', '<f8'),
+    8: ('I/mA', '<f4'),
+    9: ('Ece/V', '<f4'),
+    11: ('<I>/mA', '<f8'),
+    13: ('(Q-Qo)/mA.h', '<f8'),
+    16: ('Analog IN 1/V', '<f4'),
+    19: ('control/V', '<f4'),
+    20: ('control/mA', '<f4'),
+    23: ('dQ/mA.h', '<f8'),
+    24: ('cycle number', '<f8'),
+    26: ('Rapp/Ohm', '<f4'),
+    32: ('freq/Hz', '<f4'),
+    33: ('|Ewe|/V', '<f4'),
+    34: ('|I|/A', '<f4'),
+    35: ('Phase(Z)/deg', '<f4'),
+    36: ('|Z|/Ohm', '<f4'),
+    37: ('Re(Z)/Ohm', '<f4'),
+    38: ('-Im(Z)/Ohm', '<f4'),
+    39: ('I Range', '<u2'),
+    69: ('R/Ohm', '<f4'),
+    70: ('P/W', '<f4'),
+    74: ('Energy/W.h', '<f8'),
+    75: ('Analog OUT/V', '<f4'),
+    76: ('<I>/mA', '<f4'),
+    77: ('<Ewe>/V', '<f4'),
+    78: ('Cs-2/µF-2', '<f4'),
+    96: ('|Ece|/V', '<f4'),
+    98: ('Phase(Zce)/deg', '<f4'),
+    99: ('|Zce|/Ohm', '<f4'),
+    100: ('Re(Zce)/Ohm', '<f4'),
+    101: ('-Im(Zce)/Ohm', '<f4'),
+    123: ('Energy charge/W.h', '<f8'),
+    124: ('Energy discharge/W.h', '<f8'),
+    125: ('Capacitance charge/µF', '<f8'),
+    126: ('Capacitance discharge/µF', '<f8'),
+    131: ('Ns', '<u2'),
+    163: ('|Estack|/V', '<f4'),
+    168: ('Rcmp/Ohm', '<f4'),
+    169: ('Cs/µF', '<f4'),
+    172: ('Cp/µF', '<f4'),
+    173: ('Cp-2/µF-2', '<f4'),
+    174: ('<Ewe>/V', '<f4'),
+    434: ('(Q-Qo)/C', '<f4'),
+    435: ('dQ/C', '<f4'),
+    467: ('Q charge/discharge/mA.h', '<f8'),
+    468: ('half cycle', '<u4'),
+    469: ('z cycle', '<u4'),
+}
+
+def read_mpr_modules(buffer):
+    """Splits the contents of a .mpr file (bytes or a memory map) into its modules ('VMP Set', 'VMP data', 'VMP LOG', ...). Returns a list of dicts with the module header fields, 'offset' and 'data' (a memoryview of the module, not a copy)."""
+    if bytes(buffer[:len(mpr_magic)]) != mpr_magic:
+        raise ValueError('Not a Bio-Logic .mpr file')
+    view = memoryview(buffer)
+    offset = len(mpr_magic)
+    modules = []
+    while offset < len(view):
+        if bytes(view[offset:offset + 6]) != b'MODULE':
+            raise ValueError('Expected a module at byte {0}'.format(offset))
+        offset += 6
+        header = np.frombuffer(view, mpr_module_header, count=1, offset=offset)[0]
+        if header['length'] == 0xFFFFFFFF:
+            header = np.frombuffer(view, mpr_module_header_v2, count=1, offset=offset)[0]
+        offset += header.dtype.itemsize
+        module = dict((name, header[name]) for name in ('shortname', 'longname', 'length', 'version', 'date'))
+        module['shortname'] = module['shortname'].decode('latin-1').strip()
+        module['longname'] = module['longname'].decode('latin-1').strip()
+        module['date'] = module['date'].decode('latin-1')
+        module['offset'] = offset
+        module['data'] = view[offset:offset + int(header['length'])]
+        modules.append(module)
+        offset += int(header['length'])
+    return modules
+
+def mpr_dtype(column_ids):
+    """Returns the structured dtype of one row of the data module and a list of (name, mask) of the flag columns, from the column IDs. Columns named twice get a numbered suffix."""
+    fields = []
+    flags = []
+    for column_id in column_ids:
+        if column_id in mpr_flags:
+            if 'flags' not in [name for name, dtype in fields]:
+                fields.append(('flags', 'u1'))
+            flags.append(mpr_flags[column_id])
+        elif column_id in mpr_columns:
+            name, dtype = mpr_columns[column_id]
+            names = [field for field, t in fields]
+            if name in names:
+                name = '{0} {1}'.format(name, names.count(name) + 1)
+            fields.append((name, dtype))
+        else:
+            raise ValueError('Column ID {0} of the data module is not known'.format(column_id))
+    return np.dtype(fields), flags
+
+def _pascal_string(data, offset):
+    """Internal function. Reads a string stored as a length byte followed by the characters."""
+    length = data[offset]
+    return bytes(data[offset + 1:offset + 1 + length]).decode('latin-1')
+
+def _mpr_settings(data):
+    """Internal function. Reads comments, active material and electrolyte from the settings module (best effort). Returns a dict of header attributes, empty if they do not look right."""
+    try:
+        comments = _pascal_string(data, 0x0001)
+        mass, x0, mol_weight = np.frombuffer(data, '<f4', count=3, offset=0x0107)
+        material = _pascal_string(data, 0x011D)
+        electrolyte = _pascal_string(data, 0x01C0)
+        area = np.frombuffer(data, '<f4', count=1, offset=0x0211)[0]
+    except (IndexError, ValueError):
+        return {}
+    if not all(np.isfinite([mass, mol_weight, area])) or not all(text.isprintable() for text in [comments, material, electrolyte]):
+        return {}
+    return {
+        'comments': [comments] if comments else [],
+        'mass_am': '{0:.3f} mg'.format(mass),
+        'mol_weight': '{0:.3f} g/mol'.format(mol_weight),
+        'material': material,
+        'electrolyte': electrolyte,
+        'surface_area': '{0:.3f} cm²'.format(area),
+    }
+
+def read_mpr_header(filename, buffer=None):
+    """Reads the header attributes of a .mpr file (the same keys as read_mpt_header) from its settings and LOG modules without decoding the data. The file is memory mapped unless its contents are given as buffer, so only the pages holding the module headers are read.
+
+    Returns a dict of the header attributes of MPTFile and 'modules' (see read_mpr_modules, keyed by shortname)."""
+    if buffer is None:
+        buffer = np.memmap(filename, dtype='u1', mode='r')
+    modules = dict((module['shortname'], module) for module in read_mpr_modules(buffer))
+    header = dict((attribute, "") for key, attribute in header_keys)
+    header['comments'] = []
+    if 'VMP data' in modules:
+        header['date'] = modules['VMP data']['date']
+    if 'VMP Set' in modules:
+        header.update(_mpr_settings(modules['VMP Set']['data']))
+    log = modules.get('VMP LOG', {}).get('data', b'')
+    # Channel number, best effort
+    if len(log) > 9 and 0 < log[9] < 255:
+        header['channel'] = str(log[9])
+    header['modules'] = modules
+    return header
+
+class MPRFile(MPTFile):
+    """Loads data from a binary .mpr file written by EC-Lab, without exporting it to .mpt text first. The data module is decoded with a structured numpy dtype straight from the file buffer; the columns and header attributes have the same names as in MPTFile, so every MPTFile method works on it.
+
+    Header attributes come from the settings module at offsets that are not documented by Bio-Logic; they are read on a best effort basis and left empty if they do not look right. The channel is read from the LOG module.
+
+    Arguments
+    ---------
+    filename : str
+        Name of the file you wish to import.
+    shortname : str
+        The name used in legend plotting and other identifying information.
+    """
+
+    def __init__(self, filename, shortname=""):
+        self.filename = filename
+        self.shortname = shortname
+        self.header = []
+        self.skip_line = 0
+        with open(filename, 'rb') as file:
+            buffer = file.read()
+        header = read_mpr_header(filename, buffer)
+        for key, attribute in header_keys:
+            setattr(self, attribute, header[attribute])
+        self.modules = header['modules']
+        self.dataframe = self._read_data(self.modules['VMP data'])
+        self.column_list = [self.dataframe.index.name] + list(self.dataframe.columns)
+        self._cycle_indexes = {}
+
+    def _read_data(self, module):
+        """Internal function. Decodes the data module into a DataFrame indexed by mode (like the first column of .mpt files)."""
+        data = module['data']
+        rows = int(np.frombuffer(data, '<u4', count=1)[0])
+        n_columns = data[4]
+        if module['version'] == 0:
+            column_ids = np.frombuffer(data, 'u1', count=n_columns, offset=5)
+            start = 100
+        elif module['version'] in (2, 3):
+            column_ids = np.frombuffer(data, '<u2', count=n_columns, offset=5)
+            start = 405 if module['version'] == 2 else 406
+        else:
+            raise ValueError('Version {0} of the data module is not known'.format(module['version']))
+        dtype, flags = mpr_dtype(column_ids)
+        records = np.frombuffer(data, dtype, count=rows, offset=start)
+        columns = {}
+        for name, mask in flags:
+            # Shift each flag down to its lowest bit
+            shift = (mask & -mask).bit_length() - 1
+            columns[name] = (records['flags'] & mask) >> shift
+        for name in dtype.names:
+            if name != 'flags':
+                columns[name] = records[name]
+        dataframe = pd.DataFrame(columns)
+        return dataframe.set_index('mode') if 'mode' in columns else dataframe
+
+
+# Many cells
+fleet_columns = ['filename', 'channel', 'material', 'mass_am', 'electrolyte', 'date', 'device', 'initial_state', 'comments']
+
+def read_header(filename):
+    """Reads the header attributes of an EC-Lab .mpt or .mpr file (see read_mpt_header and read_mpr_header)."""
+    if filename.lower().endswith('.mpr'):
+        header = read_mpr_header(filename)
+        del header['modules']               # Releases the memory map
+        return header
+    return read_mpt_header(filename)
+
+class CellFleet(object):
+    """Index of a directory of EC-Lab files, one file per cell (e.g. one .mpt per channel). The headers are read in parallel into a table; the data of a cell is only read when it is first used, and then kept.
+
+    Arguments
+    ---------
+    directory : str
+        Folder holding the files.
+    pattern : str
+        glob pattern of the files in the folder, .mpt and .mpr files by default.
+    threads : int
+        number of files read at the same time. Threads rather than processes are used: the cells are kept in this process (.mpr cells hold memory views of their file, which cannot be sent between processes), reading headers is mostly waiting on the disk, and the C parser of pandas and numpy release the GIL for most of the data parsing.
+    **options
+        passed to MPTFile when reading .mpt files (usecols, downcast, chunksize, cache).
+
+    Cells are named by their file name without extension. The index attribute is a DataFrame with one row per cell: filename, channel, material, mass_am, electrolyte, date (as a Timestamp), device, initial_state, comments and mass/mg.
+    """
+
+    def __init__(self, directory, pattern='*.mp[rt]', threads=8, **options):
+        self.directory = directory
+        self.threads = threads
+        self.options = options
+        filenames = sorted(glob.glob(os.path.join(directory, pattern)))
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            headers = list(pool.map(read_header, filenames))
+        names = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+        rows = []
+        for filename, header in zip(filenames, headers):
+            row = dict(header, filename=filename, comments='; '.join(line.strip() for line in header['comments']))
+            rows.append([row[column] for column in fleet_columns])
+        self.index = pd.DataFrame(rows, index=pd.Index(names, name='cell'), columns=fleet_columns)
+        self.index['date'] = [pd.to_datetime(date, errors='coerce') for date in self.index['date']]
+        self.index['mass/mg'] = [_mass_mg(mass) for mass in self.index['mass_am']]
+        self._cells = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.index)
+
+    def __getitem__(self, name):
+        """Returns the MPTFile (or MPRFile) of a cell, reading its data the first time."""
+        if name not in self._cells:
+            filename = self.index.loc[name, 'filename']
+            if filename.lower().endswith('.mpr'):
+                self._cells[name] = MPRFile(filename, name)
+            else:
+                self._cells[name] = MPTFile(filename, name, **self.options)
+        return self._cells[name]
+
+    def select(self, **criteria):
+        """Returns the names of the cells whose index columns equal the given values, e.g. select(material='NMC', electrolyte='LP30'). A list of values matches any of them."""
+        keep = np.ones(len(self.index), dtype=bool)
+        for column, value in criteria.items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            keep &= self.index[column].isin(values).values
+        return self.index.index[keep].tolist()
+
+    def load(self, cells=None):
+        """Reads the data of the given cells (all by default) in parallel. Returns the list of cell objects."""
+        cells = list(self.index.index) if cells is None else list(cells)
+        todo = [name for name in cells if name not in self._cells]
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(self.__getitem__, todo))
+        return [self._cells[name] for name in cells]
+
+    def cycle_summary(self, cells=None, mass=None):
+        """Cycle summaries of the given cells (all by default) as one DataFrame indexed by (cell, cycle), see cycle_summaries. The 'Mass of active material' of each header is used unless mass (a dict of cell -> mg) is given."""
+        return cycle_summaries(self.load(cells), mass=mass)
+
+    def at_cycle(self, cycle, column='Q discharge/mA.h', cells=None, mass=None):
+        """Returns a column of the cycle summaries at one cycle for every cell, as a Series indexed by cell (NaN for cells that did not reach that cycle). A list of cycles gives a DataFrame with one column per cycle."""
+        summary = self.cycle_summary(cells, mass=mass)[column].unstack('cycle')
+        names = list(self.index.index) if cells is None else list(cells)
+        table = summary.reindex(index=names, columns=np.atleast_1d(cycle))
+        return table[cycle] if np.ndim(cycle) == 0 else table
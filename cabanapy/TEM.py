@@ -6,97 +6,548 @@ import zipfile
 import numpy as np, pandas as pd, matplotlib.pyplot as plt, dm3_lib as dm3
 from matplotlib.colors import Normalize
 import matplotlib.patches as patches
-from scipy import interpolate
+from scipy import interpolate, signal, ndimage
+import collections, weakref, glob, fnmatch, json, html
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+from dm_filereader import DMReader
+import general
 
 
 #Adapted from the dm3_lib package by Greg Jefferis from https://bitbucket.org/piraynal/pydm3reader/get/b7500989b83a.zip
 class DM3File(object):
-    """With help from the dm3_lib package, this object allows plotting of TEM images with appropriate nm scale"""
+    """With help from the dm3_lib package, this object allows plotting of TEM images with appropriate nm scale.
+
+    The file is parsed once, on first use or explicitly with open(), and the parsed tags are kept until close(). Image data is decoded the first time it is needed and then retained. DM3File.memory_budget (bytes, shared by all DM3File objects) evicts the pixel data of the least recently used images once exceeded. DM3File also works as a context manager:
+
+        with tem.DM3File("./path/to/dm3file") as image:
+            image.plot()
+
+    With mmap=True the tag tree is parsed by dm_filereader.DMReader instead, which also reads DM4 files, and imagedata is a read-only numpy.memmap view of the file so that cropping, binning or taking a histogram of a region never loads the whole image.
+    """
     filename = ""
     shortname = ""
     image = ""
+    memory_budget = None
+    _retained = collections.OrderedDict()       # id -> weakref of objects holding pixel data, least recently used first
     
-    def __init__(self, filename, shortname=""):
+    def __init__(self, filename, shortname="", mmap=False):
         self.filename = filename
         self.shortname = shortname
-    
+        self.mmap = mmap
+        self._dm3 = None
+        self._imagedata = None
+
+    def open(self):
+        """Parses the file tags once. Further property access reuses the parsed reader until close() is called."""
+        if self._dm3 is None:
+            self._dm3 = DMReader(self.filename) if self.mmap else dm3.DM3(self.filename)
+        return self
+
+    def close(self):
+        """Releases the parsed tags and any retained image data."""
+        self._dm3 = None
+        self.evict()
+
+    def evict(self):
+        """Drops the retained image data. It is decoded again on next access."""
+        self._imagedata = None
+        DM3File._retained.pop(id(self), None)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def reader(self):
+        """Returns the parsed dm3_lib.DM3 (or dm_filereader.DMReader with mmap=True) reader, opening the file if needed."""
+        return self.open()._dm3
+
+    def _retain(self, data):
+        """Internal function. Keeps data as the image data of this object and evicts least recently used image data beyond memory_budget."""
+        self._imagedata = data
+        retained = DM3File._retained
+        retained.pop(id(self), None)
+        retained[id(self)] = weakref.ref(self)
+        total = 0
+        for key, ref in reversed(list(retained.items())):
+            other = ref()
+            if other is None or other._imagedata is None:
+                retained.pop(key)
+                continue
+            total += other._imagedata.nbytes
+            if self.memory_budget is not None and total > self.memory_budget and other is not self:
+                other.evict()
+
     @property
     def outputcharset(self):
-        return dm3.DM3(self.filename).outputcharset
+        return self.reader.outputcharset
 
     @property
     def tags(self):
         """Returns all image Tags."""
-        return dm3.DM3(self.filename).tags
+        return self.reader.tags
 
     @property
     def info(self):
-        return dm3.DM3(self.filename).info
+        return self.reader.info
 
 
     @property
     def thumbnail(self):
         """Returns thumbnail as PIL Image."""
-        return dm3.DM3(self.filename).thumbnail
+        if self.mmap:
+            return _pil_image(self.thumbnaildata)
+        return self.reader.thumbnail
 
     @property
     def thumbnaildata(self):
         """Returns thumbnail data as numpy.array"""
-        return dm3.DM3(self.filename).thumbnaildata
+        if self.mmap:
+            return self.reader.imagedata(0)
+        return self.reader.thumbnaildata
 
     def makePNGThumbnail(self, tn_file=''):
         """Save thumbnail as PNG file."""
-        return dm3.DM3(self.filename).makePNGThumbnail(tn_file=tn_file)
+        if self.mmap:
+            if not tn_file:
+                tn_file = os.path.splitext(self.filename)[0] + '.tn.png'
+            self.thumbnail.save(tn_file, 'png')
+            return tn_file
+        return self.reader.makePNGThumbnail(tn_file=tn_file)
 
 
     @property
     def image(self):
         """Extracts image data as PIL Image"""
-        return dm3.DM3(self.filename).image
+        if self.mmap:
+            return _pil_image(self.imagedata)
+        return self.reader.image
 
     @property
     def imagedata(self):
-        """Extracts image data as numpy.array"""
-        return dm3.DM3(self.filename).imagedata
+        """Extracts image data as numpy.array (a read-only numpy.memmap with mmap=True). Decoded on first access and retained."""
+        if self.mmap:
+            if self._imagedata is None:
+                self._imagedata = self.reader.imagedata()
+            return self._imagedata
+        if self._imagedata is None:
+            self._retain(self.reader.imagedata)
+        elif id(self) in DM3File._retained:
+            DM3File._retained.move_to_end(id(self))
+        return self._imagedata
 
     @property
     def contrastlimits(self):
         """Returns display range (cuts)."""
-        return dm3.DM3(self.filename).contrastlimits
+        return self.reader.contrastlimits
 
     @property
     def cuts(self):
         """Returns display range (cuts)."""
-        return dm3.DM3(self.filename).cuts
+        return self.reader.cuts
 
 
     @property
     def pxsize(self):
         """Returns pixel size and unit."""
-        return dm3.DM3(self.filename).pxsize
+        return self.reader.pxsize
+
+    def display_range(self, cutoff=.1, **kwargs):
+        """Computes the display range (cuts) from the image data. See display_range for the keyword arguments."""
+        return display_range(self.imagedata, cutoff=cutoff, **kwargs)
+
+    def display_limits(self, cutoff=.1, imdata=None):
+        """Returns the display range used by plot and batch_process: the contrast limits saved in the file or, if there are none or they are equal, the cuts of display_range on imdata (the image data by default)."""
+        limits = self.contrastlimits
+        if not limits or limits[0] == limits[1]:
+            limits = display_range(self.imagedata if imdata is None else imdata, cutoff=cutoff)
+        return limits
         
-    def plot(self, cmap="gray", scale_bar="", sb_loc = "bl", sb_color = "w", *args, **kwargs):
+    def pyramid(self, tile_size=512):
+        """Returns the ImagePyramid of the image data, cached in a '.pyramid' folder next to the file."""
+        data = self.imagedata
+        while data.ndim > 2:
+            data = data[0]
+        return ImagePyramid(data, cache_dir=self.filename + '.pyramid', source=self.filename, tile_size=tile_size)
+
+    def plot(self, cmap="gray", scale_bar="", sb_loc = "bl", sb_color = "w", *args, pyramid=False, **kwargs):
         """Plots the DM3 object as a plt.
 
-        scale_bar argument accepts integer (in nanometers) e.g. scale_bar = 20 will add a white rectangle to the bottom left of the image that is 20nm wide"""
+        scale_bar argument accepts integer (in nanometers) e.g. scale_bar = 20 will add a white rectangle to the bottom left of the image that is 20nm wide
+
+        pyramid=True renders from an ImagePyramid instead of the full image: only the tiles in view are drawn, at the resolution matching the size of the axes, and zooming or panning redraws the view."""
         ax=plt.gca()
-        axis_size = 2048*self.pxsize[0]
-        ax.imshow(self.imagedata, cmap=cmap, extent=[0, axis_size, axis_size, 0], norm=Normalize(self.contrastlimits[0],self.contrastlimits[1]), *args, **kwargs)
+        pxsize = self.pxsize
+        contrastlimits = self.display_limits()
+        norm = Normalize(contrastlimits[0],contrastlimits[1])
+        # Physical size from the real image shape
+        shape = self.imagedata.shape[-2:]
+        width, height = shape[1]*pxsize[0], shape[0]*pxsize[0]
+        if pyramid:
+            self.pyramid().show(ax, extent=[0, width, height, 0], cmap=cmap, norm=norm, *args, **kwargs)
+        else:
+            ax.imshow(self.imagedata, cmap=cmap, extent=[0, width, height, 0], norm=norm, *args, **kwargs)
 #           scale bar location dict
         if scale_bar:
             loc = {
-                'bl': [axis_size*.05, axis_size*.90],
-                'br': [(axis_size*.95)-scale_bar, axis_size*.90],
-                'tr': [(axis_size*.95)-scale_bar, axis_size*.05],
-                'tl': [axis_size*.05, axis_size*.05]
+                'bl': [width*.05, height*.90],
+                'br': [(width*.95)-scale_bar, height*.90],
+                'tr': [(width*.95)-scale_bar, height*.05],
+                'tl': [width*.05, height*.05]
             }
             add_scale_bar = patches.Rectangle((50, 50), scale_bar, 5, linewidth=1, edgecolor=sb_color, facecolor=sb_color)
-            add_scale_bar.set_bounds(loc[sb_loc][0],loc[sb_loc][1], scale_bar, axis_size*0.05)
+            add_scale_bar.set_bounds(loc[sb_loc][0],loc[sb_loc][1], scale_bar, height*0.05)
             ax.add_patch(add_scale_bar)
-        ax.set_ylabel(self.pxsize[1].decode('ascii'), fontsize=10)
+        ax.set_ylabel(pxsize[1].decode('ascii'), fontsize=10)
         plt.subplots_adjust(hspace=0, wspace=0)
 
 
+def _pil_image(data):
+    """Returns a 2D numpy.array scaled to 8 bits as a PIL Image."""
+    data = np.asarray(data, dtype=float)
+    low, high = data.min(), data.max()
+    return Image.fromarray(((data - low)*(255/((high - low) or 1))).astype(np.uint8))
+
+
+# Image pyramids
+class ImagePyramid(object):
+    """Multi-resolution pyramid of a 2D image for viewing large micrographs.
+
+    Level 0 is the image itself; every further level is the 2x2 block mean of the previous one, down to the first level that fits in one tile. Levels are built a band of rows at a time so a memory-mapped image is never read whole, and with cache_dir they are written there as float32 .npy files that are memory-mapped on later use. The cache is rebuilt when the size or modification time of source changes.
+
+    Arguments
+    ---------
+    data : numpy.array
+        2D image (a numpy.memmap works best for large images)
+    cache_dir : str
+        folder for the pyramid levels. None keeps the levels in memory
+    source : str
+        file the image was read from, used to validate the cache
+    tile_size : int
+        regions are read in blocks of tile_size x tile_size pixels of a level
+    """
+
+    def __init__(self, data, cache_dir=None, source=None, tile_size=512):
+        self.tile_size = tile_size
+        self.cache_dir = cache_dir
+        self.levels = [data]
+        self._image = None
+        stamp = {'shape': list(data.shape), 'dtype': str(data.dtype), 'tile_size': tile_size}
+        if source is not None:
+            stat = os.stat(source)
+            stamp.update({'source': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime})
+        if cache_dir is not None and self._load(stamp):
+            return
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        while max(self.levels[-1].shape) > tile_size:
+            self.levels.append(self._downsample(self.levels[-1], len(self.levels)))
+        if cache_dir is not None:
+            with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+                json.dump(dict(stamp, levels=len(self.levels)), f)
+
+    def _level_file(self, level):
+        return os.path.join(self.cache_dir, 'level{0}.npy'.format(level))
+
+    def _load(self, stamp):
+        """Internal function. Memory-maps the cached levels if the cache matches stamp."""
+        try:
+            with open(os.path.join(self.cache_dir, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if {key: meta.get(key) for key in stamp} != stamp:
+            return False
+        self.levels += [np.load(self._level_file(level), mmap_mode='r') for level in range(1, meta['levels'])]
+        return True
+
+    def _downsample(self, data, level):
+        """Internal function. Returns the 2x2 block mean of data, an odd last row or column is averaged with itself."""
+        h, w = data.shape
+        shape = ((h + 1)//2, (w + 1)//2)
+        if self.cache_dir is None:
+            out = np.empty(shape, dtype=np.float32)
+        else:
+            out = np.lib.format.open_memmap(self._level_file(level), mode='w+', dtype=np.float32, shape=shape)
+        band = 2*self.tile_size
+        for start in range(0, h, band):
+            block = np.asarray(data[start:start + band], dtype=np.float32)
+            if block.shape[0] % 2:
+                block = np.concatenate((block, block[-1:]), axis=0)
+            if w % 2:
+                block = np.concatenate((block, block[:, -1:]), axis=1)
+            out[start//2:(start + len(block))//2] = block.reshape(len(block)//2, 2, -1, 2).mean(axis=(1, 3))
+        if isinstance(out, np.memmap):
+            out.flush()
+            out = np.load(self._level_file(level), mmap_mode='r')
+        return out
+
+    @property
+    def shape(self):
+        """Shape of the full resolution image."""
+        return self.levels[0].shape
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level_for(self, step):
+        """Returns the coarsest level with at least one pixel per screen pixel, for step image pixels per screen pixel."""
+        if step <= 1:
+            return 0
+        return int(min(np.floor(np.log2(step)), len(self.levels) - 1))
+
+    def region(self, x0, x1, y0, y1, level=0):
+        """Returns the tiles of a level covering columns x0:x1 and rows y0:y1 (in full resolution pixels) and their extent (left, right, bottom, top) in full resolution pixels."""
+        data = self.levels[level]
+        factor, tile = 2**level, self.tile_size
+        h, w = data.shape
+        c0 = min(max(int(x0//factor)//tile*tile, 0), w)
+        c1 = min(max(-(-int(np.ceil(x1/factor))//tile)*tile, c0 + 1), w)
+        r0 = min(max(int(y0//factor)//tile*tile, 0), h)
+        r1 = min(max(-(-int(np.ceil(y1/factor))//tile)*tile, r0 + 1), h)
+        H, W = self.shape
+        extent = [c0*factor, min(c1*factor, W), min(r1*factor, H), r0*factor]
+        return data[r0:r1, c0:c1], extent
+
+    def show(self, ax=None, extent=None, **kwargs):
+        """Draws the part of the image in view at the resolution of the axes, and redraws it when the axes limits change. Keyword arguments are passed to imshow.
+
+        extent (left, right, bottom, top) places the image in data coordinates, [0, width, height, 0] in pixels by default. Returns the AxesImage."""
+        ax = ax or plt.gca()
+        H, W = self.shape
+        self._extent = extent or [0, W, H, 0]
+        self._ax = ax
+        data, region = self.region(0, W, 0, H, len(self.levels) - 1)
+        self._image = ax.imshow(data, extent=self._transform(region), **kwargs)
+        self._image.pyramid = self              # the axes callbacks only hold weak references
+        ax.set_xlim(self._extent[0], self._extent[1])
+        ax.set_ylim(self._extent[2], self._extent[3])
+        ax.set_autoscale_on(False)
+        self._view = None
+        self.update()
+        ax.callbacks.connect('xlim_changed', self.update)
+        ax.callbacks.connect('ylim_changed', self.update)
+        return self._image
+
+    def _transform(self, region):
+        """Internal function. Converts an extent in pixels to data coordinates."""
+        left, right, bottom, top = self._extent
+        sx, sy = (right - left)/float(self.shape[1]), (bottom - top)/float(self.shape[0])
+        return [left + region[0]*sx, left + region[1]*sx, top + region[2]*sy, top + region[3]*sy]
+
+    def update(self, ax=None):
+        """Replaces the displayed image with the tiles in view at the matching level. Connected to the axes limits by show."""
+        ax = self._ax
+        left, right, bottom, top = self._extent
+        H, W = self.shape
+        sx, sy = (right - left)/float(W), (bottom - top)/float(H)
+        xs = sorted((np.array(ax.get_xlim()) - left)/sx)
+        ys = sorted((np.array(ax.get_ylim()) - top)/sy)
+        # Width before the aspect is applied, which happens only when drawing
+        width = max(ax.get_position(original=True).width*ax.figure.bbox.width, 1)
+        level = self.level_for((xs[1] - xs[0])/width)
+        data, region = self.region(xs[0], xs[1], ys[0], ys[1], level)
+        view = (level, tuple(region))
+        if view == self._view:
+            return
+        self._view = view
+        self._image.set_data(data)
+        self._image.set_extent(self._transform(region))
+        ax.figure.canvas.draw_idle()
+
+
+# Display range (cuts)
+def _subsample(imdata, max_pixels):
+    """Returns a strided view of the last two axes holding at most about max_pixels pixels per image."""
+    if max_pixels is None:
+        return imdata
+    step = max(int(np.ceil(np.sqrt(imdata.shape[-2]*imdata.shape[-1]/float(max_pixels)))), 1)
+    return imdata[..., ::step, ::step]
+
+def display_range(imdata, cutoff=.1, bins=512, method='histogram', max_pixels=2**20):
+    """Computes the display range (cuts) ignoring the 'cutoff' percent lowest and highest value pixels.
+
+    Arguments
+    ---------
+    imdata : numpy.array
+        an image, or a stack of images along the first axis. numpy.memmap views only have the subsampled pixels read
+    cutoff : float
+        percent of pixels ignored at each end
+    bins : int
+        number of histogram bins for method='histogram'
+    method : str
+        'histogram' finds the cuts on the cumulative histogram with searchsorted (the bins and searchsorted of calcDisplayRange in dm3_lib/demo/utilities.py, so the cuts are close to its results, but they are not rounded to integers); 'partition' returns the exact order statistics with numpy.partition
+    max_pixels : int
+        images are subsampled with a regular stride to at most this many pixels. None uses every pixel
+
+    Returns (low, high) for a single image or an array of shape (n_images, 2) for a stack.
+    """
+    imdata = np.asarray(_subsample(imdata, max_pixels))
+    single = imdata.ndim <= 2
+    values = imdata.reshape(1 if single else imdata.shape[0], -1)
+    n = values.shape[1]
+    if method == 'partition':
+        k = min(int(n*cutoff/100.), n - 1)
+        cuts = np.partition(values, [k, n - 1 - k], axis=1)[:, [k, n - 1 - k]].astype(float)
+    elif method == 'histogram':
+        low = values.min(axis=1).astype(float)
+        high = values.max(axis=1).astype(float)
+        width = (high - low)/bins
+        width[width == 0] = 1
+        index = np.clip(((values - low[:, np.newaxis])/width[:, np.newaxis]).astype(int), 0, bins - 1)
+        # One bincount for the whole stack
+        hh = np.bincount((index + bins*np.arange(len(values))[:, np.newaxis]).ravel(), minlength=bins*len(values)).reshape(len(values), bins)
+        threshold = n*cutoff/100.
+        i = np.minimum((np.cumsum(hh, axis=1) < threshold).sum(axis=1) + 1, bins - 1)
+        j = np.minimum((np.cumsum(hh[:, ::-1], axis=1) < threshold).sum(axis=1) + 1, bins)
+        edges = low[:, np.newaxis] + width[:, np.newaxis]*np.arange(bins)
+        rows = np.arange(len(values))
+        cuts = np.column_stack((edges[rows, i], edges[rows, bins - j]))
+    else:
+        raise ValueError("method must be 'histogram' or 'partition'")
+    if single:
+        return float(cuts[0, 0]), float(cuts[0, 1])
+    return cuts
+
+
+# Batch processing of micrograph directories
+def _bin_image(data, factor):
+    """Returns data downsampled by an integer factor with a block mean (edges that do not fill a block are dropped)."""
+    if factor <= 1:
+        return np.asarray(data, dtype=float)
+    h, w = data.shape[0]//factor*factor, data.shape[1]//factor*factor
+    return np.asarray(data[:h, :w], dtype=float).reshape(h//factor, factor, w//factor, factor).mean(axis=(1, 3))
+
+def _scale_bar_length(width):
+    """Returns a round (1, 2 or 5 x 10^n) scale bar length close to a fifth of width."""
+    target = width/5.
+    magnitude = 10**np.floor(np.log10(target))
+    for step in [5, 2, 1]:
+        if step*magnitude <= target:
+            return step*magnitude
+    return magnitude
+
+def _process_micrograph(filename, output_dir, thumbnail_size=256, preview_size=1024, cutoff=0.1, cmap='gray'):
+    """Computes cuts and writes a PNG thumbnail and a preview with a calibrated scale bar for one file. Used by batch_process."""
+    stat = os.stat(filename)
+    name = os.path.basename(filename)
+    with DM3File(filename, mmap=True) as micrograph:
+        data = micrograph.imagedata
+        while data.ndim > 2:                    # first frame of stacks and spectrum images
+            data = data[0]
+        scale, units = micrograph.pxsize
+        units = units.decode('latin-1')
+        factor = int(np.ceil(max(data.shape)/float(preview_size)))
+        preview = _bin_image(data, factor)
+        cuts = micrograph.display_limits(cutoff, data)
+        scaled = np.clip((preview - cuts[0])/((cuts[1] - cuts[0]) or 1), 0, 1)
+        # Thumbnail
+        thumbnail = Image.fromarray((scaled*255).astype(np.uint8))
+        thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+        thumbnail_file = os.path.join(output_dir, name + '.thumbnail.png')
+        thumbnail.save(thumbnail_file)
+        # Preview with scale bar
+        height, width = data.shape[0]*scale, data.shape[1]*scale
+        fig = Figure(figsize=(6, 6*height/width))
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.imshow(scaled, cmap=cmap, extent=[0, width, height, 0], vmin=0, vmax=1)
+        ax.set_axis_off()
+        length = _scale_bar_length(width)
+        ax.add_patch(patches.Rectangle((width*.05, height*.92), length, height*.02, edgecolor='w', facecolor='w'))
+        ax.text(width*.05 + length/2, height*.9, '{0:g} {1}'.format(length, units), color='w', horizontalalignment='center', verticalalignment='bottom')
+        preview_file = os.path.join(output_dir, name + '.preview.png')
+        fig.savefig(preview_file, dpi=preview_size/6.)
+        return {
+            'filename': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'shape': list(data.shape),
+            'pxsize': float(scale),
+            'units': units,
+            'cuts': [float(cuts[0]), float(cuts[1])],
+            'thumbnail': os.path.basename(thumbnail_file),
+            'preview': os.path.basename(preview_file),
+        }
+
+def _write_contact_sheet(results, output_dir):
+    """Writes index.html with a grid of thumbnails linking to the previews."""
+    cells = []
+    for result in results:
+        caption = '{0}<br>{1} x {2} px, {3:.3g} {4}/px<br>cuts {5:.4g} - {6:.4g}'.format(
+            html.escape(os.path.basename(result['filename'])), result['shape'][1], result['shape'][0],
+            result['pxsize'], html.escape(result['units']), result['cuts'][0], result['cuts'][1])
+        cells.append('<figure><a href="{0}"><img src="{1}"></a><figcaption>{2}</figcaption></figure>'.format(
+            html.escape(result['preview']), html.escape(result['thumbnail']), caption))
+    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Contact sheet</title>'
+                '<style>body{font-family:sans-serif}figure{display:inline-block;margin:8px;vertical-align:top;font-size:small}</style></head>\n<body>\n')
+        f.write('\n'.join(cells))
+        f.write('\n</body></html>\n')
+
+def batch_process(directory, output_dir=None, pattern='*.dm[34]', processes=None, thumbnail_size=256, preview_size=1024, cutoff=0.1, cmap='gray'):
+    """Processes every DM3/DM4 file in a directory with a process pool: display cuts, a PNG thumbnail and a downsampled preview with a calibrated scale bar per file, and an index.html contact sheet. Results are cached in index.json so reruns skip files that have not changed.
+
+    Arguments
+    ---------
+    directory : str
+        directory containing the micrographs
+    output_dir : str
+        where images, index.json and index.html are written. Defaults to a 'batch' folder inside directory
+    pattern : str
+        glob pattern of the file names to process, matched without regard to case
+    processes : int
+        number of worker processes. Defaults to the number of CPUs; 1 processes files in this process
+    thumbnail_size : int
+        largest side of the thumbnails in pixels
+    preview_size : int
+        approximate largest side of the previews in pixels
+    cutoff : float
+        percent of lowest and highest pixels ignored by the cuts when the file has no display range
+
+    Returns a pandas.DataFrame with one row per file.
+    """
+    if output_dir is None:
+        output_dir = os.path.join(directory, 'batch')
+    os.makedirs(output_dir, exist_ok=True)
+    cache_file = os.path.join(output_dir, 'index.json')
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    # Acquisition PCs often write .DM3/.DM4, so the pattern is matched without regard to case
+    filenames = sorted(os.path.abspath(os.path.join(directory, f)) for f in os.listdir(directory)
+                       if fnmatch.fnmatch(f.lower(), pattern.lower()) and os.path.isfile(os.path.join(directory, f)))
+    results, todo = {}, []
+    for filename in filenames:
+        stat = os.stat(filename)
+        cached = cache.get(filename)
+        if (cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime
+                and all(os.path.exists(os.path.join(output_dir, cached[key])) for key in ['thumbnail', 'preview'])):
+            results[filename] = cached
+        else:
+            todo.append(filename)
+    options = dict(thumbnail_size=thumbnail_size, preview_size=preview_size, cutoff=cutoff, cmap=cmap)
+    if todo and processes == 1:
+        for filename in todo:
+            results[filename] = _process_micrograph(filename, output_dir, **options)
+    elif todo:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {filename: pool.submit(_process_micrograph, filename, output_dir, **options) for filename in todo}
+            for filename, future in futures.items():
+                results[filename] = future.result()
+    results = [results[filename] for filename in filenames]
+    with open(cache_file, 'w') as f:
+        json.dump({result['filename']: result for result in results}, f, indent=1)
+    _write_contact_sheet(results, output_dir)
+    return pd.DataFrame(results)
+
+
 # EDX Data Classes
 class VantageEmsaFile(object):
     """Vantage Emsa File class opens .emsa files created from VANTAGE 2.4 program used in conjunction with the JEOL 3010 EDX data collection
@@ -114,35 +565,14 @@ class VantageEmsaFile(object):
         self.filename = filename
         self.shortname = shortname
 
-        self.metadata = {}      # Empty the metadata
-            
-        # open the file and read its contents
-        file = open(self.filename, 'r')
-        i=0
-        p=[]
-        r=[]
-        for line in file:
-            if '#' in line:
-                i+=1
-                # Assign files metadata to a string
-                (key, val) = line.split(':', 1)
-                key=''.join(c for c in key if c not in '#\t\n ')
-                val=''.join(c for c in val if c not in '#\t\n')
-                if str(key) == 'PEAKLAB':
-                    p.append(val.split())
-                if str(key) == 'RESULT':
-                    r.append(val)
-                self.metadata[str(key)] = val
-        self.metadata['RESULT'] = r
-        self.metadata['PEAKLAB'] = p
-        self.dataframe = pd.read_csv(filename, sep=',', skiprows=i, skipfooter=2, engine='python', index_col=False, header=None, names=['Energy (keV)', 'Counts'])
-        self.dataframe = self.dataframe.set_index('Energy (keV)')
-        file.close()
+        self.metadata, data = read_emsa(filename)
+        data = data[emsa_first_channel:]
+        self.dataframe = pd.DataFrame({'Counts': data[:, 1]}, index=pd.Index(data[:, 0], name='Energy (keV)'))
        
     def plot(self, color="grey", show_results=False, r_loc = 'tl', label_peaks=False, legend=''):
         signal_data = self.dataframe['Counts'].values
         energy_data = self.dataframe.index.values
-        plt.vlines(x=energy_data, ymax=signal_data, ymin=[0 for x in signal_data], color=color)
+        plt.fill_between(energy_data, signal_data, step='mid', color=color)
         if legend:
             plt.plot(energy_data, signal_data, linewidth = 1, label=legend, color=color)
             plt.legend(loc = 1, frameon = False).draggable(True)
@@ -171,16 +601,12 @@ class VantageEmsaFile(object):
         #             s=peak[i][1]
         #         )
         if label_peaks:
-            for peak in self.metadata['PEAKLAB']:
+            peaks = self.metadata['PEAKLAB']
+            centers = np.array([float(peak[0]) for peak in peaks])
+            heights = max_in_ranges(signal_data, energy_data, centers - 0.05, centers + 0.05)
+            for peak, center, height in zip(peaks, centers, heights):
                 plt.annotate(
-                    xy=[float(peak[0]),
-                        max_in_range(
-                            self.dataframe['Counts'].values,
-                            self.dataframe.index.values,
-                            low=float(peak[0])-0.05,
-                            high=float(peak[0])+0.05,
-                            plot=False,
-                            do_return=True)][1],
+                    xy=[center, height],
                     s=str(peak[1]),
                     horizontalalignment='center',
                     verticalalignment='bottom'
@@ -189,6 +615,271 @@ class VantageEmsaFile(object):
         plt.xlabel(self.dataframe.index.name)
         plt.axis([np.amin(energy_data), np.amax(energy_data), 0, np.amax(signal_data)*1.1])
 
+    def identify_peaks(self, elements=None, **kwargs):
+        """Finds the peaks of the spectrum and assigns X-ray lines to them. See identify_edx_peaks for the keyword arguments."""
+        return identify_edx_peaks(self.dataframe.index.values, self.dataframe['Counts'].values, elements, **kwargs)
+
+    def quantify(self, elements, kfactors=None, **kwargs):
+        """Cliff-Lorimer quantification of the given elements from a Gaussian fit of the spectrum. See fit_edx and quantify_edx for the arguments.
+
+        Returns a DataFrame indexed by element with the fitted line, net counts, Weight% and Atomic%."""
+        intensities, families = fit_edx(self.dataframe.index.values, self.dataframe['Counts'].values, elements, **kwargs)
+        weight, atomic, quantified = quantify_edx(intensities, families, kfactors)
+        used = _quantified_families(families)
+        return pd.DataFrame({'Line': used['line'].values, 'Counts': intensities[used.index.values], 'Weight%': weight, 'Atomic%': atomic}, index=pd.Index(quantified, name='Element'))
+
+# EMSA reading
+_emsa_strip_key = str.maketrans('', '', '#\t\n ')
+_emsa_strip_val = str.maketrans('', '', '#\t\n')
+
+# Earlier versions of VantageEmsaFile skipped the first (0 keV) channel; every spectrum reader does the same so that analyses line up
+emsa_first_channel = 1
+
+def read_emsa(filename):
+    """Reads an EMSA/MAS spectral data file in one pass.
+
+    Returns (metadata, data): a dict of the '#' keyword lines, with repeated 'PEAKLAB' and 'RESULT' lines collected in lists, and the numeric block as an array with one row per channel (energy, counts, ...)."""
+    with open(filename, 'r') as f:
+        lines = f.read().split('\n')
+    # Header lines lead the file, '#ENDOFDATA' and blank lines trail it
+    first = 0
+    while first < len(lines) and lines[first].startswith('#'):
+        first += 1
+    last = len(lines)
+    while last > first and (lines[last - 1].startswith('#') or not lines[last - 1].strip()):
+        last -= 1
+    metadata = {}
+    peaks = []
+    results = []
+    for line in lines[:first] + [line for line in lines[last:] if line.startswith('#')]:
+        (key, val) = line.split(':', 1)
+        key = key.translate(_emsa_strip_key)
+        val = val.translate(_emsa_strip_val)
+        if key == 'PEAKLAB':
+            peaks.append(val.split())
+        if key == 'RESULT':
+            results.append(val)
+        metadata[key] = val
+    metadata['RESULT'] = results
+    metadata['PEAKLAB'] = peaks
+    block = ' '.join(lines[first:last]).replace(',', ' ')
+    # Trailing commas leave no empty fields once split on whitespace
+    values = np.array(block.split(), dtype=float)
+    ncolumns = int(float(metadata.get('NCOLUMNS', 1))) + 1 if metadata.get('DATATYPE', 'XY').strip() == 'XY' else 1
+    return metadata, values.reshape(-1, ncolumns)
+
+def read_emsa_stack(filenames):
+    """Reads many EMSA files of a map or line scan into one array.
+
+    Arguments
+    ---------
+    filenames : list or str
+        EMSA files in acquisition order, or a glob pattern (files are then sorted by name)
+
+    Returns (energy, counts, metadata): the channel energies, counts of shape (n_spectra, n_channels) and a list of the metadata dicts. All files must have the same channels. The channels are those of VantageEmsaFile (from emsa_first_channel on)."""
+    if isinstance(filenames, str):
+        filenames = sorted(glob.glob(filenames))
+    metadata, data = read_emsa(filenames[0])
+    data = data[emsa_first_channel:]
+    energy = data[:, 0]
+    counts = np.empty((len(filenames), len(energy)))
+    counts[0] = data[:, 1]
+    metadatas = [metadata]
+    for i, filename in enumerate(filenames[1:], 1):
+        metadata, data = read_emsa(filename)
+        data = data[emsa_first_channel:]
+        if len(data) != len(energy) or not np.allclose(data[:, 0], energy):
+            raise ValueError('{0} does not have the same channels as {1}'.format(filename, filenames[0]))
+        counts[i] = data[:, 1]
+        metadatas.append(metadata)
+    return energy, counts, metadatas
+
+
+# EDX quantification
+# X-ray line energies (keV) and atomic weights. Ka and La stand for the unresolved a1/a2 doublets.
+xray_lines = {
+    'B':  {'Z': 5,  'mass': 10.81,  'Ka': 0.183},
+    'C':  {'Z': 6,  'mass': 12.011, 'Ka': 0.277},
+    'N':  {'Z': 7,  'mass': 14.007, 'Ka': 0.392},
+    'O':  {'Z': 8,  'mass': 15.999, 'Ka': 0.525},
+    'F':  {'Z': 9,  'mass': 18.998, 'Ka': 0.677},
+    'Na': {'Z': 11, 'mass': 22.990, 'Ka': 1.041, 'Kb': 1.071},
+    'Mg': {'Z': 12, 'mass': 24.305, 'Ka': 1.254, 'Kb': 1.302},
+    'Al': {'Z': 13, 'mass': 26.982, 'Ka': 1.487, 'Kb': 1.557},
+    'Si': {'Z': 14, 'mass': 28.086, 'Ka': 1.740, 'Kb': 1.836},
+    'P':  {'Z': 15, 'mass': 30.974, 'Ka': 2.013, 'Kb': 2.139},
+    'S':  {'Z': 16, 'mass': 32.06,  'Ka': 2.307, 'Kb': 2.464},
+    'Cl': {'Z': 17, 'mass': 35.45,  'Ka': 2.622, 'Kb': 2.816},
+    'K':  {'Z': 19, 'mass': 39.098, 'Ka': 3.314, 'Kb': 3.590},
+    'Ca': {'Z': 20, 'mass': 40.078, 'Ka': 3.692, 'Kb': 4.013, 'La': 0.341},
+    'Ti': {'Z': 22, 'mass': 47.867, 'Ka': 4.511, 'Kb': 4.932, 'La': 0.452},
+    'V':  {'Z': 23, 'mass': 50.942, 'Ka': 4.952, 'Kb': 5.427, 'La': 0.511},
+    'Cr': {'Z': 24, 'mass': 51.996, 'Ka': 5.415, 'Kb': 5.947, 'La': 0.573},
+    'Mn': {'Z': 25, 'mass': 54.938, 'Ka': 5.899, 'Kb': 6.490, 'La': 0.637},
+    'Fe': {'Z': 26, 'mass': 55.845, 'Ka': 6.404, 'Kb': 7.058, 'La': 0.705},
+    'Co': {'Z': 27, 'mass': 58.933, 'Ka': 6.930, 'Kb': 7.649, 'La': 0.776},
+    'Ni': {'Z': 28, 'mass': 58.693, 'Ka': 7.478, 'Kb': 8.265, 'La': 0.851},
+    'Cu': {'Z': 29, 'mass': 63.546, 'Ka': 8.048, 'Kb': 8.905, 'La': 0.930},
+    'Zn': {'Z': 30, 'mass': 65.38,  'Ka': 8.639, 'Kb': 9.572, 'La': 1.012},
+    'Ga': {'Z': 31, 'mass': 69.723, 'Ka': 9.252, 'Kb': 10.264, 'La': 1.098},
+    'Ge': {'Z': 32, 'mass': 72.63,  'Ka': 9.886, 'Kb': 10.982, 'La': 1.188},
+    'Zr': {'Z': 40, 'mass': 91.224, 'Ka': 15.775, 'Kb': 17.668, 'La': 2.042, 'Lb': 2.124},
+    'Nb': {'Z': 41, 'mass': 92.906, 'Ka': 16.615, 'Kb': 18.623, 'La': 2.166, 'Lb': 2.257},
+    'Mo': {'Z': 42, 'mass': 95.95,  'Ka': 17.479, 'Kb': 19.608, 'La': 2.293, 'Lb': 2.395},
+    'Pd': {'Z': 46, 'mass': 106.42, 'Ka': 21.177, 'Kb': 23.818, 'La': 2.838, 'Lb': 2.990},
+    'Ag': {'Z': 47, 'mass': 107.87, 'Ka': 22.163, 'Kb': 24.942, 'La': 2.984, 'Lb': 3.151},
+    'Sn': {'Z': 50, 'mass': 118.71, 'Ka': 25.271, 'Kb': 28.486, 'La': 3.444, 'Lb': 3.663},
+    'La': {'Z': 57, 'mass': 138.91, 'Ka': 33.442, 'La': 4.651, 'Lb': 5.042},
+    'Ce': {'Z': 58, 'mass': 140.12, 'Ka': 34.720, 'La': 4.840, 'Lb': 5.262},
+    'W':  {'Z': 74, 'mass': 183.84, 'La': 8.398, 'Lb': 9.672, 'Ma': 1.775},
+    'Pt': {'Z': 78, 'mass': 195.08, 'La': 9.442, 'Lb': 11.071, 'Ma': 2.048},
+    'Au': {'Z': 79, 'mass': 196.97, 'La': 9.713, 'Lb': 11.443, 'Ma': 2.120},
+    'Pb': {'Z': 82, 'mass': 207.2,  'La': 10.551, 'Lb': 12.614, 'Ma': 2.342},
+}
+# Intensity of each line relative to the strongest line of its family
+line_weights = {'Ka': 1., 'Kb': 0.13, 'La': 1., 'Lb': 0.6, 'Ma': 1.}
+
+def xray_line_table(elements=None, low=0.1, high=np.inf):
+    """Returns the X-ray lines of the given elements (all of xray_lines by default) between low and high keV as a DataFrame with columns element, family, line, energy (keV) and weight."""
+    rows = []
+    for element in elements or xray_lines:
+        for line, weight in line_weights.items():
+            energy = xray_lines[element].get(line)
+            if energy is not None and low <= energy <= high:
+                rows.append((element, line[0], line, energy, weight))
+    return pd.DataFrame(rows, columns=['element', 'family', 'line', 'energy', 'weight'])
+
+def edx_fwhm(energy, fwhm_mnka=0.130):
+    """Detector resolution (FWHM in keV) at the given energies (keV) from the FWHM at Mn Ka, following Fiori and Newbury: FWHM**2 = FWHM(Mn Ka)**2 + 2.5*(E - 5.895 keV) in eV."""
+    return np.sqrt(np.clip((fwhm_mnka*1000)**2 + 2.5*(np.asarray(energy)*1000 - 5895), 1, None))/1000
+
+def edx_peak_matrix(energy, elements, fwhm_mnka=0.130):
+    """Returns the design matrix of the line families of the elements in the energy range, shape (n_channels, n_families), and the families as a DataFrame (element, family, principal line energy).
+
+    Each column is the sum of the Gaussian lines of one family, weighted by line_weights, with the strongest line normalized to unit area in counts."""
+    energy = np.asarray(energy, dtype=float)
+    lines = xray_line_table(elements, low=max(energy.min(), 0.1), high=energy.max())
+    families = lines.groupby(['element', 'family'], sort=False)
+    column = families.ngroup().values
+    width = np.abs(np.gradient(energy))
+    sigma = edx_fwhm(lines['energy'].values, fwhm_mnka)/(2*np.sqrt(2*np.log(2)))
+    # One Gaussian per line, all lines at once
+    gaussians = np.exp(-0.5*((energy[:, np.newaxis] - lines['energy'].values)/sigma)**2)*width[:, np.newaxis]/(sigma*np.sqrt(2*np.pi))
+    matrix = np.zeros((len(energy), families.ngroups))
+    np.add.at(matrix.T, column, (gaussians*lines['weight'].values).T)
+    principal = lines.loc[lines.groupby(column)['weight'].idxmax().values, ['element', 'family', 'line', 'energy']].reset_index(drop=True)
+    return matrix, principal
+
+def fit_edx(energy, counts, elements, fwhm_mnka=0.130, background='snip', chunk_size=256, **kwargs):
+    """Background subtraction and Gaussian peak deconvolution of EDX spectra.
+
+    Arguments
+    ---------
+    energy : numpy.array
+        channel energies in keV
+    counts : numpy.array
+        a spectrum, or spectra with channels along the last axis, e.g. (n_spectra, n_channels) or a spectrum image (ny, nx, n_channels)
+    elements : list
+        element symbols (keys of xray_lines)
+    fwhm_mnka : float
+        detector resolution at Mn Ka in keV
+    background : str
+        method of general.background, or None if counts are already background subtracted. It is estimated on the spectra smoothed with a Gaussian of the detector resolution, so that it follows the mean of noisy counts rather than their lower envelope. Keyword arguments are passed to it ('snip' clips up to the FWHM at the highest energy by default)
+    chunk_size : int
+        number of spectra fitted at a time, which bounds the memory used
+
+    The design matrix is shared by every spectrum, so all spectra are fitted by one linear least squares solve (one matrix product with its pseudo-inverse per chunk).
+
+    Returns (intensities, families): the net counts of each line family, shape (..., n_families), and the families DataFrame of edx_peak_matrix.
+    """
+    matrix, families = edx_peak_matrix(energy, elements, fwhm_mnka)
+    if background:
+        # A constant and a slope fitted with the peaks absorb what the background estimate leaves of the noise floor
+        ramp = np.linspace(-1, 1, len(matrix))
+        matrix = np.column_stack((matrix, np.ones(len(matrix)), ramp))
+    inverse = np.linalg.pinv(matrix)[:len(families)]
+    step = np.abs(np.median(np.diff(energy)))
+    sigma = max(edx_fwhm(np.min(energy), fwhm_mnka)/(2*np.sqrt(2*np.log(2))*step), 0.5)
+    if background == 'snip':
+        kwargs.setdefault('iterations', int(np.ceil(edx_fwhm(np.max(energy), fwhm_mnka)/step)))
+    counts = np.asarray(counts, dtype=float)
+    spectra = counts.reshape(-1, counts.shape[-1])
+    intensities = np.empty((len(spectra), len(families)))
+    for start in range(0, len(spectra), chunk_size):
+        chunk = spectra[start:start + chunk_size]
+        if background:
+            chunk = chunk - general.background(ndimage.gaussian_filter1d(chunk, sigma, axis=-1), method=background, x=energy, **kwargs)
+        intensities[start:start + chunk_size] = chunk.dot(inverse.T)
+    return intensities.reshape(counts.shape[:-1] + (len(families),)), families
+
+def _quantified_families(families):
+    """Internal function. Returns the rows of families quantified for each element: K if fitted, otherwise L then M."""
+    order = families['family'].map({'K': 0, 'L': 1, 'M': 2})
+    return families.assign(order=order).sort_values('order', kind='stable').drop_duplicates('element').sort_index()
+
+def quantify_edx(intensities, families, kfactors=None):
+    """Cliff-Lorimer quantification: weight fractions proportional to k*I for each element.
+
+    Arguments
+    ---------
+    intensities : numpy.array
+        net counts of the line families as returned by fit_edx, shape (..., n_families)
+    families : pandas.DataFrame
+        families as returned by fit_edx
+    kfactors : dict
+        k-factor of each element relative to a common reference (e.g. Si), for the line family quantified. Elements that are missing get 1
+
+    One family per element is quantified, the K family if it was fitted and otherwise L then M. Returns (weight, atomic, elements): weight and atomic percentages of shape (..., n_elements) and the list of elements."""
+    kfactors = kfactors or {}
+    chosen = _quantified_families(families)
+    elements = chosen['element'].tolist()
+    net = np.clip(intensities[..., chosen.index.values], 0, None)
+    weight = net*np.array([kfactors.get(element, 1.) for element in elements])
+    weight = 100*weight/np.where(weight.sum(axis=-1, keepdims=True) > 0, weight.sum(axis=-1, keepdims=True), 1)
+    atomic = weight/np.array([xray_lines[element]['mass'] for element in elements])
+    atomic = 100*atomic/np.where(atomic.sum(axis=-1, keepdims=True) > 0, atomic.sum(axis=-1, keepdims=True), 1)
+    return weight, atomic, elements
+
+def edx_maps(energy, counts, elements, kfactors=None, **kwargs):
+    """Elemental maps of a spectrum image of shape (ny, nx, n_channels). Returns a dict of element -> (ny, nx) weight percent map, and 'intensity' -> dict of element -> net counts map. Keyword arguments are passed to fit_edx."""
+    intensities, families = fit_edx(energy, counts, elements, **kwargs)
+    weight, atomic, elements = quantify_edx(intensities, families, kfactors)
+    maps = {element: weight[..., i] for i, element in enumerate(elements)}
+    maps['intensity'] = {row.element + ' ' + row.line: intensities[..., i] for i, row in enumerate(families.itertuples())}
+    return maps
+
+def identify_edx_peaks(energy, counts, elements=None, fwhm_mnka=0.130, threshold=5, iterations=None):
+    """Finds peaks in an EDX spectrum (or the sum of a stack of spectra) and assigns them to the nearest X-ray line.
+
+    The background subtracted spectrum is smoothed with a Gaussian of the detector resolution, and a peak is kept when its smoothed net height is more than 'threshold' standard deviations of the smoothed background counts. Each peak gets the nearest line within half the FWHM. Returns a DataFrame with the peak energy, net counts, element, line and line energy (NaN when no line matches)."""
+    energy = np.asarray(energy, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    spectrum = counts.reshape(-1, counts.shape[-1]).sum(axis=0)
+    step = np.abs(np.median(np.diff(energy)))
+    if iterations is None:
+        iterations = int(np.ceil(edx_fwhm(energy.max(), fwhm_mnka)/step))
+    # Smoothing with the narrowest peak width reduces the noise by sqrt(2*sqrt(pi)*sigma) for Poisson counts
+    sigma = max(edx_fwhm(energy.min(), fwhm_mnka)/(2*np.sqrt(2*np.log(2))*step), 0.5)
+    smoothed = ndimage.gaussian_filter1d(spectrum, sigma)
+    background = general.snip(smoothed, iterations=iterations)
+    net = smoothed - background
+    noise = np.sqrt((background + 1)/(2*np.sqrt(np.pi)*sigma))
+    peaks, properties = signal.find_peaks(net, height=threshold*noise, distance=max(int(2.355*sigma), 1))
+    result = pd.DataFrame({'energy': energy[peaks], 'counts': net[peaks], 'element': None, 'line': None, 'line energy': np.nan})
+    lines = xray_line_table(elements, low=max(energy.min(), 0.1), high=energy.max())
+    if len(lines) and len(peaks):
+        # All peaks against all lines at once
+        distance = np.abs(energy[peaks][:, np.newaxis] - lines['energy'].values)
+        score = np.where(distance <= edx_fwhm(energy[peaks], fwhm_mnka)[:, np.newaxis]/2, distance, np.inf)
+        best = score.argmin(axis=1)
+        found = np.isfinite(score[np.arange(len(peaks)), best])
+        match = lines.iloc[best[found]]
+        result.loc[found, 'element'] = match['element'].values
+        result.loc[found, 'line'] = match['line'].values
+        result.loc[found, 'line energy'] = match['energy'].values
+    return result
+
+
 # External Functions
 def max_in_range(signal, index, low, high, plot=True, do_return=False):
     """Finds the maximum value of y in a given range of x"""
@@ -205,6 +896,19 @@ def max_in_range(signal, index, low, high, plot=True, do_return=False):
     if do_return:
         return max_x, max_y
 
+def max_in_ranges(signal, index, low, high):
+    """Finds the maximum value of y in each range of x (low[i] to high[i], inclusive). index must be ascending. Returns nan for empty ranges."""
+    low = np.searchsorted(index, low, side='left')
+    high = np.searchsorted(index, high, side='right')
+    # Even entries of reduceat over the (low, high) pairs are the range maxima
+    result = np.full(len(low), np.nan)
+    valid = high > low
+    if valid.any():
+        bounds = np.stack((low[valid], high[valid]), axis=1).ravel()
+        padded = np.append(np.asarray(signal, dtype=float), -np.inf)
+        result[valid] = np.maximum.reduceat(padded, bounds)[::2]
+    return result
+
 def yforx(x, xdata, ydata): #Used by other functions
     """Sorts xdata into ascending order (required by splrep) and solves y (as fa) for a value of x. Also returns spl to allow for further calculations to take place quicker. Used by other functions."""
     #Sorts data into ascending order (required by splrep)
@@ -1,12 +1,287 @@
 #TGA Technique 
 import numpy as np, matplotlib.pyplot as plt
-from scipy import interpolate
+from scipy import interpolate, ndimage, signal
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import general
+
+# Header lines of Universal Analysis exports -> attribute names
+ua_header_keys = {
+    'OrgFile': 'original_filename',
+    'Date': 'date',
+    'Time': 'time',
+    'Sample': 'sample',
+    'Size': 'mass',
+    'Method': 'method',
+    'Comment': 'comment',
+}
+
+def read_ua(filename):
+    """Reads a text file exported by Universal Analysis 2000 in one pass: the header is scanned up to 'StartOfData' and the rest of the file is parsed by the C tokenizer of pandas from where the scan stopped.
+
+    Returns a dict of the header attributes of TGAFile ('signal' being the list of 'Sig' names) and a DataFrame with one column per signal."""
+    header = dict((attribute, "") for attribute in ua_header_keys.values())
+    header['signal'] = []
+    with open(filename, 'r', encoding='latin-1') as file:
+        for line in file:
+            key, _, value = line.rstrip('\r\n').partition('\t')
+            if key == 'StartOfData':
+                break
+            if key in ua_header_keys:
+                header[ua_header_keys[key]] = value.replace('\t', ' ').replace('\\', '/') if key == 'OrgFile' else value.replace('\t', ' ')
+            elif key.startswith('Sig'):
+                header['signal'].append(value.split('\t')[-1])
+        else:
+            raise ValueError('No StartOfData line in ' + filename)
+        dataframe = pd.read_csv(file, sep=r'\s+', header=None, names=header['signal'] or None, dtype=float)
+    return header, dataframe
+
+# Analysis
+def smoothed_curve(temperature, weight, step=None, window=10., polyorder=2):
+    """Resamples weight on a uniform temperature grid and smooths it with a Savitzky-Golay filter of 'window' °C. The grid spacing 'step' is the median temperature step of the data by default. Meant for heating ramps: the data are sorted by temperature first.
+
+    Returns the grid, the smoothed weight and its derivative dW/dT."""
+    temperature = np.asarray(temperature, dtype=float)
+    weight = np.asarray(weight, dtype=float)
+    order = np.argsort(temperature, kind='stable')
+    temperature, weight = temperature[order], weight[order]
+    if step is None:
+        step = np.median(np.diff(temperature)[np.diff(temperature) > 0])
+    grid = np.arange(temperature[0], temperature[-1] + step/2, step)
+    resampled = np.interp(grid, temperature, weight)
+    # Odd number of points in the window
+    points = int(np.clip(window/step, polyorder + 2, len(grid)))
+    points -= 1 - points % 2
+    smooth = signal.savgol_filter(resampled, points, polyorder)
+    derivative = signal.savgol_filter(resampled, points, polyorder, deriv=1, delta=step)
+    return grid, smooth, derivative
+
+def dtg(temperature, weight, step=None, window=10., polyorder=2):
+    """Derivative thermogravimetry: returns the temperature grid and the smoothed dW/dT (see smoothed_curve)."""
+    grid, smooth, derivative = smoothed_curve(temperature, weight, step, window, polyorder)
+    return grid, derivative
+
+def find_steps(temperature, weight, prominence=0.05, edge=0.05, min_loss=None, step=None, window=10., polyorder=2):
+    """Finds the mass loss steps of a heating ramp as the peaks of -dW/dT (see smoothed_curve) higher than 'prominence' times the largest one. Steps losing less than 'min_loss' (in the units of weight, 1e-6 times the largest weight by default) are left out, so a flat curve has no steps.
+
+    A step runs from where the loss rate falls below 'edge' times its peak rate, or from the lowest rate between it and the neighbouring step, on either side. The extrapolated onset and endset are where the tangent at the peak rate crosses the weight at the start and end of the step.
+
+    Returns a DataFrame with one row per step: 'start', 'onset', 'peak', 'endset' and 'end' temperatures, 'mass loss' (in the units of weight) and 'rate' (-dW/dT at the peak)."""
+    grid, smooth, derivative = smoothed_curve(temperature, weight, step, window, polyorder)
+    rate = -derivative
+    if min_loss is None:
+        min_loss = 1e-6*np.abs(smooth).max()
+    peaks, properties = signal.find_peaks(rate, prominence=prominence*max(rate.max(), 0))
+    # Lowest rate between neighbouring peaks bounds each step
+    valleys = [p + np.argmin(rate[p:q]) for p, q in zip(peaks[:-1], peaks[1:])]
+    left_limits = np.append(0, valleys).astype(int)
+    right_limits = np.append(valleys, len(rate) - 1).astype(int)
+    rows = []
+    for peak, low, high in zip(peaks, left_limits, right_limits):
+        below = np.flatnonzero(rate[low:high + 1] < edge*rate[peak]) + low
+        start = below[below < peak].max() if np.any(below < peak) else low
+        end = below[below > peak].min() if np.any(below > peak) else high
+        slope = derivative[peak]
+        onset = grid[peak] + (smooth[start] - smooth[peak])/slope
+        endset = grid[peak] + (smooth[end] - smooth[peak])/slope
+        if smooth[start] - smooth[end] < min_loss:
+            continue
+        rows.append([grid[start], onset, grid[peak], endset, grid[end], smooth[start] - smooth[end], rate[peak]])
+    return pd.DataFrame(rows, columns=['start', 'onset', 'peak', 'endset', 'end', 'mass loss', 'rate'])
+
+def batch_steps(runs, ranges=None, x=1, y=2, percent=True, **kwargs):
+    """Quantifies mass loss steps over many TGAFile runs at once.
+
+    With ranges, a list of (low, high) temperatures, returns the weight difference over every range for every run (one spline per run, evaluated at all the limits at once) as a DataFrame with one row per run and one column per range. Otherwise the steps of every run are found with find_steps (keyword arguments are passed to it) and returned as one DataFrame indexed by (run, step).
+
+    Runs are named by shortname (or filename); weights are in percent of the largest weight by default."""
+    names = [run.shortname or run.filename for run in runs]
+    if ranges is not None:
+        rows = [run.calculate_steps(ranges, x, y, percent) for run in runs]
+        return pd.DataFrame(rows, index=pd.Index(names, name='run'), columns=pd.MultiIndex.from_tuples([tuple(limits) for limits in ranges], names=['low', 'high']))
+    tables = [run.find_steps(x, y, percent, **kwargs) for run in runs]
+    return pd.concat(tables, keys=names, names=['run', 'step'])
+
+# Kinetics
+gas_constant = 8.314462618e-3       # kJ/(mol K)
+
+def heating_rate(time, temperature):
+    """Heating rate of a ramp as the slope of a straight line fitted to temperature against time (°C or K per unit of time)."""
+    return np.polyfit(np.asarray(time, dtype=float), np.asarray(temperature, dtype=float), 1)[0]
+
+def conversion(temperature, weight, start=None, end=None, **kwargs):
+    """Conversion α = (W(start) - W)/(W(start) - W(end)) of a heating ramp on the uniform temperature grid of smoothed_curve, limited to the range from start to end (the whole ramp by default). Keyword arguments are passed to smoothed_curve.
+
+    Returns the grid, α (made non-decreasing) and dα/dT."""
+    grid, smooth, derivative = smoothed_curve(temperature, weight, **kwargs)
+    low = 0 if start is None else np.searchsorted(grid, start)
+    high = len(grid) if end is None else np.searchsorted(grid, end, side='right')
+    grid, smooth, derivative = grid[low:high], smooth[low:high], derivative[low:high]
+    loss = smooth[0] - smooth[-1]
+    alpha = np.maximum.accumulate(np.clip((smooth[0] - smooth)/loss, 0, 1))
+    return grid, alpha, -derivative/loss
+
+def conversion_table(runs, alpha=None, x=1, y=2, time=0, start=None, end=None, **kwargs):
+    """Temperature (K), conversion rate dα/dt and heating rate of every run at the conversions alpha (0.05 to 0.95 by default), interpolated from conversion. Keyword arguments are passed to smoothed_curve.
+
+    Returns a dict of 'alpha', 'beta' (n_runs), 'temperature' and 'rate' (n_alpha, n_runs) arrays."""
+    alpha = np.linspace(0.05, 0.95, 19) if alpha is None else np.asarray(alpha, dtype=float)
+    beta = np.array([heating_rate(run.data_array[time], run.data_array[x]) for run in runs])
+    temperatures, rates = [], []
+    for run, b in zip(runs, beta):
+        grid, a, dadT = conversion(run.data_array[x], run.data_array[y], start, end, **kwargs)
+        # First temperature reaching each conversion
+        T = np.interp(alpha, a, grid)
+        temperatures.append(T + 273.15)
+        rates.append(b*np.interp(T, grid, dadT))
+    return {'alpha': alpha, 'beta': beta, 'temperature': np.array(temperatures).T, 'rate': np.array(rates).T}
+
+def _regression(x, y):
+    """Internal function. Least squares slopes and intercepts of the rows of y against the rows of x, all at once, with the fitted values and r²."""
+    dx = x - x.mean(axis=-1, keepdims=True)
+    dy = y - y.mean(axis=-1, keepdims=True)
+    slope = np.sum(dx*dy, axis=-1)/np.sum(dx**2, axis=-1)
+    intercept = y.mean(axis=-1) - slope*x.mean(axis=-1)
+    fitted = intercept[..., None] + slope[..., None]*x
+    r2 = 1 - np.sum((y - fitted)**2, axis=-1)/np.sum(dy**2, axis=-1)
+    return slope, intercept, fitted, r2
+
+def _bootstrap_slopes(x, fitted, residuals, n, seed):
+    """Internal function. Slopes of n residual bootstrap resamples: the residuals of each row are drawn again with replacement and added to the fitted values. Runs in the worker processes of isoconversional and kissinger."""
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, residuals.shape[-1], size=(n,) + residuals.shape)
+    resampled = fitted + np.take_along_axis(np.broadcast_to(residuals, picks.shape), picks, axis=-1)
+    return _regression(np.broadcast_to(x, picks.shape), resampled)[0]
+
+def bootstrap_slopes(x, y, n_bootstrap=1000, processes=1, seed=0):
+    """Residual bootstrap of the slopes of the rows of y against the rows of x. The resamples are split over processes. Returns an array (n_bootstrap, n_rows)."""
+    slope, intercept, fitted, r2 = _regression(x, y)
+    residuals = y - fitted
+    counts = [len(chunk) for chunk in np.array_split(np.arange(n_bootstrap), max(processes, 1))]
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    if processes == 1:
+        return _bootstrap_slopes(x, fitted, residuals, n_bootstrap, seeds[0])
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_bootstrap_slopes, x, fitted, residuals, n, s) for n, s in zip(counts, seeds)]
+        return np.concatenate([future.result() for future in futures])
+
+def isoconversional(runs, method='friedman', alpha=None, n_bootstrap=0, processes=1, x=1, y=2, time=0, start=None, end=None, **kwargs):
+    """Activation energy against conversion from runs of the same material at different heating rates, for every conversion at once.
+
+    Arguments
+    ---------
+    runs : list
+        TGAFile objects, one per heating rate.
+    method : str
+        'friedman' (ln dα/dt against 1/T) or 'ofw' (Ozawa-Flynn-Wall, ln β against 1/T with Doyle's approximation).
+    alpha : array
+        conversions, 0.05 to 0.95 by default.
+    n_bootstrap : int
+        number of residual bootstrap resamples used to estimate the standard deviation of Ea; none by default.
+    processes : int
+        number of processes sharing the bootstrap resamples.
+    x, y, time : int
+        columns of temperature (°C), weight and time.
+    start, end : float
+        temperatures where the conversion is 0 and 1, the ends of the runs by default.
+
+    Keyword arguments are passed to smoothed_curve. Returns a DataFrame indexed by alpha with 'Ea/kJ/mol', 'intercept' (ln(A f(α)) for Friedman), 'r2' and, with bootstrap, 'Ea std/kJ/mol'.
+    """
+    table = conversion_table(runs, alpha, x, y, time, start, end, **kwargs)
+    inverse_T = 1/table['temperature']
+    if method == 'friedman':
+        values, factor = np.log(table['rate']), 1.
+    elif method == 'ofw':
+        values, factor = np.broadcast_to(np.log(table['beta']), inverse_T.shape), 1.052
+    else:
+        raise ValueError("method must be 'friedman' or 'ofw'")
+    slope, intercept, fitted, r2 = _regression(inverse_T, values)
+    result = pd.DataFrame({'Ea/kJ/mol': -slope*gas_constant/factor, 'intercept': intercept, 'r2': r2}, index=pd.Index(table['alpha'], name='alpha'))
+    if n_bootstrap:
+        slopes = bootstrap_slopes(inverse_T, values, n_bootstrap, processes)
+        result['Ea std/kJ/mol'] = np.std(slopes, axis=0)*gas_constant/factor
+    return result
+
+def kissinger(runs, n_bootstrap=0, processes=1, x=1, y=2, time=0, **kwargs):
+    """Kissinger activation energy from the temperature Tp of the largest mass loss rate of each run: ln(β/Tp²) against 1/Tp. Keyword arguments are passed to smoothed_curve.
+
+    Returns a Series with 'Ea/kJ/mol', 'ln A' (A in the time unit of the runs), 'r2' and, with n_bootstrap resamples, 'Ea std/kJ/mol'."""
+    beta = np.array([heating_rate(run.data_array[time], run.data_array[x]) for run in runs])
+    peaks = []
+    for run in runs:
+        grid, derivative = dtg(run.data_array[x], run.data_array[y], **kwargs)
+        peaks.append(grid[np.argmin(derivative)] + 273.15)
+    inverse_T = 1/np.array(peaks)
+    values = np.log(beta*inverse_T**2)
+    slope, intercept, fitted, r2 = _regression(inverse_T, values)
+    Ea = -slope*gas_constant
+    result = pd.Series({'Ea/kJ/mol': Ea, 'ln A': intercept + np.log(Ea/gas_constant), 'r2': r2})
+    if n_bootstrap:
+        result['Ea std/kJ/mol'] = np.std(bootstrap_slopes(inverse_T[None], values[None], n_bootstrap, processes)[:, 0])*gas_constant
+    return result
+
+# Segments
+segment_kinds = {-1: 'cooling', 0: 'isothermal', 1: 'heating'}
+
+def detect_segments(time, temperature, threshold=1., window=1., breaks=()):
+    """Splits a run into heating, isothermal and cooling segments from the temperature derivative: dT/dt above threshold (°C per unit of time) is heating, below -threshold cooling, isothermal otherwise. The labels are median filtered over 'window' units of time so that noise does not split segments. Rows in breaks (e.g. gas switches) always start a new segment.
+
+    Returns the first row of every segment and its kind."""
+    time = np.asarray(time, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    rate = np.gradient(temperature, time)
+    labels = np.where(rate > threshold, 1, np.where(rate < -threshold, -1, 0))
+    points = max(int(window/np.median(np.diff(time))), 1)
+    labels = ndimage.median_filter(labels, size=points, mode='nearest')
+    starts = np.union1d(np.append(0, np.flatnonzero(np.diff(labels)) + 1), np.asarray(breaks, dtype=int))
+    return starts, np.array([segment_kinds[label] for label in labels[starts]])
+
+def segment_statistics(starts, time, temperature, weight):
+    """Statistics of consecutive segments starting at the rows starts, computed for all segments at once with reduceat, so that many runs concatenated end to end are done in one pass (a run must start a segment).
+
+    Returns a DataFrame with one row per segment: 'start', 'end' (time), 'start temperature', 'end temperature', 'mean temperature', 'mass change' and 'rate' (mass change per unit of time)."""
+    time = np.asarray(time, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    weight = np.asarray(weight, dtype=float)
+    starts = np.asarray(starts, dtype=int)
+    lasts = np.append(starts[1:], len(time)) - 1
+    lengths = lasts - starts + 1
+    duration = time[lasts] - time[starts]
+    change = weight[lasts] - weight[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(duration > 0, change/duration, np.nan)
+    return pd.DataFrame({
+        'start': time[starts],
+        'end': time[lasts],
+        'start temperature': temperature[starts],
+        'end temperature': temperature[lasts],
+        'mean temperature': np.add.reduceat(temperature, starts)/lengths,
+        'mass change': change,
+        'rate': rate,
+    })
+
+def segment_table(runs, time=0, temperature=1, weight=2, **kwargs):
+    """Segments of many TGAFile runs (see TGAFile.find_segments; keyword arguments are passed to detect_segments) with their statistics, computed in one pass over the runs joined end to end. Returns a DataFrame indexed by (run, segment), runs being named by shortname (or filename)."""
+    names = [run.shortname or run.filename for run in runs]
+    offsets = np.cumsum([0] + [len(run.data_array[time]) for run in runs])
+    starts, kinds, gases = [], [], []
+    for run, offset in zip(runs, offsets):
+        run_starts, run_kinds = run._segment_starts(time, temperature, **kwargs)
+        starts.append(run_starts + offset)
+        kinds.append(run_kinds)
+        gases.append(run.gas_at(run_starts))
+    columns = [np.concatenate([run.data_array[column] for run in runs]) for column in (time, temperature, weight)]
+    table = segment_statistics(np.concatenate(starts), *columns)
+    table.insert(0, 'kind', np.concatenate(kinds))
+    table.insert(1, 'gas', np.concatenate(gases))
+    counts = [len(s) for s in starts]
+    table.index = pd.MultiIndex.from_arrays([np.repeat(names, counts), np.concatenate([np.arange(n) for n in counts])], names=['run', 'segment'])
+    return table
 
 class _DataFile(object):
     def plot(self, x='Temperature (oC)', y='Mass (mg)', color='blue'):
         """Plots x vs y based on self.signal columns. Further calculation based plotting can be done using other commands."""
-        plt.plot(self.dataframe[x].values, self.dataframe[y].values, color=color)
+        general.plot_downsampled(self.dataframe[x].values, self.dataframe[y].values, color=color)
         plt.xlabel(self.dataframe[x].name, fontsize=12)
         plt.ylabel(self.dataframe[y].name, fontsize=12)
     
@@ -23,39 +298,20 @@ class TGAFile(object):
     signal = []
     data_array = ""
     color = "blue"
+    gas_switches = []           # Recorded by gas_change
+    segments = None             # Found by find_segments
     
     def __init__(self, filename, shortname=""):
         self.filename = filename
         self.shortname = shortname
-        file = open(filename, 'r', encoding='latin-1')
-        i = 0
-        skip_line = 0
-        self.signal = []
-        for line in file:
-            i += 1
-            if "OrgFile" in line:
-                self.original_filename = line.strip("OrgFile" + "\t").strip('\n').replace('\t', ' ').replace('\\', "/")
-                skip_line = i
-            elif "Date" in line:
-                self.date = line.strip("Date\t").strip('\n').replace('\t', ' ')
-                #self.date = datetime.strptime(line.strip('Date\t'), '%d-%b-%y')
-            elif "Time" in line and "Sig" not in line:
-                self.time = line.strip("Time\t").strip('\n').replace('\t', ' ')
-                #self.time = datetime.strptime(line.strip('Time\t'), '%I:%M:%S')
-            elif "Sample" in line and "Sig" not in line:
-                self.sample = line.strip("Sample\t").strip('\n').replace('\t', ' ')
-            elif "Size" in line:
-                self.mass = line.strip("Size\t").strip('\n').replace('\t', ' ')
-            elif "Method" in line:
-                self.method = line.strip("Method\t").strip('\n').replace('\t', ' ')
-            elif "Comment" in line:
-                self.comment = line.strip("Comment\t").strip('\n').replace('\t', ' ')
-            elif "Sig" in line:
-                signal_entry = line.split('\t')
-                self.signal.append(signal_entry[-1].strip('\n'))
-            elif "StartOfData" in line:
-                skip_line = i
-        self.data_array = np.genfromtxt(filename, delimiter=None, skip_header=skip_line, autostrip=True, unpack=True)
+        self.gas_switches = []
+        header, self.dataframe = read_ua(filename)
+        for attribute in ua_header_keys.values():
+            setattr(self, attribute, header[attribute])
+        self.signal = header['signal']
+        # One row per signal, as np.genfromtxt(..., unpack=True) returned
+        self.data_array = self.dataframe.values.T
+        self._splines = {}
     
     @property
     def all(self):
@@ -74,7 +330,7 @@ class TGAFile(object):
     
     def plot(self, x=0, y=1, color='blue'):
         """Plots x vs y based on self.signal columns. Further calculation based plotting can be done using other commands."""
-        plt.plot(self.data_array[x], self.data_array[y], color=color)
+        general.plot_downsampled(self.data_array[x], self.data_array[y], color=color)
         plt.xlabel(self.signal[x], fontsize=12)
         plt.ylabel(self.signal[y], fontsize=12)
     
@@ -92,19 +348,23 @@ class TGAFile(object):
         return fa, spl
         
     def weight_percent(self, y): #Used by other functions
-        """Calculates weight percent. Used by other functions. Used by other functions"""
-        percent = self.data_array[y]
-        max = np.amax(self.data_array[y])
-        percent[:] = [x/max*100 for x in percent]
-        return percent
+        """Returns column y as a percent of its largest value. Used by other functions"""
+        return self.data_array[y]/np.amax(self.data_array[y])*100
+    
+    def spline(self, x=1, y=2, percent=False):
+        """Smoothing spline (as used by yforx) of column y against column x, or of weight_percent(y) with percent, built once per pair of columns."""
+        if (x, y, percent) not in self._splines:
+            weight = self.weight_percent(y) if percent else self.data_array[y]
+            self._splines[(x, y, percent)] = self.yforx(self.data_array[x][0], self.data_array[x], weight)[1]
+        return self._splines[(x, y, percent)]
     
     def plot_percent(self, x=1, y=2, color=""):     
         """Calculates percent mass based on column indices provided as arguments. Defaults are x=1, y=2"""
         percent = self.weight_percent(y)
         if color:
-            plt.plot(self.data_array[x], percent, color=color, linewidth=1.5, label=self.shortname)
+            general.plot_downsampled(self.data_array[x], percent, color=color, linewidth=1.5, label=self.shortname)
         else:
-            plt.plot(self.data_array[x], percent, color=self.color, linewidth=1.5, label=self.shortname)
+            general.plot_downsampled(self.data_array[x], percent, color=self.color, linewidth=1.5, label=self.shortname)
         plt.ylabel(r'Weight Percent / %', fontsize=12)
         plt.xlabel(self.signal[x], fontsize=12)
         legend = plt.legend(loc=1, frameon = 1, fontsize=15, framealpha=1)
@@ -112,9 +372,9 @@ class TGAFile(object):
             frame = legend.get_frame()
             frame.set_color('white')
         
-    def plot_step(self, a, x=1, y=2, color="", line=True):
-        """Plots point on curve of object"""
-        fa, spl = self.yforx(a, self.data_array[x], self.data_array[y])
+    def plot_step(self, a, x=1, y=2, color="", line=True, percent=True):
+        """Plots point on curve of object, on the weight percent curve of plot_percent by default"""
+        fa = interpolate.splev(a, self.spline(x, y, percent), der=0)
         plt.plot(a,fa,'om', color='red')
         if line:
             if color:
@@ -122,19 +382,82 @@ class TGAFile(object):
             else:
                 plt.hlines(y=fa,xmin=a,xmax=np.amax(self.data_array[x])*10,color=self.color, linestyle='dashed')
             
-    def calculate_step(self, a, b, x=1, y=2):
-        """Calculates the y difference between two x points as a float"""
-        fa, spl = self.yforx(a, self.data_array[x], self.data_array[y])
-        fb = interpolate.splev(b,spl,der=0)
+    def calculate_step(self, a, b, x=1, y=2, percent=False):
+        """Calculates the y difference between two x points as a float. With percent, in percent of the largest y."""
+        fa, fb = interpolate.splev([a, b], self.spline(x, y, percent), der=0)
         diff = abs(fa - fb)
         return float(diff)
+    
+    def calculate_steps(self, ranges, x=1, y=2, percent=False):
+        """Calculates the y difference over every (a, b) of ranges as an array, evaluating the spline at all the limits at once. With percent, in percent of the largest y."""
+        limits = np.asarray(ranges, dtype=float)
+        values = interpolate.splev(limits.ravel(), self.spline(x, y, percent), der=0).reshape(limits.shape)
+        return np.abs(values[:, 0] - values[:, 1])
+    
+    def dtg(self, x=1, y=2, percent=True, **kwargs):
+        """Derivative thermogravimetry of column y against column x (in percent of the largest y by default). Returns a DataFrame indexed by x on a uniform grid. Keyword arguments are passed to smoothed_curve."""
+        weight = self.weight_percent(y) if percent else self.data_array[y]
+        grid, derivative = dtg(self.data_array[x], weight, **kwargs)
+        return pd.DataFrame({'DTG': derivative}, index=pd.Index(grid, name=self.signal[x]))
+    
+    def plot_dtg(self, x=1, y=2, percent=True, color="", **kwargs):
+        """Plots -dW/dT (see dtg)."""
+        curve = self.dtg(x, y, percent, **kwargs)
+        general.plot_downsampled(curve.index.values, -curve['DTG'].values, color=color or self.color, linewidth=1.5, label=self.shortname)
+        plt.ylabel(r'-dW/dT / %/°C' if percent else r'-dW/dT', fontsize=12)
+        plt.xlabel(self.signal[x], fontsize=12)
+    
+    def find_steps(self, x=1, y=2, percent=True, **kwargs):
+        """Finds the mass loss steps with their onset and endset (see find_steps), in percent of the largest y by default."""
+        weight = self.weight_percent(y) if percent else self.data_array[y]
+        return find_steps(self.data_array[x], weight, **kwargs)
         
-    def gas_change(self, location, gas1="", gas2="", fontsize=15):
-        plt.axvline(x=location, color='black', linestyle='dashed')
-        plt.annotate(gas1, xy=(location-2, -0), xycoords='data', fontsize=fontsize,
-            horizontalalignment='right', verticalalignment='top')
-        plt.annotate(gas2, xy=(location+2, -0), xycoords='data', fontsize=fontsize,
-            horizontalalignment='left', verticalalignment='top')
+    def gas_change(self, location, gas1="", gas2="", fontsize=15, x=1, plot=True):
+        """Records a switch from gas1 to gas2 at the first row where column x reaches location, and draws it on the current plot unless plot is False. The switches are kept in gas_switches and start new segments in find_segments. Raises ValueError if column x never reaches location."""
+        reached = self.data_array[x] >= location
+        if not reached.any():
+            raise ValueError('{0} never reaches {1}'.format(self.signal[x], location))
+        row = int(np.argmax(reached))
+        switch = {'row': row, 'location': location, 'column': self.signal[x], 'from': gas1, 'to': gas2}
+        self.gas_switches = sorted([s for s in self.gas_switches if s['row'] != row] + [switch], key=lambda s: s['row'])
+        self.segments = None
+        if plot:
+            plt.axvline(x=location, color='black', linestyle='dashed')
+            plt.annotate(gas1, xy=(location-2, -0), xycoords='data', fontsize=fontsize,
+                horizontalalignment='right', verticalalignment='top')
+            plt.annotate(gas2, xy=(location+2, -0), xycoords='data', fontsize=fontsize,
+                horizontalalignment='left', verticalalignment='top')
+    
+    def gas_at(self, rows):
+        """Returns the gas flowing at the given rows according to gas_switches ('' if none were recorded)."""
+        if not self.gas_switches:
+            return np.full(len(rows), '', dtype=object)
+        gases = np.array([self.gas_switches[0]['from']] + [s['to'] for s in self.gas_switches], dtype=object)
+        return gases[np.searchsorted([s['row'] for s in self.gas_switches], rows, side='right')]
+    
+    def _segment_starts(self, time=0, temperature=1, **kwargs):
+        """Internal function. First rows and kinds of the segments, gas switches included."""
+        breaks = [s['row'] for s in self.gas_switches]
+        return detect_segments(self.data_array[time], self.data_array[temperature], breaks=breaks, **kwargs)
+    
+    def find_segments(self, time=0, temperature=1, weight=2, **kwargs):
+        """Splits the run into heating, isothermal and cooling segments (see detect_segments; keyword arguments are passed to it), also splitting at the recorded gas switches. The result is stored in segments: a DataFrame indexed by an IntervalIndex of time with the kind, gas and statistics (see segment_statistics) of every segment."""
+        starts, kinds = self._segment_starts(time, temperature, **kwargs)
+        table = segment_statistics(starts, self.data_array[time], self.data_array[temperature], self.data_array[weight])
+        table.insert(0, 'kind', kinds)
+        table.insert(1, 'gas', self.gas_at(starts))
+        table.insert(2, 'first row', starts)
+        # Intervals are closed on the left; the last one reaches just past the last time so that every sample is in a segment
+        ends = np.append(table['start'].values[1:], np.nextafter(table['end'].values[-1], np.inf))
+        table.index = pd.IntervalIndex.from_arrays(table['start'].values, ends, closed='left', name=self.signal[time])
+        self.segments = table
+        return table
+    
+    def segment_at(self, time):
+        """Returns the row of segments (found with find_segments) holding a time."""
+        if self.segments is None:
+            self.find_segments()
+        return self.segments.loc[time]
     
 
 class KPFile(_DataFile):
@@ -154,9 +477,5 @@ class KPFile(_DataFile):
     def __init__(self, filename, shortname=""):
         self.filename = filename
         self.shortname = shortname
-        file = open(filename, 'r', encoding='latin-1')
-        i = 0
-        skip_line = 0
-        self.signal = []
-        # self.data_array = pd(filename, delimiter='\s', skip_header=1, autostrip=True, unpack=True)
         self.dataframe = pd.read_csv(filename, encoding='utf-16', sep='\t', skiprows=0, header=0, index_col=0)
+        self.signal = [self.dataframe.index.name] + list(self.dataframe.columns)
@@ -3,6 +3,7 @@
 
 import datetime, numpy as np, operator, pandas as pd, matplotlib.pyplot as plt
 from scipy import interpolate
+import general
 
 # Parent Classes
 class _DataFile():
@@ -21,16 +22,16 @@ class _DataFile():
         else:
             RaiseException('No dataframe found')
         if legend:
-            plt.plot(energy, signal, linewidth = 1, label=legend, color=color)
+            general.plot_downsampled(energy, signal, linewidth = 1, label=legend, color=color)
             plt.legend(loc = 2, frameon = False).draggable(True)
         elif self.shortname: 
             if legend is None:
-                plt.plot(energy, signal, linewidth = 1, color=color)
+                general.plot_downsampled(energy, signal, linewidth = 1, color=color)
             else:
-                plt.plot(energy, signal, linewidth = 1, label=self.shortname, color=color)
+                general.plot_downsampled(energy, signal, linewidth = 1, label=self.shortname, color=color)
                 plt.legend(loc = 2, frameon = False).draggable(True)
         else:
-            plt.plot(energy, signal, linewidth = 1, label='no_label', color=color)
+            general.plot_downsampled(energy, signal, linewidth = 1, label='no_label', color=color)
             plt.legend(loc = 2, frameon = False).draggable(True)
         # plt.axis([np.amin(energy), np.amax(energy), 0, np.amax(signal)*1.1])
         # plt.subplots_adjust(hspace=0, wspace=0)
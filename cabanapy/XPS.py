@@ -2,7 +2,37 @@
 #Classes and functions of XPS experiments
 """XPS data analysis for materials synthesized"""
 
-import datetime, pandas as pd, numpy as np, matplotlib.pyplot as plt
+import datetime, io, mmap, pandas as pd, numpy as np, matplotlib.pyplot as plt
+import general
+
+# Kratos exports
+kratos_marker = b'Spectra ASCII data for data set...'
+
+def index_kratos_regions(filename):
+    """Finds every region (data set) of a Kratos ASCII export in one pass over the memory-mapped file, without splitting it into lines. Each region starts with a 'Spectra ASCII data for data set...' line, which may end with the name of the region, followed by the column names and the data.
+
+    Returns a list of dicts with 'name', 'line' (line number of the marker, counting from 1), and 'start' and 'stop', the byte offsets of the column names and of the end of the region."""
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        regions = []
+        line, counted = 1, 0
+        offset = buffer.find(kratos_marker)
+        while offset != -1:
+            line += buffer[counted:offset].count(b'\n')
+            counted = offset
+            start = buffer.find(b'\n', offset) + 1 or len(buffer)
+            name = buffer[offset + len(kratos_marker):start].decode('latin-1').strip()
+            if regions:
+                regions[-1]['stop'] = offset
+            regions.append({'name': name, 'line': line, 'start': start, 'stop': len(buffer)})
+            offset = buffer.find(kratos_marker, start)
+    return regions
+
+def read_kratos_region(filename, region):
+    """Reads the data of one region found by index_kratos_regions into a DataFrame indexed by the first column, reading only its bytes."""
+    with open(filename, 'rb') as file:
+        file.seek(region['start'])
+        data = file.read(region['stop'] - region['start'])
+    return pd.read_csv(io.BytesIO(data), sep='\t', index_col=0)
 
 # Parent Classes
 class _DataFile():
@@ -46,6 +76,24 @@ class _DataFile():
         plt.xlabel(self.dataframe['Binding Energy(eV)'].name)
         plt.axis([np.amin(energy_data), np.amax(energy_data), 0, np.amax(signal_data)*1.1])
         plt.gca().invert_xaxis()
+
+    def subtract_background(self, signal='Intensity(Counts/sec)', method='shirley', **kwargs):
+        """Estimates the background of a signal against binding energy with general.background ("shirley", "linear", "tougaard", "snip", "asls" or "rolling_ball") and adds '<signal> background' and '<signal> subtracted' columns to the dataframe. Keyword arguments are passed to the method. Returns the background.
+
+        Arguments
+        ---------
+        signal : str
+            column to treat
+        method : str
+            background method
+        """
+        energy = self.dataframe['Binding Energy(eV)'].values
+        intensity = self.dataframe[signal].values
+        bg = general.background(intensity, method=method, x=energy, **kwargs)
+        self.dataframe[signal + ' background'] = bg
+        self.dataframe[signal + ' subtracted'] = intensity - bg
+        self._AddLog('{method} background subtracted from {signal}'.format(method=method, signal=signal))
+        return bg
         
 class KratosAsciiFile(_DataFile):
     """Kratos Ascii file class opening .ascii files from Kratos AXIS-165 Surface Analysis System at UIC RRC facilities. The technique is surface sensitive (less that 8nm for XPS) with a spatial resolution in X and Y of down to 30µm.
@@ -60,26 +108,49 @@ class KratosAsciiFile(_DataFile):
         Type of scan (e.g. survey, O 1s, etc.).
     header_lines : int
         Number of lines to skip when importing data from a file.
+    region : int or str
+        position or name of the region (data set) loaded into dataframe, the last one by default. Every region is available with dataset().
+    regions : list
+        regions found by index_kratos_regions, to avoid indexing the file again.
     """
 
-    def __init__(self, filename, shortname, scan_type):
+    def __init__(self, filename, shortname, scan_type, region=-1, regions=None):
         self._log = []          # Empty the log at object initialization
         self.filename = filename
         self.shortname = shortname
         self.scan_type = scan_type
         self._AddLog('Object Initialized')
 
-        # Open the file and read its contents
-        file = open(filename, 'r')
-        i=0
-        for line in file:
-            i+=1
-            if 'Spectra ASCII data for data set...' in line:
-                self.header_lines = i
-        self.dataframe = pd.read_csv(filename, sep='\t', skiprows=self.header_lines, header=self.header_lines-1, index_col=0)
-        file.close()
+        # Index the regions of the file and read one of them
+        self.regions = index_kratos_regions(filename) if regions is None else regions
+        self._datasets = {}
+        entry = self._region(region)
+        self.header_lines = entry['line']
+        self.dataframe = read_kratos_region(filename, entry)
         self._AddLog('Dataframe created')
 
+    def _region(self, region):
+        """Internal function. Returns the entry of regions at a position or with a name."""
+        if isinstance(region, str):
+            for entry in self.regions:
+                if entry['name'] == region:
+                    return entry
+            raise KeyError('No region named {0} in {1}'.format(region, self.filename))
+        return self.regions[region]
+
+    @property
+    def region_names(self):
+        """Names of the regions of the file, in order"""
+        return [entry['name'] for entry in self.regions]
+
+    def dataset(self, region, scan_type=None):
+        """Returns one region of the file (by position or name) as its own KratosAsciiFile, read on first use from its byte offsets without scanning the file again. The scan type is the region name by default."""
+        entry = self._region(region)
+        key = entry['start']
+        if key not in self._datasets:
+            self._datasets[key] = KratosAsciiFile(self.filename, self.shortname, scan_type or entry['name'] or self.scan_type, region, self.regions)
+        return self._datasets[key]
+
     def _AddLog(self, message):
         """Writes to object.log property to allow the user to observe and changes that have been made to the data since the object was initialised."""
         self._log.append('{time}:\t{message}'.format(time=datetime.datetime.now(), message=message))
@@ -4,9 +4,15 @@ import csv, os, math, xml.etree.ElementTree as ET, numpy as np
 import json
 from pprint import pprint
 import dm3_lib as tem
+import general
 from xml.etree import ElementTree
 import zipfile
 import numpy as np, pandas as pd, matplotlib.pyplot as plt
+from scipy import signal, optimize
+try:
+        import h5py
+except ImportError:
+        h5py = None
 
 # Parent Classes
 class _DataFile():
@@ -16,9 +22,54 @@ class _DataFile():
         
         def _new_source(self, old_wavelength, new_wavelength, between):
                 two_theta, intensity = self.norm_dataframe(between)
-                two_theta[:] = [2*math.degrees(np.arcsin((new_wavelength*np.sin(math.radians(x/2)))/old_wavelength)) for x in two_theta]
+                two_theta = 2*np.degrees(np.arcsin(new_wavelength*np.sin(np.radians(np.asarray(two_theta)/2))/old_wavelength))
                 return two_theta, intensity
 
+        def _pattern(self):
+                """
+                Internal function. Returns the measured 2theta and raw intensity as numpy arrays.
+                """
+                return self.dataframe.index.values, self.dataframe['intensity'].values
+
+        def _pattern_between(self, between, weights=None):
+                """
+                Internal function. Returns the 2theta, intensity and weights (None stays None) of the points between the two 2theta values of 'between', or of every point if it is empty.
+                """
+                two_theta, intensity = self._pattern()
+                if between:
+                        mask = (between[0] <= two_theta) & (two_theta <= between[1])
+                        two_theta, intensity = two_theta[mask], intensity[mask]
+                        if weights is not None:
+                                weights = np.asarray(weights, dtype=float)[mask]
+                return two_theta, intensity, weights
+
+        def subtract_background(self, method="snip", **kwargs):
+                """Estimates the background of the raw intensity with general.background (e.g. "snip", "asls" or "rolling_ball") and adds 'background' and 'subtracted_intensity' columns to the dataframe. Keyword arguments are passed to the method. Returns the background."""
+                two_theta, intensity = self._pattern()
+                bg = general.background(intensity, method=method, x=two_theta, **kwargs)
+                if isinstance(self.dataframe, pd.DataFrame):
+                        self.dataframe['background'] = bg
+                        self.dataframe['subtracted_intensity'] = intensity - bg
+                return bg
+
+        def compare(self, references, method="rwp", between=[], weights=None, **kwargs):
+                """Scores this pattern against a list of reference patterns. Weights are given for every point of the pattern and cropped with it. See compare_patterns for the available keyword arguments."""
+                two_theta, intensity, weights = self._pattern_between(between, weights)
+                return compare_patterns(two_theta, intensity, references, method=method, weights=weights, **kwargs)
+
+        def refine_scales(self, references, between=[], weights=None, **kwargs):
+                """Refines non-negative scale factors of a multi-phase mixture of references. Weights are given for every point of the pattern and cropped with it. See refine_scale_factors for the available keyword arguments."""
+                two_theta, intensity, weights = self._pattern_between(between, weights)
+                return refine_scale_factors(two_theta, intensity, references, weights=weights, **kwargs)
+
+        def export_csv(self, export_to, normalized=False):
+                """Exports the 2theta and intensity data to a comma-separated ascii file."""
+                _export_csv(*_export_arrays(self, normalized), export_to=export_to)
+
+        def export(self, export_to, fmt=None, normalized=False):
+                """Exports the pattern to export_to. See export_patterns for the available formats."""
+                export_patterns([self], export_to, fmt=fmt, normalized=normalized)
+
         def _normalize(self):
                 """
                 Internal function. Normalize the data between 0 and 100.
@@ -82,6 +133,19 @@ class _ReferenceFile():
                 plt.xlim(float(10),float(lim))
                 plt.ylim(float(0),float(110))
 
+        def bragg_law(self, d_list, wavelength):
+                """Returns an array of new 2theta values given a list of d_values and a wavelength via Braggs law"""
+                return 2*np.degrees(np.arcsin(wavelength/(2*np.asarray(d_list, dtype=float))))
+
+        def sticks(self, wavelength=None):
+                """Returns the reference line positions (2theta) and intensities as numpy arrays. If a wavelength is given, positions are recalculated from the d-spacings via bragg_law."""
+                x, y, hkl_values, h, k, l, d = self.peak_data
+                if wavelength:
+                        x = self.bragg_law(d, wavelength)
+                if len(x) != len(y):
+                        raise ValueError('{0} has {1} line positions but {2} intensities'.format(self.filename or self.shortname, len(x), len(y)))
+                return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
 
 # Object classes to open and process data files from different sources and formats
 class BM11CSVfile(_DataFile):
@@ -98,80 +162,116 @@ class BM11CSVfile(_DataFile):
         def __init__(self, filename, shortname=""):
                 self.filename = filename
                 self.shortname = shortname
-                file = open(filename, 'r')
                 self.column_index = []
-                i = 0
-                for line in file:
-                        i += 1
-                        if '2theta, intensity' in line:
-                                self.header_lines = i
-                                self.column_index = line.strip('##').split(',')                                         
-                self.dataframe = pd.read_csv(filename, sep=',', skiprows=self.header_lines, header=None, names=self.column_index, index_col=0)
+                with open(filename, 'r') as file:
+                        # Scan the header only as far as the column line, then hand the same handle to the C parser
+                        for i, line in enumerate(file, 1):
+                                if '2theta, intensity' in line:
+                                        self.header_lines = i
+                                        self.column_index = line.strip('#\n').split(',')
+                                        break
+                        data = pd.read_csv(file, sep=',', header=None, names=self.column_index, dtype=np.float64).values
+                self.two_theta = data[:, 0]
+                self.intensity = data[:, 1]
+                self.dataframe = pd.DataFrame(data[:, 1:], index=pd.Index(self.two_theta, name=self.column_index[0]), columns=self.column_index[1:], copy=False)
 
         def max_in_range(self, x, y, low, high):
                 """Finds the maximum value of y in a given range of x"""
-                data = np.vstack((x,y))         
-                y_values = data[1][np.logical_and(low < data[0], data[0] < high)]
-                x_values = data[0][np.logical_and(low < data[0], data[0] < high)]
+                mask = (low < x) & (x < high)
+                y_values = y[mask]
                 index_max_y = y_values.argmax()
-                max_y = y_values[index_max_y]
-                max_x = x_values[index_max_y]
-                return max_x, max_y
+                return x[mask][index_max_y], y_values[index_max_y]
 
-                        
-        def norm_dataframe(self, between=[]):
-                intensity = self.dataframe[' intensity'].copy()
-                two_theta = intensity.index.values.copy()
-                intensity = intensity.as_matrix().copy()
+        def normalize(self, between=[]):
+                """Returns the intensity scaled between 0 and 100 as a new array. 'between' gives a 2theta range [low, high] in which to look for the maximum."""
+                min = self.intensity.min()
                 if between == []:
-                        max = np.amax(intensity)
+                        max = self.intensity.max()
                 else:
-                        max_x, max = self.max_in_range(two_theta, intensity, between[0], between[1])
-                min = np.amin(intensity)
-                a = max-min
-                intensity[:] = [((x-min)/a) * 100 for x in intensity]
-                return two_theta, intensity
+                        max_x, max = self.max_in_range(self.two_theta, self.intensity, between[0], between[1])
+                intensity = self.intensity - min
+                intensity *= 100 / (max - min)
+                return intensity
+
+        def norm_dataframe(self, between=[]):
+                return self.two_theta, self.normalize(between)
+
+        def _pattern(self):
+                return self.two_theta, self.intensity
 
 class BrukerBrmlFile(_DataFile):
         # Taken (with permission) from https://github.com/m3wolf/scimap and edited. Thanks Mark!
-        '''Loads data from a Bruker .brml v4 file to an object'''
+        '''Loads data from a Bruker .brml v4 file to an object. With metadata_only=True only the InfoItems and ScanInformation are read and the parse stops before the data points; the full XML is parsed the first time the data is accessed.'''
+        raw_data = 'Experiment0/RawData0.xml'
 
-        def __init__(self, filename, shortname=""):
+        def __init__(self, filename, shortname="", metadata_only=False):
                 self.filename = filename
                 self.shortname = shortname
-                with zipfile.ZipFile(filename) as zf:
-                        dataFile = zf.open('Experiment0/RawData0.xml')
-                        self._dataTree = ElementTree.parse(dataFile)
-                        
+                self.metadata = {}
+                self.scan_parameters = {}
+                self._tree = None
+                self._data = None
+                if metadata_only:
+                        self._read_metadata()
+                else:
+                        self._read_metadata(self._dataTree.getroot())
+
+        @property
+        def _dataTree(self):
+                if self._tree is None:
+                        with zipfile.ZipFile(self.filename) as zf:
+                                with zf.open(self.raw_data) as dataFile:
+                                        self._tree = ElementTree.parse(dataFile)
+                return self._tree
+
+        def _read_metadata(self, root=None):
+                """
+                Internal function. Collects InfoItems and ScanInformation from a parsed tree or, if none is given, by incrementally parsing the archive until the first Datum once both have been found.
+                """
+                if root is not None:
+                        for element in root.iter('InfoItem'):
+                                self.metadata[element.get('Name')] = element.get('Value')
+                        scan = root.find('.//ScanInformation')
+                        if scan is not None:
+                                self.scan_parameters = _scan_parameters(scan)
+                        return
+                with zipfile.ZipFile(self.filename) as zf:
+                        with zf.open(self.raw_data) as dataFile:
+                                for event, element in ElementTree.iterparse(dataFile, events=('end',)):
+                                        if element.tag == 'InfoItem':
+                                                self.metadata[element.get('Name')] = element.get('Value')
+                                        elif element.tag == 'ScanInformation':
+                                                self.scan_parameters = _scan_parameters(element)
+                                        elif element.tag == 'Datum':
+                                                if 'SampleName' in self.metadata and self.scan_parameters:
+                                                        break
+                                                element.clear()
+
         @property
         def sample_name(self):
-                nameElement = self._dataTree.find('.//InfoItem[@Name="SampleName"]')
-                name = nameElement.get('Value')
-                return name
+                return self.metadata.get('SampleName')
 
         @property
         def dataframe(self): #Used by other functions
-                index = []
-                countsList = []
-                # Find all Datum entries in data tree
-                data = self._dataTree.findall('.//Datum')
-                for datum in data:
-                        time, num, two_theta, theta, counts = datum.text.split(',')
-                        index.append(float(two_theta))
-                        countsList.append(int(counts))
-                return index, countsList
+                if self._data is None:
+                        # Decode every Datum ("time,num,2theta,theta,counts") in one call
+                        rows = [datum.text for datum in self._dataTree.iterfind('.//Datum')]
+                        values = np.array(','.join(rows).split(','), dtype=float).reshape(len(rows), -1) if rows else np.empty((0, 5))
+                        self._data = values[:, 2], values[:, -1]
+                return self._data
                 # # Build pandas DataFrame
                 # df = pd.DataFrame(countsList, index=index, columns=['counts'])
                 # df.index.name = 'two_theta'
                 # return df 
-        
+
+        def _pattern(self):
+                return self.dataframe
+
         def norm_dataframe(self, between):
                 two_theta, intensity = self.dataframe
                 max = np.amax(intensity)
                 min = np.amin(intensity)
-                a = max-min
-                intensity[:] = [((x-min)/a) * 100 for x in intensity]
-                return two_theta, intensity
+                return two_theta, (intensity - min)*(100/(max - min))
                 
 class XYFile(_DataFile):
         '''Class that imports data from ASCII .xy file to an object'''
@@ -225,6 +325,9 @@ class ICDDXmlFile(_ReferenceFile):
                 self.filename = filename
                 tree = ET.parse(filename)
                 root = tree.getroot()
+                # Kept so that peak_data does not parse the file again
+                self._root = root
+                self._peak_data = {}
                 formula = root.find('.//chemical_formula')
                 self.shortname = formula.text
                 try:
@@ -245,9 +348,15 @@ class ICDDXmlFile(_ReferenceFile):
         
         @property               # Now Legacy
         def peak_data(self):#Used by other functions
-                tree = ET.parse(self.filename)
-                root = tree.getroot()
+                """Line positions, intensities, hkl labels, h, k, l and d-spacings, read once per flavour from the XML parsed by __init__."""
+                if self.flavour not in self._peak_data:
+                        self._peak_data[self.flavour] = self._read_peak_data(self._root)
+                return self._peak_data[self.flavour]
 
+        def _read_peak_data(self, root):
+                """
+                Internal function. Reads the peak data of peak_data from the root of the XML tree.
+                """
                 theta_list, intensity_list, h_list, k_list, l_list, hkl_list, d_list = [],[],[],[],[],[],[]
 
                 for theta in root.findall('.//theta'):
@@ -286,13 +395,6 @@ class ICDDXmlFile(_ReferenceFile):
                 
                 return theta_list, intensity_list, hkl_list, h_list, k_list, l_list, d_list
         
-        def bragg_law(self, d_list, wavelength):
-                """Returns a list of new 2theta values given a list of d_values and a wavelength via Braggs law"""
-                new_twotheta = []
-                for d in d_list:
-                        new_twotheta.append(2*math.degrees(np.arcsin(wavelength/(2*d))))
-                return new_twotheta
-
         def plot_wavelength(self, wavelength, color="red", legend="", xtal=False, hkl=False, lim=80):
                 x, y, hkl_values, h, k, l, d = self.peak_data
 
@@ -348,11 +450,32 @@ class MaterProjJSON(_ReferenceFile):
                 json_file.close()
                 self.legend = self.mp_number    
 
+        @property
+        def peak_data(self):
+                return self.two_theta, self.amplitude, self.hkl, [], [], [], self.d_spacing
+
         def export_csv(self, export_to):
-                _export_to(self.two_theta, self.amplitude, export_to)
+                _export_csv(self.two_theta, self.amplitude, export_to)
                 
 # Internal functions
-def _export_csv(x, y, export_to):
+def _scan_parameters(element):
+        """Returns the attributes and settings of a .brml ScanInformation element as a dict. Scan axes are nested dicts keyed by AxisId."""
+        parameters = dict(element.attrib)
+        for child in element:
+                if child.tag == 'ScanAxes':
+                        for axis in child:
+                                parameters[axis.get('AxisId')] = {setting.tag: _to_number(setting.text) for setting in axis}
+                elif len(child) == 0:
+                        parameters[child.tag] = _to_number(child.text)
+        return parameters
+
+def _to_number(text):
+        try:
+                return float(text)
+        except (TypeError, ValueError):
+                return text
+
+def _export_csv(x, y, export_to, fmt='%.10g'):
         """Exports x and y data to a comma-separated ascii file.
 
         Arguments
@@ -363,13 +486,255 @@ def _export_csv(x, y, export_to):
             list of y values to be written to the second column in the .csv file
         export_to : str
             destination path to file
+        fmt : str
+            number format applied to both columns
         """
 
-        with open(export_to, 'w', newline='') as e:
-                writer = csv.writer(e, delimiter=',')
-                for i in range (0, len(x)):
-                        writer.writerow([x[i], y[i]])
-        
+        np.savetxt(export_to, np.column_stack((x, y)), fmt=fmt, delimiter=',')
+
+def _export_arrays(pattern, normalized=False):
+        """Internal function. Returns (two_theta, intensity) arrays for a measured pattern, a reference file or an (x, y) pair."""
+        if isinstance(pattern, _DataFile):
+                two_theta, intensity = pattern._pattern()
+        elif isinstance(pattern, _ReferenceFile):
+                two_theta, intensity = pattern.sticks()
+        else:
+                two_theta, intensity = np.asarray(pattern[0], dtype=float), np.asarray(pattern[1], dtype=float)
+        if normalized:
+                min = intensity.min()
+                intensity = (intensity - min)*(100/(intensity.max() - min))
+        return two_theta, intensity
+
+def _export_name(pattern, i):
+        name = getattr(pattern, 'shortname', '') or getattr(pattern, 'legend', '') or os.path.splitext(os.path.basename(getattr(pattern, 'filename', '')))[0]
+        return name or 'pattern_{0:04d}'.format(i)
+
+# Whole-pattern comparison
+def _reference_arrays(reference, wavelength=None):
+        """Internal function. Returns (two_theta, intensity) arrays for a reference file object or an (x, y) pair."""
+        if isinstance(reference, _ReferenceFile):
+                return reference.sticks(wavelength)
+        if wavelength:
+                raise ValueError('A wavelength conversion needs d-spacings; pass an ICDDXmlFile or MaterProjJSON object')
+        x, y = reference
+        if len(x) != len(y):
+                raise ValueError('A reference has {0} line positions but {1} intensities'.format(len(x), len(y)))
+        return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+def _reference_names(references):
+        names = []
+        for i, reference in enumerate(references):
+                if isinstance(reference, _ReferenceFile):
+                        names.append(reference.legend or reference.shortname or reference.filename)
+                else:
+                        names.append(i)
+        return names
+
+def pseudo_voigt(x, fwhm, eta=0.5):
+        """Returns a pseudo-Voigt profile of unit height centred on x=0. 'eta' is the Lorentzian fraction."""
+        x2 = (2*np.asarray(x, dtype=float)/fwhm)**2
+        return eta/(1 + x2) + (1 - eta)*np.exp(-np.log(2)*x2)
+
+def simulate_patterns(two_theta, references, fwhm=0.1, eta=0.5, wavelength=None):
+        """Broadens the stick patterns of many references into pseudo-Voigt profiles on a measured 2theta grid.
+
+        Arguments
+        ---------
+        two_theta : numpy.array
+            ascending 2theta values of the measured pattern
+        references : list
+            ICDDXmlFile/MaterProjJSON objects or (two_theta, intensity) pairs
+        fwhm : float
+            full width at half maximum of the peak profile in degrees 2theta
+        eta : float
+            Lorentzian fraction of the pseudo-Voigt profile
+        wavelength : float
+            if given, stick positions are recalculated from the reference d-spacings with bragg_law
+
+        Returns an array of shape (len(references), len(two_theta)). All sticks are binned onto a uniform grid and broadened with one FFT convolution.
+        """
+        two_theta = np.asarray(two_theta, dtype=float)
+        step = np.median(np.diff(two_theta))
+        n = int(round((two_theta[-1] - two_theta[0])/step)) + 1
+        grid = two_theta[0] + step*np.arange(n)
+        # Collect the sticks of every reference with a row number
+        positions, heights, rows = [], [], []
+        for row, reference in enumerate(references):
+                x, y = _reference_arrays(reference, wavelength)
+                positions.append(x)
+                heights.append(y)
+                rows.append(np.full(len(x), row))
+        positions, heights, rows = np.concatenate(positions), np.concatenate(heights), np.concatenate(rows)
+        # Split each stick linearly between its two neighbouring grid points
+        f = (positions - grid[0])/step
+        keep = np.isfinite(f) & (f >= 0) & (f < n - 1)
+        f, heights, rows = f[keep], heights[keep], rows[keep]
+        i0 = np.floor(f).astype(int)
+        w1 = f - i0
+        flat = rows*n + i0
+        size = len(references)*n
+        sticks = np.bincount(flat, weights=heights*(1 - w1), minlength=size) + np.bincount(flat + 1, weights=heights*w1, minlength=size)
+        sticks = sticks.reshape(len(references), n)
+        half_width = min(int(np.ceil(10*fwhm/step)), n)
+        kernel = pseudo_voigt(step*np.arange(-half_width, half_width + 1), fwhm, eta)
+        profiles = signal.fftconvolve(sticks, kernel[np.newaxis, :], mode='same', axes=1)
+        if n != len(two_theta) or not np.allclose(grid, two_theta, atol=step*1e-3):
+                # Irregular measured grid: interpolate every profile back in one step
+                index = np.clip(np.searchsorted(grid, two_theta), 1, n - 1)
+                t = (two_theta - grid[index - 1])/step
+                profiles = profiles[:, index - 1]*(1 - t) + profiles[:, index]*t
+        return profiles
+
+def _poisson_weights(intensity):
+        return 1/np.maximum(intensity, 1)
+
+def compare_patterns(two_theta, intensity, references, method="rwp", fwhm=0.1, eta=0.5, wavelength=None, weights=None):
+        """Scores a measured pattern against many reference patterns at once.
+
+        Arguments
+        ---------
+        two_theta : numpy.array
+            ascending 2theta values of the measured pattern
+        intensity : numpy.array
+            measured (ideally background-subtracted) intensity
+        references : list
+            ICDDXmlFile/MaterProjJSON objects or (two_theta, intensity) pairs
+        method : str
+            "rwp" for the weighted profile R-factor after an optimal scale factor (lower is better) or "correlation" for the Pearson cross-correlation (higher is better)
+        weights : numpy.array
+            statistical weights for "rwp", defaults to 1/intensity
+
+        Returns a pandas.Series of scores indexed by reference legend.
+        """
+        intensity = np.asarray(intensity, dtype=float)
+        profiles = simulate_patterns(two_theta, references, fwhm=fwhm, eta=eta, wavelength=wavelength)
+        if method == "rwp":
+                w = _poisson_weights(intensity) if weights is None else np.asarray(weights, dtype=float)
+                wy = w*intensity
+                num = profiles.dot(wy)
+                den = (profiles**2).dot(w)
+                den[den == 0] = np.inf
+                score = np.sqrt(np.clip(1 - num**2/(den*wy.dot(intensity)), 0, 1))
+        elif method == "correlation":
+                y = intensity - intensity.mean()
+                c = profiles - profiles.mean(axis=1, keepdims=True)
+                norm = np.linalg.norm(c, axis=1)*np.linalg.norm(y)
+                norm[norm == 0] = np.inf
+                score = c.dot(y)/norm
+        else:
+                raise ValueError('method must be "rwp" or "correlation"')
+        return pd.Series(score, index=_reference_names(references), name=method)
+
+def refine_scale_factors(two_theta, intensity, references, fwhm=0.1, eta=0.5, wavelength=None, weights=None):
+        """Refines non-negative scale factors of a multi-phase mixture of references by weighted non-negative least squares.
+
+        'intensity' may be a single pattern or a 2D array of patterns (one per row) sharing the same 2theta grid; the reference profiles are simulated once for the whole batch. Returns a pandas.DataFrame with one row per pattern, one column of scale factors per reference and the resulting 'Rwp'.
+        """
+        intensity = np.atleast_2d(np.asarray(intensity, dtype=float))
+        profiles = simulate_patterns(two_theta, references, fwhm=fwhm, eta=eta, wavelength=wavelength)
+        scales = np.zeros((len(intensity), len(references)))
+        rwp = np.zeros(len(intensity))
+        for i, y in enumerate(intensity):
+                w = np.sqrt(_poisson_weights(y) if weights is None else np.asarray(weights, dtype=float))
+                scales[i], residual = optimize.nnls(profiles.T*w[:, np.newaxis], y*w)
+                rwp[i] = residual/np.linalg.norm(y*w)
+        result = pd.DataFrame(scales, columns=_reference_names(references))
+        result['Rwp'] = rwp
+        return result
+
+# Bulk export
+class PatternWriter():
+        """Streams XRD patterns to disk one at a time so long series never have to be held in memory together.
+
+        Arguments
+        ---------
+        export_to : str
+            destination. A directory for "xy", "csv" and "npy" (one file per pattern) or a single .npz or .h5 file
+        fmt : str
+            "xy", "csv", "npy", "npz" or "h5" (requires the optional h5py package). Inferred from the export_to extension if not given
+        chunk_size : int
+            chunk length of the compressed HDF5 datasets
+        number_format : str
+            number format of the ascii formats
+        """
+        formats = ['xy', 'csv', 'npy', 'npz', 'h5']
+
+        def __init__(self, export_to, fmt=None, chunk_size=4096, number_format='%.10g'):
+                if fmt is None:
+                        fmt = os.path.splitext(export_to)[1].lstrip('.').lower().replace('hdf5', 'h5')
+                if fmt not in self.formats:
+                        raise ValueError('fmt must be one of ' + ', '.join(self.formats))
+                self.export_to = export_to
+                self.fmt = fmt
+                self.chunk_size = chunk_size
+                self.number_format = number_format
+                self.names = []
+                self._zip = None
+                self._h5 = None
+                if fmt == 'npz':
+                        self._zip = zipfile.ZipFile(export_to, 'w', zipfile.ZIP_STORED, allowZip64=True)
+                elif fmt == 'h5':
+                        if h5py is None:
+                                raise ImportError('Exporting to HDF5 requires the h5py package (pip install h5py). The "npz" format needs no extra package')
+                        self._h5 = h5py.File(export_to, 'w')
+                else:
+                        os.makedirs(export_to, exist_ok=True)
+
+        def _unique(self, name):
+                name = str(name).replace('/', '_')
+                unique, i = name, 1
+                while unique in self.names:
+                        unique = '{0}_{1}'.format(name, i)
+                        i += 1
+                self.names.append(unique)
+                return unique
+
+        def write(self, two_theta, intensity, name, attrs={}):
+                """Writes one pattern. 'attrs' are stored as HDF5 attributes and ignored by the other formats."""
+                name = self._unique(name)
+                two_theta = np.asarray(two_theta, dtype=float)
+                intensity = np.asarray(intensity, dtype=float)
+                if self.fmt == 'h5':
+                        group = self._h5.create_group(name)
+                        chunks = (min(self.chunk_size, max(len(two_theta), 1)),)
+                        group.create_dataset('two_theta', data=two_theta, chunks=chunks, compression='gzip', shuffle=True)
+                        group.create_dataset('intensity', data=intensity, chunks=chunks, compression='gzip', shuffle=True)
+                        for key, value in attrs.items():
+                                group.attrs[key] = value
+                elif self.fmt == 'npz':
+                        with self._zip.open(name + '.npy', 'w', force_zip64=True) as member:
+                                np.lib.format.write_array(member, np.vstack((two_theta, intensity)))
+                elif self.fmt == 'npy':
+                        np.save(os.path.join(self.export_to, name + '.npy'), np.vstack((two_theta, intensity)))
+                elif self.fmt == 'csv':
+                        _export_csv(two_theta, intensity, os.path.join(self.export_to, name + '.csv'), fmt=self.number_format)
+                else:
+                        # XYFile reads the first line as a header
+                        np.savetxt(os.path.join(self.export_to, name + '.xy'), np.column_stack((two_theta, intensity)), fmt=self.number_format, delimiter=' ', header='two_theta intensity', comments='')
+
+        def close(self):
+                if self._zip is not None:
+                        self._zip.close()
+                if self._h5 is not None:
+                        self._h5.close()
+
+        def __enter__(self):
+                return self
+
+        def __exit__(self, *args):
+                self.close()
+
+def export_patterns(patterns, export_to, fmt=None, normalized=False, **kwargs):
+        """Exports many measured and reference patterns at once. 'patterns' may be any iterable (including a generator) of XRD file objects or (two_theta, intensity) pairs; each pattern is written as soon as it is produced. See PatternWriter for the formats and keyword arguments. Returns the names the patterns were written under."""
+        with PatternWriter(export_to, fmt=fmt, **kwargs) as writer:
+                for i, pattern in enumerate(patterns):
+                        two_theta, intensity = _export_arrays(pattern, normalized)
+                        attrs = {'kind': 'reference' if isinstance(pattern, _ReferenceFile) else 'measured'}
+                        if getattr(pattern, 'filename', ''):
+                                attrs['filename'] = pattern.filename
+                        writer.write(two_theta, intensity, _export_name(pattern, i), attrs)
+        return writer.names
+
 # Legacy functions
 def retro_plot_xrd(filename, color="red", legend="", number_of_stacked=0):
         #normalize_xrd(filename)
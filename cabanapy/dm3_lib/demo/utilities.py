@@ -22,14 +22,10 @@ def calcDisplayRange(imdata, cutoff=.1, bins_=512):
         bb = bins_[:-1]    # 'bins' == bin_edges
        # number of pixels
     Npx = np.sum(hh)
-    # calc. lower limit : 
-    i = 1
-    while np.sum( hh[:i] ) < Npx*cutoff/100.:
-        i += 1
+    # calc. lower limit from the cumulative histogram : 
+    i = np.searchsorted( np.cumsum(hh), Npx*cutoff/100. ) + 1
     cut0 = round( bb[i] )
     # calc. higher limit
-    j = 1
-    while np.sum( hh[-j:] ) < Npx*cutoff/100.:
-        j += 1
+    j = np.searchsorted( np.cumsum(hh[::-1]), Npx*cutoff/100. ) + 1
     cut1 = round( bb[-j] )
     return cut0,cut1
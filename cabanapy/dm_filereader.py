@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Reader for Gatan DigitalMicrograph DM3 and DM4 files that parses the tag tree without loading pixel data.
+
+The tag tree is walked once. Large arrays (image data, thumbnails, spectra) are not read; their file offset, dtype and element count are recorded instead, so that images can be exposed as read-only numpy.memmap views. Cropping, binning or histogramming a region of a memory-mapped image only reads the pages that region touches.
+
+Tag names follow dm3_lib: a flat dict keyed by the dotted tag path starting at 'root', with unnamed tags numbered by their position in the group (e.g. 'root.ImageList.1.ImageData.Calibrations.Dimension.0.Scale').
+"""
+
+import struct
+import numpy as np
+
+# Encoded tag data types -> numpy type codes
+encoded_types = {
+    2: 'i2',    # short
+    3: 'i4',    # long
+    4: 'u2',    # unsigned short
+    5: 'u4',    # unsigned long
+    6: 'f4',    # float
+    7: 'f8',    # double
+    8: 'u1',    # bool
+    9: 'i1',    # char
+    10: 'u1',   # octet
+    11: 'i8',   # long long (DM4)
+    12: 'u8',   # unsigned long long (DM4)
+}
+STRUCT, STRING, ARRAY = 15, 18, 20
+
+# ImageData.DataType -> numpy type codes
+image_types = {
+    1: 'i2',
+    2: 'f4',
+    3: 'c8',
+    6: 'u1',
+    7: 'i4',
+    8: 'u4',    # RGB
+    9: 'i1',
+    10: 'u2',
+    11: 'u4',
+    12: 'f8',
+    13: 'c16',
+    14: 'u1',   # binary
+    23: 'u4',   # RGBA
+    39: 'i8',
+    40: 'u8',
+}
+
+
+class ArrayRef(object):
+    """Location of an array in the file that was not read while parsing the tags."""
+
+    def __init__(self, offset, dtype, count):
+        self.offset = offset
+        self.dtype = dtype
+        self.count = count
+
+    @property
+    def nbytes(self):
+        return self.dtype.itemsize*self.count
+
+    def __repr__(self):
+        return 'ArrayRef(offset={0}, dtype={1}, count={2})'.format(self.offset, self.dtype, self.count)
+
+
+class DMReader(object):
+    """Parses the tag tree of a DM3 or DM4 file.
+
+    Arguments
+    ---------
+    filename : str
+        Name of the file you wish to import.
+    max_array : int
+        Arrays with more elements than this are recorded as ArrayRef instead of being read.
+    """
+
+    def __init__(self, filename, max_array=1024):
+        self.filename = filename
+        self.max_array = max_array
+        self.tags = {}
+        self.images = []
+        with open(filename, 'rb') as self._f:
+            self.version = self._unpack('>i')
+            if self.version not in (3, 4):
+                raise ValueError('{0} is not a DM3 or DM4 file (version {1})'.format(filename, self.version))
+            # Tag headers are always big endian; values use the byte order given in the file header
+            self._len = '>q' if self.version == 4 else '>i'
+            self.file_size = self._unpack(self._len)
+            self.little_endian = self._unpack('>i') == 1
+            self._order = '<' if self.little_endian else '>'
+            self._read_group('root')
+        del self._f
+        self._find_images()
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._f.read(struct.calcsize(fmt)))[0]
+
+    def _read_group(self, path):
+        self._f.read(2)                         # sorted, open
+        for i in range(self._unpack(self._len)):
+            tag_type = self._unpack('>B')
+            if tag_type == 0:                   # end of file
+                break
+            label = self._f.read(self._unpack('>H')).decode('latin-1') or str(i)
+            if self.version == 4:
+                self._unpack('>q')              # tag size
+            if tag_type == 20:
+                self._read_group(path + '.' + label)
+            elif tag_type == 21:
+                self._read_data(path + '.' + label)
+            else:
+                raise ValueError('Unknown tag type {0} at {1} in {2}'.format(tag_type, path, self.filename))
+
+    def _dtype(self, code):
+        return np.dtype(encoded_types[code]).newbyteorder(self._order)
+
+    def _read_data(self, path):
+        if self._f.read(4) != b'%%%%':
+            raise ValueError('Corrupt tag {0} in {1}'.format(path, self.filename))
+        info = [self._unpack(self._len) for i in range(self._unpack(self._len))]
+        kind = info[0]
+        if kind in encoded_types:
+            dtype = self._dtype(kind)
+            self.tags[path] = np.frombuffer(self._f.read(dtype.itemsize), dtype)[0].item()
+        elif kind == STRING:
+            self.tags[path] = self._f.read(2*info[1]).decode('utf-16-le' if self.little_endian else 'utf-16-be', 'replace')
+        elif kind == STRUCT:
+            fields = [self._dtype(code) for code in info[4::2][:info[2]]]
+            self.tags[path] = tuple(np.frombuffer(self._f.read(field.itemsize), field)[0].item() for field in fields)
+        elif kind == ARRAY:
+            if info[1] == STRUCT:
+                fields = [self._dtype(code) for code in info[5:-1:2][:info[3]]]
+                dtype = np.dtype([('f{0}'.format(i), field) for i, field in enumerate(fields)])
+            else:
+                dtype = self._dtype(info[1])
+            count = info[-1]
+            offset = self._f.tell()
+            if count > self.max_array:
+                self.tags[path] = ArrayRef(offset, dtype, count)
+                self._f.seek(dtype.itemsize*count, 1)
+            else:
+                values = np.frombuffer(self._f.read(dtype.itemsize*count), dtype)
+                if info[1] == 4 and not path.endswith('.Data'):
+                    # Arrays of unsigned shorts hold UTF-16 text (units, names)
+                    values = values.astype('<u2').tobytes().decode('utf-16-le', 'replace')
+                self.tags[path] = values
+        else:
+            raise ValueError('Unknown data type {0} at {1} in {2}'.format(kind, path, self.filename))
+
+    def _find_images(self):
+        """Internal function. Records offset, dtype and shape of every ImageList entry."""
+        i = 0
+        while 'root.ImageList.{0}.ImageData.DataType'.format(i) in self.tags:
+            base = 'root.ImageList.{0}.ImageData.'.format(i)
+            data = self.tags.get(base + 'Data')
+            dims = []
+            j = 0
+            while base + 'Dimensions.{0}'.format(j) in self.tags:
+                dims.append(int(self.tags[base + 'Dimensions.{0}'.format(j)]))
+                j += 1
+            code = image_types.get(self.tags[base + 'DataType'])
+            if isinstance(data, ArrayRef):
+                dtype = np.dtype(code).newbyteorder(self._order) if code else data.dtype
+                offset, nbytes = data.offset, data.nbytes
+            else:
+                dtype = np.dtype(code).newbyteorder(self._order) if code else None
+                offset, nbytes = None, 0 if data is None else data.nbytes
+            self.images.append({'index': i, 'offset': offset, 'dtype': dtype, 'shape': tuple(dims[::-1]), 'nbytes': nbytes})
+            i += 1
+
+    def _image(self, index):
+        if not self.images:
+            raise ValueError('No image data in ' + self.filename)
+        return self.images[index]
+
+    def imagedata(self, index=-1):
+        """Returns image data as a read-only numpy.memmap of shape (..., y, x). The last image in the ImageList (the main image, the first is usually the thumbnail) is returned by default."""
+        image = self._image(index)
+        if image['offset'] is None:
+            # Small images are read with the tags
+            values = self.tags['root.ImageList.{0}.ImageData.Data'.format(image['index'])]
+            if image['dtype'] is not None:
+                values = np.frombuffer(values.tobytes(), image['dtype'])
+            return values.reshape(image['shape'])
+        return np.memmap(self.filename, dtype=image['dtype'], mode='r', offset=image['offset'], shape=image['shape'])
+
+    def _tag(self, name, index=-1, default=None):
+        return self.tags.get('root.ImageList.{0}.{1}'.format(self._image(index)['index'], name), default)
+
+    @property
+    def pxsize(self):
+        """Returns pixel size and unit (as bytes, like dm3_lib) of the main image."""
+        scale = self._tag('ImageData.Calibrations.Dimension.0.Scale', default=1.)
+        units = self._tag('ImageData.Calibrations.Dimension.0.Units', default='')
+        return scale, units.encode('latin-1', 'replace')
+
+    @property
+    def contrastlimits(self):
+        """Returns display range (cuts) stored in the file, or None if absent."""
+        low = self.tags.get('root.DocumentObjectList.0.ImageDisplayInfo.LowLimit')
+        high = self.tags.get('root.DocumentObjectList.0.ImageDisplayInfo.HighLimit')
+        if low is None or high is None:
+            return None
+        return low, high
+
+    cuts = contrastlimits
+
+    @property
+    def info(self):
+        """Returns a dict of common acquisition metadata of the main image."""
+        keys = {
+            'acq_date': 'ImageTags.DataBar.Acquisition Date',
+            'acq_time': 'ImageTags.DataBar.Acquisition Time',
+            'name': 'Name',
+            'micro': 'ImageTags.Microscope Info.Name',
+            'hv': 'ImageTags.Microscope Info.Voltage',
+            'mag': 'ImageTags.Microscope Info.Indicated Magnification',
+            'mode': 'ImageTags.Microscope Info.Operation Mode',
+            'operator': 'ImageTags.Microscope Info.Operator',
+            'specimen': 'ImageTags.Microscope Info.Specimen',
+        }
+        info = {}
+        for key, name in keys.items():
+            value = self._tag(name)
+            if value is not None:
+                info[key] = value
+        return info
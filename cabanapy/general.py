@@ -1,6 +1,7 @@
 # General functions applicable to all techniques
-import numpy as np
-from scipy import interpolate
+import numpy as np, matplotlib.pyplot as plt
+from scipy import interpolate, ndimage, sparse
+from scipy.sparse import linalg as splinalg
 
 def yforx(x, xdata, ydata): #Used by other functions
     """Sorts xdata into ascending order (required by splrep) and solves y (as fa) for a value of x. Also returns spl to allow for further calculations to take place quicker. Used by other functions.
@@ -39,3 +40,295 @@ def max_in_range(dataframe, dataframe_index, low, high):
     max_y = y_values[index_max_y]
     max_x = x_values[index_max_y]
     return max_x, max_y
+
+# Background estimation. Every function accepts a single spectrum or a stack of spectra (one per row) and returns a background of the same shape.
+def rolling_ball(y, radius=50, smooth=None):
+    """Rolling-ball background (Kneen and Annegarn): a minimum then maximum filter of width 2*radius+1 points followed by a moving average of width 'smooth' (defaults to the same width).
+
+    Arguments
+    ---------
+    y : numpy.array
+        spectrum or stack of spectra (one per row)
+    radius : int
+        half width of the ball in data points. Should be wider than the broadest peak
+    smooth : int
+        width of the moving average applied to the rolled envelope
+    """
+    y = np.asarray(y, dtype=float)
+    size = (1,)*(y.ndim - 1) + (2*int(radius) + 1,)
+    bg = ndimage.grey_opening(y, size=size, mode='nearest')
+    bg = ndimage.uniform_filter1d(bg, size=smooth or size[-1], axis=-1, mode='nearest')
+    return np.minimum(bg, y)
+
+def asls(y, lam=1e5, p=0.01, niter=10):
+    """Asymmetric least squares background (Eilers and Boelens). A stack of spectra is solved as one block-diagonal sparse system per iteration.
+
+    Arguments
+    ---------
+    y : numpy.array
+        spectrum or stack of spectra (one per row)
+    lam : float
+        smoothness penalty. Larger values give stiffer backgrounds
+    p : float
+        asymmetry, the weight given to points above the background
+    niter : int
+        maximum number of reweighting iterations
+    """
+    if niter < 1:
+        raise ValueError('niter must be at least 1')
+    y = np.asarray(y, dtype=float)
+    stack = np.atleast_2d(y)
+    m, n = stack.shape
+    D = sparse.diags([1., -2., 1.], [0, 1, 2], shape=(n - 2, n))
+    H = sparse.kron(sparse.identity(m), lam*D.T.dot(D), format='csc')
+    flat = stack.ravel()
+    w = np.ones(m*n)
+    for i in range(niter):
+        z = splinalg.spsolve(sparse.diags(w, format='csc') + H, w*flat)
+        new_w = np.where(flat > z, p, 1 - p)
+        if np.array_equal(new_w, w):
+            break
+        w = new_w
+    return z.reshape(y.shape)
+
+def snip(y, iterations=40, lls=True):
+    """Statistics-sensitive non-linear iterative peak-clipping (SNIP) background (Ryan et al., Morhac). Clipping windows grow from 1 to 'iterations' points and are applied to the whole stack at once.
+
+    Arguments
+    ---------
+    y : numpy.array
+        spectrum or stack of spectra (one per row)
+    iterations : int
+        largest clipping half width in data points. Should be about the width of the broadest peak
+    lls : bool
+        apply the log-log-square root operator to compress the dynamic range before clipping
+    """
+    y = np.asarray(y, dtype=float)
+    v = np.log(np.log(np.sqrt(np.clip(y, 0, None) + 1) + 1) + 1) if lls else y.copy()
+    n = y.shape[-1]
+    mean = np.empty_like(v)
+    for k in range(1, min(int(iterations), (n - 1)//2) + 1):
+        # In place, into one buffer: stacks of spectra are large
+        out = mean[..., :n - 2*k]
+        np.add(v[..., :-2*k], v[..., 2*k:], out=out)
+        out *= 0.5
+        np.minimum(v[..., k:-k], out, out=v[..., k:-k])
+    if lls:
+        v = (np.exp(np.exp(v) - 1) - 1)**2 - 1
+    return v
+
+def _end_points(y, average):
+    return y[..., :average].mean(axis=-1, keepdims=True), y[..., -average:].mean(axis=-1, keepdims=True)
+
+def linear_background(x, y, average=1):
+    """Straight line between the two ends of each spectrum. The end intensities are averaged over 'average' points."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    start, end = _end_points(y, average)
+    return start + (end - start)*(x - x[0])/(x[-1] - x[0])
+
+def shirley(x, y, average=1, tol=1e-6, maxit=50):
+    """Iterative Shirley background for XPS regions. The background at each point rises in proportion to the peak area on its low binding energy side and meets the spectrum at both ends, so x may be ascending or descending.
+
+    Arguments
+    ---------
+    x : numpy.array
+        binding (or kinetic) energy
+    y : numpy.array
+        spectrum or stack of spectra (one per row) sharing x
+    average : int
+        number of points averaged at each end
+    tol : float
+        convergence criterion relative to the spectrum range
+    maxit : int
+        maximum number of iterations
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    start, end = _end_points(y, average)
+    dx = np.abs(np.diff(x))
+    bg = np.broadcast_to(end, y.shape).copy()
+    scale = np.ptp(y, axis=-1, keepdims=True) + 1e-300
+    for i in range(maxit):
+        r = y - bg
+        segments = (r[..., 1:] + r[..., :-1])*dx/2
+        # Area from each point to the end of the region
+        area = np.concatenate((np.cumsum(segments[..., ::-1], axis=-1)[..., ::-1], np.zeros(y.shape[:-1] + (1,))), axis=-1)
+        total = area[..., :1].copy()      # not a view: the empty regions are set to inf below
+        total[total == 0] = np.inf
+        new_bg = end + (start - end)*area/total
+        converged = np.all(np.abs(new_bg - bg) < tol*scale)
+        bg = new_bg
+        if converged:
+            break
+    return bg
+
+def tougaard(x, y, B=2866., C=1643., fit=True):
+    """Universal Tougaard background for XPS regions with x in binding energy. Each point collects the inelastic losses of every point at lower binding energy through the kernel B*T/(C + T**2)**2, T being the energy loss in eV.
+
+    Arguments
+    ---------
+    x : numpy.array
+        binding energy
+    y : numpy.array
+        spectrum or stack of spectra (one per row) sharing x
+    B, C : float
+        universal cross section parameters (eV**2)
+    fit : bool
+        rescale B so the background meets the spectrum at the high binding energy end
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    order = np.argsort(x)
+    xs, ys = x[order], y[..., order]
+    low = ys[..., :1]
+    j = ys - low
+    T = xs[:, np.newaxis] - xs[np.newaxis, :]
+    K = np.where(T > 0, T/(C + T**2)**2, 0)*np.gradient(xs)[np.newaxis, :]
+    loss = j.dot(K.T)
+    if fit:
+        top = loss[..., -1:].copy()       # not a view: the empty regions are set to inf below
+        top[top == 0] = np.inf
+        bg = low + loss*j[..., -1:]/top
+    else:
+        bg = low + B*loss
+    out = np.empty_like(bg)
+    out[..., order] = bg
+    return out
+
+background_methods = {
+    'rolling_ball': rolling_ball,
+    'asls': asls,
+    'snip': snip,
+    'linear': linear_background,
+    'shirley': shirley,
+    'tougaard': tougaard,
+}
+
+def background(y, method='snip', x=None, **kwargs):
+    """Estimates the background of a spectrum or a stack of spectra with one of the methods in background_methods. 'x' is required by the linear, shirley and tougaard methods. Keyword arguments are passed to the method."""
+    if method not in background_methods:
+        raise ValueError('method must be one of ' + ', '.join(background_methods))
+    if method in ['linear', 'shirley', 'tougaard']:
+        if x is None:
+            raise ValueError('The ' + method + ' background needs the energy axis x')
+        return background_methods[method](x, y, **kwargs)
+    return background_methods[method](y, **kwargs)
+
+
+# Visual downsampling. Long curves are drawn with plot_downsampled, which keeps a few thousand points on screen and returns to the full data when zoomed in.
+downsample_threshold = 20000        # Curves with more points than this are downsampled by the plot methods
+def _buckets(n, n_buckets):
+    """Internal function. Edges of n_buckets buckets of nearly equal size covering the points 1 to n - 2 (the first and last points are always kept)."""
+    return np.linspace(1, n - 1, n_buckets + 1).astype(int)
+
+def _first_in_bucket(values, targets, bucket):
+    """Internal function. Index of the first point of each bucket whose value equals the target of its bucket (buckets of all-NaN values are skipped)."""
+    hits = np.flatnonzero(values == targets[bucket])
+    found, first = np.unique(bucket[hits], return_index=True)
+    return hits[first]
+
+def lttb(x, y, n_out=2000):
+    """Largest-Triangle-Three-Buckets downsampling. Returns the indices of n_out points that keep the visual shape of the curve (x, y): the first and last points, and in each of n_out - 2 buckets of consecutive points the one forming the largest triangle with the average points of the previous and next buckets.
+
+    The original algorithm uses the point selected in the previous bucket instead of its average, which makes it sequential; with averages every bucket is done at once."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = _buckets(n, n_out - 2)
+    sizes = np.diff(edges)
+    bucket = np.repeat(np.arange(n_out - 2), sizes)
+    # Average point of every bucket, with the end points as outer neighbours
+    mean_x = np.concatenate([[x[0]], np.add.reduceat(x[:-1], edges[:-1])/sizes, [x[-1]]])
+    mean_y = np.concatenate([[y[0]], np.add.reduceat(y[:-1], edges[:-1])/sizes, [y[-1]]])
+    px, py = mean_x[bucket], mean_y[bucket]
+    nx, ny = mean_x[bucket + 2], mean_y[bucket + 2]
+    xs, ys = x[1:-1], y[1:-1]
+    area = np.nan_to_num(np.abs((px - nx)*(ys - py) - (px - xs)*(ny - py)), nan=-1.)
+    best = _first_in_bucket(area, np.maximum.reduceat(area, edges[:-1] - 1), bucket)
+    return np.concatenate([[0], best + 1, [n - 1]])
+
+def minmax(y, n_out=2000):
+    """Min/max envelope downsampling. Returns the sorted indices of the smallest and largest y in each of (n_out - 2)/2 buckets of consecutive points, and of the first and last points, so that every spike and dip of the curve stays visible."""
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    n_buckets = (n_out - 2)//2
+    if n_out >= n or n_buckets < 1:
+        return np.arange(n)
+    edges = _buckets(n, n_buckets)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    ys = y[1:-1]
+    low = _first_in_bucket(ys, np.fmin.reduceat(ys, edges[:-1] - 1), bucket)
+    high = _first_in_bucket(ys, np.fmax.reduceat(ys, edges[:-1] - 1), bucket)
+    return np.unique(np.concatenate([[0], low + 1, high + 1, [n - 1]]))
+
+downsample_methods = {
+    'lttb': lambda x, y, n_out: lttb(x, y, n_out),
+    'minmax': lambda x, y, n_out: minmax(y, n_out),
+}
+
+def downsample(x, y, n_out=2000, method='lttb'):
+    """Returns the indices of at most n_out points of the curve (x, y) chosen by 'lttb' (shape preserving) or 'minmax' (envelope preserving)."""
+    if method not in downsample_methods:
+        raise ValueError('method must be one of ' + ', '.join(downsample_methods))
+    return downsample_methods[method](x, y, n_out)
+
+class DownsampledLine(object):
+    """Draws a long curve with at most n_out points and redraws it from the full data in view whenever the x limits of the axes change, so that zooming in shows the full resolution. Created by plot_downsampled.
+
+    Arguments
+    ---------
+    x, y : array
+        the full curve.
+    ax : matplotlib.axes.Axes
+        axes to draw on, the current axes by default.
+    n_out : int
+        number of points drawn.
+    method : str
+        'lttb' or 'minmax', see downsample.
+    """
+
+    def __init__(self, x, y, ax=None, n_out=2000, method='lttb', *args, **kwargs):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.n_out = n_out
+        self.method = method
+        self.ax = ax or plt.gca()
+        rows = downsample(self.x, self.y, n_out, method)
+        self.line, = self.ax.plot(self.x[rows], self.y[rows], *args, **kwargs)
+        self.line.downsampled = self            # the axes callbacks only hold weak references
+        self._view = None
+        self.ax.callbacks.connect('xlim_changed', self.update)
+
+    def visible(self, low, high):
+        """Returns the x and y to draw for the x range [low, high]: the points in range and their neighbours, downsampled when there are more than n_out, with NaN where the curve leaves the range and comes back."""
+        inside = (self.x >= low) & (self.x <= high)
+        keep = inside.copy()
+        keep[:-1] |= inside[1:]
+        keep[1:] |= inside[:-1]
+        rows = np.flatnonzero(keep)
+        if len(rows) > self.n_out:
+            rows = rows[downsample(self.x[rows], self.y[rows], self.n_out, self.method)]
+        # Points separated by points out of range belong to different passes through the range
+        passes = np.cumsum(~keep)[rows]
+        breaks = np.flatnonzero(np.diff(passes)) + 1
+        return np.insert(self.x[rows], breaks, np.nan), np.insert(self.y[rows], breaks, np.nan)
+
+    def update(self, ax=None):
+        """Replaces the drawn points with those in view. Connected to the x limits of the axes."""
+        low, high = sorted(self.ax.get_xlim())
+        if self._view == (low, high):
+            return
+        self._view = (low, high)
+        self.line.set_data(*self.visible(low, high))
+        self.ax.figure.canvas.draw_idle()
+
+def plot_downsampled(x, y, *args, threshold=None, n_out=2000, method='lttb', ax=None, **kwargs):
+    """Same as plt.plot(x, y, ...) for a single curve; curves longer than threshold points (downsample_threshold by default) are drawn through a DownsampledLine. Returns the Line2D."""
+    ax = ax or plt.gca()
+    threshold = downsample_threshold if threshold is None else threshold
+    if len(x) <= threshold:
+        return ax.plot(x, y, *args, **kwargs)[0]
+    return DownsampledLine(x, y, ax, n_out, method, *args, **kwargs).line
@@ -0,0 +1,307 @@
+"""Unit tests for EChem.py"""
+
+import unittest, sys, os, numpy as np, pandas as pd
+from unittest import mock
+
+wdir = os.path.dirname(__file__) # Find the current working directory
+sys.path.append("..")
+sys.path.append(".")
+import cabanapy.EChem as echem
+
+mpt_columns = ['mode', 'ox/red', 'error', 'time/s', 'Ewe/V', 'I/mA', '(Q-Qo)/mA.h', 'Q discharge/mA.h', 'Q charge/mA.h', 'half cycle', 'cycle number']
+
+def galvanostatic_cycles(n_cycles=3, points=50, fade=0.05):
+    """Returns the columns of a simulated galvanostatic cycling test at +/-1 mA: each cycle is a discharge from 3.5 V to 2 V then a charge back, with a capacity fading by 'fade' per cycle"""
+    rows = []
+    q, time = 0., 0.
+    for cycle in range(n_cycles):
+        capacity = 1 - fade*cycle
+        for ox_red, sign in [(0, -1), (1, 1)]:
+            dq = capacity/points
+            for i in range(points):
+                time += 3600*dq
+                q += sign*dq
+                x = (i + 1)/float(points)
+                voltage = 3.5 - 1.5*x if ox_red == 0 else 2.1 + 1.5*x
+                rows.append([1, ox_red, 0, time, voltage, sign*1., q, (i + 1)*dq if ox_red == 0 else 0, (i + 1)*dq if ox_red == 1 else 0, 2*cycle + ox_red, cycle])
+    return np.array(rows)
+
+def write_mpt(filename, data=None, channel='3', mass='10.000 mg', columns=mpt_columns, trailing_tab=False):
+    """Writes a minimal EC-Lab .mpt file, with every line ending with a tab as EC-Lab writes them if trailing_tab"""
+    data = galvanostatic_cycles() if data is None else data
+    header = [
+        'EC-Lab ASCII FILE',
+        'Nb header lines : {0}',
+        '',
+        'Galvanostatic Cycling with Potential Limitation',
+        '',
+        'Run on channel : ' + channel,
+        'Acquisition started on : 01/02/2018 10:00:00',
+        'Device : VMP3',
+        'Electrode material : NMC',
+        'Initial state : pristine',
+        'Electrolyte : LP30',
+        'Comments : synthetic',
+        'Mass of active material : ' + mass,
+        ' at x = 0.000',
+        'Molecular weight of active material (at x = 0) : 96.461 g/mol',
+        'Electrode surface area : 1.130 cm2',
+        'Ns     0',
+        'ctrl_type     CC',
+        '\t'.join(columns) + ('\t' if trailing_tab else ''),
+    ]
+    header[1] = header[1].format(len(header))
+    with open(filename, 'w', encoding='latin-1') as f:
+        f.write('\n'.join(header) + '\n')
+        np.savetxt(f, data, fmt='%.6f', delimiter='\t', newline='\t\n' if trailing_tab else '\n')
+
+def write_mpr(filename, data=None, version=3):
+    """Writes a minimal EC-Lab .mpr file holding the same columns as write_mpt"""
+    data = galvanostatic_cycles() if data is None else data
+    column_ids = [1, 2, 3, 4, 6, 8, 13, 468, 24]       # mode, ox/red, error, then as in mpt_columns
+    dtype, flags = echem.mpr_dtype(column_ids)
+    records = np.zeros(len(data), dtype)
+    records['flags'] = data[:, 0].astype(int) | data[:, 1].astype(int) << 2 | data[:, 2].astype(int) << 3
+    for name, column in [('time/s', 3), ('Ewe/V', 4), ('I/mA', 5), ('(Q-Qo)/mA.h', 6), ('half cycle', 9), ('cycle number', 10)]:
+        records[name] = data[:, column]
+    def module(name, body, version=0):
+        header = np.zeros(1, echem.mpr_module_header)
+        header['shortname'], header['longname'], header['length'], header['version'], header['date'] = name.encode().ljust(10), name.encode(), len(body), version, b'02/01/18'
+        return b'MODULE' + header.tobytes() + body
+    data_header = np.array([len(data)], '<u4').tobytes() + bytes([len(column_ids)]) + np.array(column_ids, '<u2').tobytes()
+    data_module = data_header.ljust(405 if version == 2 else 406, b'\x00') + records.tobytes()
+    settings = bytearray(0x0300)
+    settings[0x0001:0x000B] = b'\x09synthetic'
+    settings[0x0107:0x0113] = np.array([10., 0., 96.461], '<f4').tobytes()
+    settings[0x011D:0x0121] = b'\x03NMC'
+    settings[0x01C0:0x01C5] = b'\x04LP30'
+    settings[0x0211:0x0215] = np.array([1.13], '<f4').tobytes()
+    log = bytearray(64)
+    log[9] = 3
+    with open(filename, 'wb') as f:
+        f.write(echem.mpr_magic + module('VMP Set', bytes(settings)) + module('VMP data', data_module, version) + module('VMP LOG', bytes(log)))
+
+class EChem_init_tests(unittest.TestCase):
+    """Unit test to assert filetypes are loaded correctly"""
+
+    def test_MPTFile_init(self):
+        export_to = './test_data.mpt'
+        write_mpt(export_to)
+        test = echem.MPTFile(export_to, "Test Cell")
+        # Assert header values and data are read
+        self.assertEqual(test.channel, '3')
+        self.assertEqual(test.dataframe.index.name, 'mode')
+        self.assertEqual(len(test.dataframe), 300)
+        os.remove(export_to)
+
+    def test_MPTFile_streaming(self):
+        export_to = './test_data.mpt'
+        write_mpt(export_to)
+        full = echem.MPTFile(export_to, "Test Cell")
+        # Assert selected columns are downcast and read in chunks
+        test = echem.MPTFile(export_to, "Test Cell", usecols=['Ewe/V', 'cycle number'], downcast=True, chunksize=64)
+        self.assertEqual(test.dataframe.columns.tolist(), ['Ewe/V', 'cycle number'])
+        self.assertEqual(test.dataframe['Ewe/V'].dtype, np.float32)
+        self.assertEqual(test.dataframe['cycle number'].dtype, np.int32)
+        np.testing.assert_allclose(test.dataframe['Ewe/V'].values, full.dataframe['Ewe/V'].values, rtol=1e-6)
+        self.assertEqual(sum(len(chunk) for chunk in echem.iter_mpt(export_to, chunksize=100)), 300)
+        # Assert the column cache is written, then read while the file is unchanged
+        cached = echem.MPTFile(export_to, "Test Cell", cache=True)
+        self.assertTrue(os.path.exists('./test_data.npz'))
+        cached = echem.MPTFile(export_to, "Test Cell", usecols=['I/mA'], cache=True)
+        self.assertEqual(cached.dataframe.columns.tolist(), ['I/mA'])
+        pd.testing.assert_series_equal(cached.dataframe['I/mA'], full.dataframe['I/mA'])
+        self.assertIsNone(echem.read_column_cache('./test_data.npz', stamp={'size': 0}))
+        os.remove('./test_data.npz')
+        # Assert a restricted read followed by a full read gives every column, and the cache grows to the union of the columns read
+        echem.MPTFile(export_to, "Test Cell", usecols=['I/mA'], cache=True)
+        cached = echem.MPTFile(export_to, "Test Cell", usecols=['Ewe/V'], cache=True)
+        self.assertEqual(cached.dataframe.columns.tolist(), ['Ewe/V'])
+        self.assertEqual(echem.cached_columns('./test_data.npz'), ['mode', 'Ewe/V', 'I/mA'])
+        cached = echem.MPTFile(export_to, "Test Cell", cache=True)
+        pd.testing.assert_frame_equal(cached.dataframe, full.dataframe)
+        self.assertEqual(len(echem.cached_columns('./test_data.npz')), len(full.column_list))
+        # Assert text columns are left out of the cache, and unreadable caches are ignored
+        echem.write_column_cache(full.dataframe.assign(label='a'), './test_data.npz')
+        self.assertNotIn('label', echem.cached_columns('./test_data.npz'))
+        with open('./test_data.npz', 'wb') as f:
+            f.write(b'not a cache')
+        self.assertIsNone(echem.read_column_cache('./test_data.npz'))
+        os.remove('./test_data.npz')
+        # Assert the trailing tab of EC-Lab files adds no column, and the cache is hit on the next full read
+        write_mpt(export_to, trailing_tab=True)
+        cached = echem.MPTFile(export_to, "Test Cell", cache=True)
+        self.assertEqual(cached.column_list, full.column_list)
+        pd.testing.assert_frame_equal(cached.dataframe, full.dataframe)
+        self.assertEqual(echem.cached_columns('./test_data.npz'), full.column_list)
+        with mock.patch.object(echem.pd, 'read_csv', side_effect=AssertionError('the file is parsed again')):
+            cached = echem.MPTFile(export_to, "Test Cell", cache=True)
+        pd.testing.assert_frame_equal(cached.dataframe, full.dataframe)
+        os.remove('./test_data.npz')
+        os.remove(export_to)
+
+    def test_MPRFile_init(self):
+        write_mpt('./test_data.mpt')
+        expected = echem.MPTFile('./test_data.mpt', "Test Cell")
+        for version in [2, 3]:
+            export_to = './test_data.mpr'
+            write_mpr(export_to, version=version)
+            test = echem.MPRFile(export_to, "Test Cell")
+            # Assert the modules and header attributes are read
+            self.assertEqual(sorted(test.modules), ['VMP LOG', 'VMP Set', 'VMP data'])
+            self.assertEqual((test.channel, test.material, test.electrolyte, test.mass_am, test.comments), ('3', 'NMC', 'LP30', '10.000 mg', ['synthetic']))
+            # Assert columns match the text export
+            self.assertEqual(test.dataframe.index.name, 'mode')
+            for column in ['ox/red', 'error', 'time/s', 'Ewe/V', 'I/mA', '(Q-Qo)/mA.h', 'half cycle', 'cycle number']:
+                np.testing.assert_allclose(test.dataframe[column].values, expected.dataframe[column].values, rtol=1e-6, atol=1e-6)
+            self.assertEqual(test.cycle_index().half_cycle(1, 'charge'), slice(150, 200))
+            os.remove(export_to)
+        # Assert unknown columns are reported as bad input
+        self.assertRaises(ValueError, echem.mpr_dtype, [1, 9999])
+        os.remove('./test_data.mpt')
+
+class EChem_cycle_tests(unittest.TestCase):
+    """Unit tests for cycle selection"""
+
+    def test_cycle_index(self):
+        export_to = './test_data.mpt'
+        write_mpt(export_to)
+        test = echem.MPTFile(export_to, "Test Cell")
+        index = test.cycle_index()
+        # Assert cycles and half cycles are found as slices
+        self.assertEqual(index.cycles.tolist(), [0, 1, 2])
+        self.assertEqual(index.cycle(1), slice(100, 200))
+        self.assertEqual(index.half_cycle(1, 'charge'), slice(150, 200))
+        self.assertEqual(index.half_cycle(2, 'discharge'), slice(200, 250))
+        # Assert selections are views of the data
+        voltage = test.dataframe['Ewe/V'].values
+        views = index.split(voltage, half='discharge')
+        self.assertEqual(len(views), 3)
+        self.assertTrue(np.shares_memory(views[0], voltage))
+        self.assertEqual(len(test.cycle(2, half='charge')), 50)
+        # Assert rows interrupted by another cycle are still collected
+        interrupted = echem.CycleIndex(np.array([1, 1, 2, 2, 1, 3]))
+        np.testing.assert_array_equal(interrupted.cycle(1), [0, 1, 4])
+        os.remove(export_to)
+
+class EChem_analysis_tests(unittest.TestCase):
+    """Unit tests for cycling analysis"""
+
+    def test_cycle_summary(self):
+        write_mpt('./test_data.mpt')
+        write_mpr('./test_data.mpr')
+        test = echem.MPTFile('./test_data.mpt', "Test Cell")
+        summary = test.cycle_summary()
+        # Assert capacities are integrated per cycle (the first point of the file has no time step)
+        self.assertEqual(len(summary), 3)
+        np.testing.assert_allclose(summary['Q discharge/mA.h'].values[1:], [0.95, 0.90])
+        np.testing.assert_allclose(summary['Q charge/mA.h'].values, [1.0, 0.95, 0.90])
+        np.testing.assert_allclose(summary['Coulombic efficiency/%'].values[1:], [100, 100])
+        np.testing.assert_allclose(summary['Polarization/V'].values[1:], [0.13, 0.13])
+        np.testing.assert_allclose(summary['Q discharge/mA.h/g'].values[1:], [95, 90])       # 10 mg of active material
+        # Assert processed files use their counters and many cells share one table
+        processed = echem.processedMPTFile('./test_data.mpt', "Processed")
+        np.testing.assert_allclose(processed.cycle_summary()['Retention/%'].values, [100, 95, 90])
+        summaries = echem.cycle_summaries([test, echem.MPRFile('./test_data.mpr', "Binary"), processed])
+        self.assertEqual(summaries.index.names, ['cell', 'cycle'])
+        self.assertEqual(summaries.index.get_level_values('cell').unique().tolist(), ["Test Cell", "Binary", "Processed"])
+        pd.testing.assert_frame_equal(summaries.loc["Binary"], summary)
+        os.remove('./test_data.mpt')
+        os.remove('./test_data.mpr')
+
+    def test_diffcap(self):
+        export_to = './test_data.mpt'
+        write_mpt(export_to)
+        test = echem.MPTFile(export_to, "Test Cell")
+        # Assert a linear discharge from 3.5 V to 2 V gives a flat dQ/dV of capacity/1.5 V for every cycle
+        for method in ['histogram', 'savgol', 'spline']:
+            curves = test.diffcap(half='discharge', method=method, dv=0.05, vmin=2.1, vmax=3.4)
+            self.assertEqual(curves.columns.tolist(), [0, 1, 2])
+            np.testing.assert_allclose(curves.mean().values, np.array([1, 0.95, 0.9])/1.5, rtol=0.05)
+        # Assert a peak shifting by 10 mV per cycle is followed
+        grid = np.linspace(3, 4, 501)
+        dqdv = np.exp(-(grid - (3.5 + 0.01*np.arange(4)[:, None]))**2/(2*0.01**2))
+        peaks = echem.track_peaks(grid, dqdv)
+        np.testing.assert_allclose(peaks[(0, 'voltage')].values, [3.5, 3.51, 3.52, 3.53])
+        os.remove(export_to)
+    def test_plot_downsampled(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        export_to = './test_data.mpt'
+        write_mpt(export_to, galvanostatic_cycles(n_cycles=20, points=1000))
+        test = echem.MPTFile(export_to, "Test Cell")
+        # Assert long curves are drawn with fewer points, keeping both ends and the extremes
+        time, voltage = test.dataframe['time/s'].values, test.dataframe['Ewe/V'].values
+        for method in ['lttb', 'minmax']:
+            rows = echem.general.downsample(time, voltage, 500, method)
+            self.assertLessEqual(len(rows), 500)
+            self.assertEqual((rows[0], rows[-1]), (0, len(time) - 1))
+            self.assertEqual((voltage[rows].min(), voltage[rows].max()), (voltage.min(), voltage.max()))
+        fig, ax = plt.subplots()
+        test.plot('time/s', 'Ewe/V')
+        line = ax.get_lines()[0]
+        self.assertEqual(len(line.get_xdata()), 2000)
+        # Assert zooming in draws every point in view
+        ax.set_xlim(time[100], time[300])
+        self.assertEqual(np.count_nonzero(np.isfinite(line.get_xdata())), 203)
+        plt.close(fig)
+        os.remove(export_to)
+
+class EChem_impedance_tests(unittest.TestCase):
+    """Unit tests for impedance spectra"""
+
+    def test_fit_impedance(self):
+        circuit = echem.Circuit('R0-p(R1,CPE1)-W1')
+        self.assertEqual(circuit.names, ['R0', 'R1', 'CPE1 Q', 'CPE1 alpha', 'W1 sigma'])
+        self.assertRaises(ValueError, echem.Circuit, 'R0-p(R1)')
+        # Assert the analytic Jacobian matches finite differences
+        frequency = np.logspace(5, -2, 50)
+        parameters = np.array([10, 50, 1e-5, 0.85, 20])
+        Z, J = circuit.jacobian(frequency, parameters)
+        step = parameters*1e-6
+        numerical = np.array([(circuit.impedance(frequency, parameters + step*(np.arange(5) == k)) - Z)/step[k] for k in range(5)]).T
+        np.testing.assert_allclose(numerical, J, rtol=1e-4, atol=1e-6*np.abs(J).max())
+        # Assert spectra written by cycle are read back and fitted, the resistance R1 growing by 10 Ohm per cycle
+        rows = []
+        for cycle in range(3):
+            Z = circuit.impedance(frequency, parameters + [0, 10*cycle, 0, 0, 0])
+            rows += [[3, 0, 0, f, z.real, -z.imag, abs(z), cycle] for f, z in zip(frequency, Z)]
+        export_to = './test_data.mpt'
+        write_mpt(export_to, np.array(rows), columns=['mode', 'ox/red', 'error', 'freq/Hz', 'Re(Z)/Ohm', '-Im(Z)/Ohm', '|Z|/Ohm', 'cycle number'])
+        test = echem.MPTFile(export_to, "Test Cell")
+        spectra = test.impedance_spectra()
+        self.assertEqual([len(f) for f, Z in spectra], [50, 50, 50])
+        result = test.fit_impedance('R0-p(R1,CPE1)-W1', by='cycle number', processes=2)
+        self.assertEqual(result.index.tolist(), [0, 1, 2])
+        np.testing.assert_allclose(result['R1'].values, [50, 60, 70], rtol=1e-3)
+        np.testing.assert_allclose(result['CPE1 alpha'].values, 0.85, rtol=1e-3)
+        os.remove(export_to)
+
+class EChem_fleet_tests(unittest.TestCase):
+    """Unit tests for directories of cells"""
+
+    def test_CellFleet(self):
+        directory = './test_fleet'
+        os.makedirs(directory)
+        write_mpt(os.path.join(directory, 'cell_a.mpt'), channel='1')
+        write_mpt(os.path.join(directory, 'cell_b.mpt'), galvanostatic_cycles(n_cycles=2, fade=0.1), channel='2', mass='5.000 mg')
+        write_mpr(os.path.join(directory, 'cell_c.mpr'))
+        fleet = echem.CellFleet(directory)
+        # Assert headers are indexed without reading the data
+        self.assertEqual(fleet.index.index.tolist(), ['cell_a', 'cell_b', 'cell_c'])
+        self.assertEqual(fleet.index['channel'].tolist(), ['1', '2', '3'])
+        np.testing.assert_allclose(fleet.index['mass/mg'].values, [10, 5, 10])
+        self.assertEqual(fleet.index.loc['cell_a', 'date'], pd.Timestamp('2018-01-02 10:00:00'))
+        self.assertEqual(fleet._cells, {})
+        self.assertEqual(fleet.select(mass_am='10.000 mg', material='NMC'), ['cell_a', 'cell_c'])
+        # Assert capacities at one cycle are compared across cells
+        np.testing.assert_allclose(fleet.at_cycle(1, 'Q charge/mA.h').values, [0.95, 0.9, 0.95])
+        self.assertTrue(np.isnan(fleet.at_cycle([1, 2], 'Q charge/mA.h').loc['cell_b', 2]))
+        self.assertEqual(fleet['cell_b'].shortname, 'cell_b')
+        for name in fleet:
+            os.remove(fleet.index.loc[name, 'filename'])
+        os.rmdir(directory)
+
+if __name__ == '__main__':
+    unittest.main()
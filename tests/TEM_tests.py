@@ -1,12 +1,43 @@
 """Unit tests for TEM.py"""
 
-import unittest, sys, os, numpy as np, pandas as pd
+import unittest, sys, os, struct, shutil, types, numpy as np, pandas as pd
 
 wdir = os.path.dirname(__file__) # Find the current working directory
 sys.path.append("..")
 sys.path.append(".")
 import cabanapy.TEM as tem
 
+def write_dm(filename, images, version=3, limits=None):
+    """Writes a minimal DM3/DM4 file holding the given 2D images (the first one acting as thumbnail) with a 0.5 nm pixel size"""
+    n = '>q' if version == 4 else '>i'
+    def tag(label, body, kind):
+        size = struct.pack('>q', len(body)) if version == 4 else b''
+        return struct.pack('>BH', kind, len(label)) + label.encode() + size + body
+    def group(tags):
+        return struct.pack('>BB', 0, 1) + struct.pack(n, len(tags)) + b''.join(tags)
+    def value(fmt, code, x):
+        return b'%%%%' + struct.pack(n, 1) + struct.pack(n, code) + struct.pack('<' + fmt, x)
+    def array(code, data):
+        return b'%%%%' + struct.pack(n, 3) + struct.pack(n, 20) + struct.pack(n, code) + struct.pack(n, data.size) + data.tobytes()
+    image_list = []
+    for image in images:
+        units = np.frombuffer('nm'.encode('utf-16-le'), '<u2')
+        calibration = group([tag('', group([tag('Origin', value('f', 6, 0), 21), tag('Scale', value('f', 6, 0.5), 21), tag('Units', array(4, units), 21)]), 20)])
+        image_data = group([
+            tag('Calibrations', group([tag('Dimension', calibration, 20)]), 20),
+            tag('Data', array(4, image.astype('<u2')), 21),
+            tag('DataType', value('i', 3, 10), 21),
+            tag('Dimensions', group([tag('', value('i', 3, image.shape[1]), 21), tag('', value('i', 3, image.shape[0]), 21)]), 20),
+        ])
+        image_list.append(tag('', group([tag('ImageData', image_data, 20)]), 20))
+    tags = [tag('ImageList', group(image_list), 20)]
+    if limits:
+        display = group([tag('LowLimit', value('f', 6, limits[0]), 21), tag('HighLimit', value('f', 6, limits[1]), 21)])
+        tags.append(tag('DocumentObjectList', group([tag('', group([tag('ImageDisplayInfo', display, 20)]), 20)]), 20))
+    root = group(tags)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('>i', version) + struct.pack(n, len(root)) + struct.pack('>i', 1) + root + b'\x00' * 8)
+
 class TEM_init_tests(unittest.TestCase):
     """Unit test to assert filetypes are loaded correctly"""
 
@@ -46,3 +77,204 @@ class TEM_init_tests(unittest.TestCase):
                                                        ' Element Weight%',
                                                        ' K   41.80 %',
                                                        ' Fe   58.20 %'])
+
+    def test_DM3File_mmap(self):
+        thumbnail = np.arange(16).reshape(4, 4)
+        image = np.arange(80*60).reshape(60, 80) % 4096
+        for version in [3, 4]:
+            export_to = './test_data.dm{0}'.format(version)
+            write_dm(export_to, [thumbnail, image], version=version, limits=(10, 4000))
+            test = tem.DM3File(export_to, "Test Data", mmap=True)
+            # Assert the image is mapped from the file, not loaded
+            self.assertEqual(type(test.imagedata), np.memmap)
+            self.assertEqual(test.imagedata.shape, (60, 80))
+            np.testing.assert_array_equal(test.imagedata[10:20, 5:15], image[10:20, 5:15])
+            np.testing.assert_array_equal(test.thumbnaildata, thumbnail)
+            # Assert the calibration and display range are read from the tags
+            self.assertEqual(test.pxsize, (0.5, b'nm'))
+            self.assertEqual(test.contrastlimits, (10, 4000))
+            test.close()
+            os.remove(export_to)
+
+    def test_DM3File_lifecycle(self):
+        export_to = './test_data.dm3'
+        write_dm(export_to, [np.zeros((4, 4)), np.arange(60*80).reshape(60, 80)])
+        # Assert the tags are parsed once and released on close
+        test = tem.DM3File(export_to, "Test Data", mmap=True).open()
+        reader = test.reader
+        self.assertIs(test.reader, reader)
+        self.assertEqual(test.imagedata.shape, (60, 80))
+        test.close()
+        self.assertIsNone(test._dm3)
+        self.assertIsNone(test._imagedata)
+        # Assert the file is parsed again when used after close
+        self.assertIsNot(test.reader, reader)
+        self.assertEqual(test.imagedata[1, 0], 80)
+        test.close()
+        # Assert the context manager opens and closes the file
+        with tem.DM3File(export_to, "Test Data", mmap=True) as test:
+            self.assertIsNotNone(test._dm3)
+            self.assertEqual(test.pxsize, (0.5, b'nm'))
+        self.assertIsNone(test._dm3)
+        os.remove(export_to)
+
+    def test_DM3File_memory_budget(self):
+        # Readers holding 800 bytes of image data each, so that no file is parsed
+        images = [tem.DM3File('image{0}.dm3'.format(i)) for i in range(3)]
+        for i, image in enumerate(images):
+            image._dm3 = types.SimpleNamespace(imagedata=np.full((10, 10), i, dtype=float))
+        tem.DM3File.memory_budget = 1600
+        try:
+            images[0].imagedata, images[1].imagedata
+            # Assert image data within the budget is retained
+            self.assertIsNotNone(images[0]._imagedata)
+            images[0].imagedata # most recently used
+            images[2].imagedata
+            # Assert the least recently used image data is evicted once the budget is exceeded
+            self.assertIsNone(images[1]._imagedata)
+            self.assertIsNotNone(images[0]._imagedata)
+            self.assertIsNotNone(images[2]._imagedata)
+            # Assert evicted image data is decoded again on access
+            self.assertEqual(images[1].imagedata[0, 0], 1)
+            self.assertIsNone(images[0]._imagedata)
+        finally:
+            tem.DM3File.memory_budget = None
+            for image in images:
+                image.close()
+
+    def test_batch_process(self):
+        directory = './test_batch'
+        os.makedirs(directory)
+        image = np.arange(300*200).reshape(200, 300) % 1000
+        # Assert the extension is matched whatever its case
+        for name, version in [('image.dm3', 3), ('image.DM4', 4)]:
+            write_dm(os.path.join(directory, name), [image[:8, :8], image], version=version)
+        results = tem.batch_process(directory, processes=1, preview_size=100)
+        # Assert one row per file with calibrated size and written images
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results['shape'][0], [200, 300])
+        self.assertEqual(results['units'][0], 'nm')
+        self.assertNotEqual(results['preview'][0], results['preview'][1])
+        for name in ['index.html', 'index.json', results['thumbnail'][0], results['preview'][1]]:
+            self.assertTrue(os.path.exists(os.path.join(directory, 'batch', name)))
+        # Assert unchanged files are served from the cache
+        os.remove(os.path.join(directory, 'batch', 'index.html'))
+        mtime = os.path.getmtime(os.path.join(directory, 'batch', results['preview'][0]))
+        tem.batch_process(directory, processes=1, preview_size=100)
+        self.assertEqual(os.path.getmtime(os.path.join(directory, 'batch', results['preview'][0])), mtime)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'batch', 'index.html')))
+        shutil.rmtree(directory)
+
+    def test_display_range(self):
+        image = np.arange(100*100).reshape(100, 100).astype(float)
+        # Assert 1% of the pixels are cut at each end
+        low, high = tem.display_range(image, cutoff=1, method='partition')
+        self.assertEqual((low, high), (100, 9899))
+        low, high = tem.display_range(image, cutoff=1, bins=1000)
+        self.assertAlmostEqual(low, 100, delta=10)
+        self.assertAlmostEqual(high, 9899, delta=10)
+        # Assert a stack gives one range per image
+        cuts = tem.display_range(np.stack([image, 2*image]), cutoff=1, method='partition')
+        np.testing.assert_array_equal(cuts, [[100, 9899], [200, 19798]])
+
+    def test_display_limits(self):
+        image = np.arange(60*80).reshape(60, 80)
+        for limits in [(10, 4000), (5, 5)]:
+            export_to = './test_data.dm3'
+            write_dm(export_to, [image[:4, :4], image], limits=limits)
+            expected = limits if limits[0] != limits[1] else tem.display_range(image)
+            # Assert plot and batch_process use the saved limits, or the computed cuts when they are equal
+            with tem.DM3File(export_to, mmap=True) as test:
+                self.assertEqual(tuple(test.display_limits()), tuple(expected))
+            os.makedirs('./test_batch')
+            result = tem._process_micrograph(export_to, './test_batch')
+            self.assertEqual(tuple(result['cuts']), tuple(expected))
+            shutil.rmtree('./test_batch')
+            os.remove(export_to)
+
+    def test_ImagePyramid(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        image = np.arange(1000*700).reshape(700, 1000) % 4096
+        export_to = './test_data.dm4'
+        write_dm(export_to, [image[:8, :8], image], version=4)
+        test = tem.DM3File(export_to, "Test Data", mmap=True)
+        pyramid = test.pyramid(tile_size=128)
+        # Assert each level halves the image down to one tile
+        self.assertEqual([level.shape for level in pyramid.levels], [(700, 1000), (350, 500), (175, 250), (88, 125)])
+        np.testing.assert_allclose(pyramid.levels[1][3, 4], image[6:8, 8:10].mean())
+        # Assert the levels are cached and memory-mapped on reuse
+        self.assertTrue(os.path.exists(export_to + '.pyramid/meta.json'))
+        self.assertEqual(type(test.pyramid(tile_size=128).levels[2]), np.memmap)
+        # Assert regions are tile aligned
+        data, extent = pyramid.region(130, 300, 0, 100, level=0)
+        self.assertEqual(data.shape, (128, 256))
+        self.assertEqual(extent, [128, 384, 128, 0])
+        # Assert zooming in switches to a finer level and shows only the tiles in view
+        plt.figure(figsize=(4, 3))
+        test.plot(pyramid=True)
+        image_plot = plt.gca().get_images()[0]
+        self.assertEqual(image_plot.get_extent(), [0, 500, 350, 0])     # 0.5 nm pixels
+        plt.xlim(10, 40)
+        plt.ylim(40, 10)
+        self.assertEqual(image_plot.get_array().shape, (512, 512))
+        self.assertEqual(list(image_plot.get_extent()), [0, 256, 256, 0])
+        plt.close()
+        test.close()
+        shutil.rmtree(export_to + '.pyramid')
+        os.remove(export_to)
+
+    def test_ImagePyramid_small(self):
+        image = np.arange(64*48).reshape(48, 64)
+        export_to = './test_data.dm4'
+        write_dm(export_to, [image[:8, :8], image], version=4)
+        test = tem.DM3File(export_to, "Test Data", mmap=True)
+        # Assert an image that fits in one tile is a pyramid of one level, cached like any other
+        pyramid = test.pyramid()
+        self.assertEqual(len(pyramid), 1)
+        self.assertTrue(os.path.exists(export_to + '.pyramid/meta.json'))
+        self.assertEqual(len(test.pyramid()), 1)
+        test.close()
+        shutil.rmtree(export_to + '.pyramid')
+        os.remove(export_to)
+
+    def test_read_emsa_stack(self):
+        filename = wdir + "/test_data/VantageEmsaFile_sample.emsa"
+        energy, counts, metadata = tem.read_emsa_stack([filename]*3)
+        # Assert one row per spectrum and one column per channel
+        self.assertEqual(counts.shape, (3, 2047))
+        # Assert the channels are those of VantageEmsaFile
+        single = tem.VantageEmsaFile(filename, "Sample").dataframe
+        np.testing.assert_array_equal(energy, single.index.values)
+        np.testing.assert_array_equal(counts[2], single['Counts'].values)
+        self.assertEqual(metadata[0]['DATE'].strip(), '12-MAY-2017')
+
+    def test_edx_quantification(self):
+        energy = np.arange(1, 2048)*0.01
+        matrix, families = tem.edx_peak_matrix(energy, ['Fe', 'Si'])
+        # Assert one column per line family in range, each with unit area for its main line
+        self.assertEqual(families[['element', 'family']].values.tolist(), [['Fe', 'K'], ['Fe', 'L'], ['Si', 'K']])
+        self.assertAlmostEqual(matrix[:, 2].sum(), 1.13, places=2)
+        # Assert net counts are recovered from a 4 x 5 spectrum image
+        intensities = np.array([3000., 500., 1000.])*np.ones((4, 5, 3))
+        counts = intensities.dot(matrix.T) + 50 + 2*energy
+        fitted, families = tem.fit_edx(energy, counts, ['Fe', 'Si'])
+        self.assertEqual(fitted.shape, (4, 5, 3))
+        np.testing.assert_allclose(fitted, intensities, rtol=0.02)
+        # Assert Cliff-Lorimer weight fractions use the K lines and the k-factors
+        weight, atomic, elements = tem.quantify_edx(fitted, families, kfactors={'Fe': 2.})
+        self.assertEqual(elements, ['Fe', 'Si'])
+        np.testing.assert_allclose(weight[0, 0], [6000/70., 1000/70.], rtol=0.02)
+        maps = tem.edx_maps(energy, counts, ['Fe', 'Si'])
+        self.assertEqual(maps['Fe'].shape, (4, 5))
+
+    def test_VantageEmsaFile_identify_peaks(self):
+        test = tem.VantageEmsaFile(wdir + "/test_data/VantageEmsaFile_sample.emsa", "Sample")
+        peaks = test.identify_peaks()
+        # Assert the main lines picked by the Vantage software are found
+        for element, line in [('K', 'Ka'), ('Fe', 'Ka'), ('Cu', 'Ka'), ('C', 'Ka'), ('F', 'Ka'), ('Cu', 'La'), ('Cu', 'Kb'), ('Si', 'Ka')]:
+            self.assertTrue(((peaks['element'] == element) & (peaks['line'] == line)).any())
+        result = test.quantify(['K', 'Fe'])
+        self.assertEqual(result.index.tolist(), ['K', 'Fe'])
+        self.assertAlmostEqual(result['Weight%'].sum(), 100)
@@ -33,3 +33,161 @@
 #                 self.assertEqual(test.dataframe.columns.values.tolist()[i-1], expected_columns[i]) 
 #             # Assert number of rows is as expected
 #             self.assertEqual(len(test.dataframe), 1101)
+
+"""Unit tests for TGA.py"""
+
+import unittest, sys, os, numpy as np, pandas as pd
+
+wdir = os.path.dirname(__file__) # Find the current working directory
+sys.path.append("..")
+sys.path.append(".")
+import cabanapy.TGA as tga
+
+signals = ['Time (min)', 'Temperature (°C)', 'Weight (mg)', 'Heat Flow (W/g)']
+
+def tga_run(rate=10., start=30., end=800., steps=((300., 0.10), (550., 0.25)), width=15., mass=10., points=2000):
+    """Returns the columns of a simulated TGA ramp at 'rate' °C/min with sigmoid mass losses at the (temperature, fraction of the initial mass) of 'steps'"""
+    temperature = np.linspace(start, end, points)
+    time = (temperature - start)/rate
+    loss = sum(fraction/(1 + np.exp(-(temperature - center)/(width/4.))) for center, fraction in steps)
+    return np.column_stack([time, temperature, mass*(1 - loss), np.zeros(points)])
+
+def arrhenius_run(rate, Ea=150., A=1e12, points=2000):
+    """Returns the columns of a simulated TGA ramp at 'rate' °C/min of a first order reaction losing half of the mass, with activation energy Ea (kJ/mol) and pre-exponential factor A (1/min)"""
+    temperature = np.linspace(100, 700, points)
+    k = A*np.exp(-Ea/(8.314462618e-3*(temperature + 273.15)))
+    # ln(1 - alpha) is minus the integral of k/rate over temperature
+    integral = np.concatenate([[0], np.cumsum((k[1:] + k[:-1])/2*np.diff(temperature))])/rate
+    alpha = 1 - np.exp(-integral)
+    return np.column_stack([(temperature - 100)/rate, temperature, 10*(1 - 0.5*alpha), np.zeros(points)])
+
+def isothermal_run(points_per_min=20, noise=0.05):
+    """Returns the columns of a simulated run: a 10 °C/min ramp from 30 to 500 °C losing 1 mg, a 30 min isotherm losing 0.6 mg, then cooling at 20 °C/min to 100 °C"""
+    rng = np.random.default_rng(0)
+    time = np.arange(0, 97, 1./points_per_min)
+    temperature = np.select([time < 47, time < 77], [30 + 10*time, 500], 500 - 20*(time - 77)) + rng.normal(0, noise, len(time))
+    weight = 10 - np.clip(time, 0, 47)/47 - 0.6*np.clip(time - 47, 0, 30)/30
+    return np.column_stack([time, temperature, weight, np.zeros(len(time))])
+
+def write_ua(filename, data=None, sample='Test', size='10.0000 mg'):
+    """Writes a minimal Universal Analysis 2000 export"""
+    data = tga_run() if data is None else data
+    header = [
+        'OrgFile\tC:\\TA\\Data\\TGA\\test.001',
+        'Date\t01-Feb-18',
+        'Time\t10:00:00',
+        'Sample\t' + sample,
+        'Size\t' + size,
+        'Method\tRamp',
+        'Comment\tsynthetic',
+    ] + ['Sig{0}\t{1}'.format(i + 1, signal) for i, signal in enumerate(signals)] + ['StartOfData']
+    with open(filename, 'w', encoding='latin-1') as f:
+        f.write('\n'.join(header) + '\n')
+        np.savetxt(f, data, fmt='%.6f', delimiter='\t')
+
+class TGA_init_tests(unittest.TestCase):
+    """Unit test to assert filetypes are loaded correctly"""
+
+    def test_TGAFile_init(self):
+        export_to = './test_data.txt'
+        write_ua(export_to)
+        test = tga.TGAFile(export_to, "Test Sample")
+        # Assert header values are read
+        self.assertEqual((test.original_filename, test.date, test.sample, test.mass), ('C:/TA/Data/TGA/test.001', '01-Feb-18', 'Test', '10.0000 mg'))
+        self.assertEqual(test.signal, signals)
+        # Assert data is read into named columns and one row per signal
+        self.assertEqual(test.dataframe.columns.tolist(), signals)
+        self.assertEqual(test.data_array.shape, (4, 2000))
+        np.testing.assert_allclose(test.data_array[1], tga_run()[:, 1], atol=1e-6)
+        os.remove(export_to)
+
+class TGA_analysis_tests(unittest.TestCase):
+    """Unit tests for mass loss analysis"""
+
+    def test_find_steps(self):
+        export_to = './test_data.txt'
+        write_ua(export_to)
+        test = tga.TGAFile(export_to, "Test Sample")
+        # Assert weight percent does not change the data
+        test.plot_percent()
+        test.plot_percent()
+        self.assertAlmostEqual(test.data_array[2].max(), 10., places=4)
+        np.testing.assert_allclose(test.weight_percent(2)[[0, -1]], [100, 65], atol=0.01)
+        # Assert both steps are found around their centres, with symmetric onset and endset
+        steps = test.find_steps()
+        np.testing.assert_allclose(steps['peak'].values, [300, 550], atol=1)
+        np.testing.assert_allclose(steps['mass loss'].values, [10, 25], rtol=0.05)
+        np.testing.assert_allclose((steps['peak'] - steps['onset']).values, (steps['endset'] - steps['peak']).values, atol=1)
+        self.assertGreater(test.dtg()['DTG'].values.min(), -2)
+        # Assert a flat run has no steps
+        flat = tga.find_steps(np.linspace(30, 800, 2000), np.full(2000, 10.))
+        self.assertEqual(len(flat), 0)
+        self.assertEqual(flat.columns.tolist(), steps.columns.tolist())
+        # Assert many runs are quantified over the same ranges
+        table = tga.batch_steps([test, test], ranges=[(200, 400), (450, 650)])
+        np.testing.assert_allclose(table.values, [[10, 25], [10, 25]], rtol=0.01)
+        self.assertEqual(test.calculate_step(200, 400), test.calculate_steps([(200, 400)])[0])
+        self.assertEqual(test.calculate_step(200, 400, percent=True), test.calculate_steps([(200, 400)], percent=True)[0])
+        os.remove(export_to)
+
+    def test_plot_step(self):
+        export_to = './test_data.txt'
+        write_ua(export_to)
+        test = tga.TGAFile(export_to, "Test Sample")
+        import matplotlib.pyplot as plt
+        plt.figure()
+        test.plot_percent()
+        # Assert the marker lands on the weight percent curve, or on the raw weight without percent
+        test.plot_step(450)
+        marker = plt.gca().lines[-1].get_ydata()[0]
+        self.assertAlmostEqual(marker, np.interp(450, test.data_array[1], test.weight_percent(2)), delta=0.1)
+        test.plot_step(450, percent=False)
+        self.assertAlmostEqual(plt.gca().lines[-1].get_ydata()[0], marker/10, delta=0.01)
+        plt.close()
+        os.remove(export_to)
+
+    def test_kinetics(self):
+        runs = []
+        for rate in [2, 5, 10, 20]:
+            write_ua('./test_data_{0}.txt'.format(rate), arrhenius_run(rate))
+            runs.append(tga.TGAFile('./test_data_{0}.txt'.format(rate), '{0} °C/min'.format(rate)))
+        # Assert the heating rates and the activation energy are recovered for every conversion
+        np.testing.assert_allclose(tga.conversion_table(runs)['beta'], [2, 5, 10, 20])
+        friedman = tga.isoconversional(runs, n_bootstrap=200, processes=2)
+        self.assertEqual(len(friedman), 19)
+        np.testing.assert_allclose(friedman['Ea/kJ/mol'].values, 150, rtol=0.01)
+        self.assertTrue(np.all(friedman['Ea std/kJ/mol'] < 1))
+        np.testing.assert_allclose(tga.isoconversional(runs, 'ofw')['Ea/kJ/mol'].values, 150, rtol=0.03)
+        kissinger = tga.kissinger(runs)
+        self.assertAlmostEqual(kissinger['Ea/kJ/mol'], 150, delta=1.5)
+        self.assertAlmostEqual(kissinger['ln A'], np.log(1e12), delta=0.5)
+        for rate in [2, 5, 10, 20]:
+            os.remove('./test_data_{0}.txt'.format(rate))
+
+    def test_segments(self):
+        export_to = './test_data.txt'
+        write_ua(export_to, isothermal_run())
+        test = tga.TGAFile(export_to, "Test Sample")
+        test.gas_change(500, 'N2', 'Air', plot=False)
+        self.assertEqual(test.gas_switches[0]['row'], 940)
+        self.assertRaises(ValueError, test.gas_change, 5000, 'Air', 'O2', plot=False)
+        self.assertEqual(len(test.gas_switches), 1)
+        # Assert the ramp is split at the gas switch, then the isotherm and cooling are found
+        segments = test.find_segments()
+        self.assertEqual(segments['kind'].tolist(), ['heating', 'heating', 'isothermal', 'cooling'])
+        self.assertEqual(segments['gas'].tolist(), ['N2', 'Air', 'Air', 'Air'])
+        isotherm = test.segment_at(60.)
+        self.assertEqual(isotherm['kind'], 'isothermal')
+        self.assertAlmostEqual(isotherm['mass change'], -0.6, delta=0.01)
+        self.assertAlmostEqual(isotherm['rate'], -0.02, delta=0.001)
+        # Assert every sample time, the first and last included, is in a segment
+        self.assertEqual(test.segment_at(test.data_array[0][0])['kind'], 'heating')
+        self.assertEqual(test.segment_at(test.data_array[0][-1])['kind'], 'cooling')
+        # Assert many runs give the same statistics in one table
+        table = tga.segment_table([test, test])
+        self.assertEqual(table.index.names, ['run', 'segment'])
+        np.testing.assert_allclose(table.loc["Test Sample", 'mass change'].values[:4], segments['mass change'].values)
+        os.remove(export_to)
+
+if __name__ == '__main__':
+    unittest.main()
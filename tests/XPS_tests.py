@@ -33,3 +33,49 @@ class XPS_init_tests(unittest.TestCase):
                 self.assertEqual(test.dataframe.columns.values.tolist()[i-1], expected_columns[i]) 
             # Assert number of rows is as expected
             self.assertEqual(len(test.dataframe), 1101)
+
+    def test_KratosAsciiFile_subtract_background(self):
+        test = xps.KratosAsciiFile(wdir + "/test_data/KratosAsciiFile_sample.txt", "Iron Acetate", "Survey")
+        for method in ['shirley', 'linear', 'snip']:
+            bg = test.subtract_background(method=method)
+            # Assert the background and subtracted columns are added
+            self.assertIn('Intensity(Counts/sec) background', test.dataframe.columns.values.tolist())
+            self.assertIn('Intensity(Counts/sec) subtracted', test.dataframe.columns.values.tolist())
+            self.assertEqual(len(bg), 1101)
+            if method != 'snip':
+                # Assert the background meets the spectrum at both ends
+                signal = test.dataframe['Intensity(Counts/sec)'].values
+                self.assertAlmostEqual(bg[0], signal[0])
+                self.assertAlmostEqual(bg[-1], signal[-1])
+        # Assert a flat region, which has no peak area, is its own Shirley and Tougaard background
+        flat = np.full(50, 3.)
+        np.testing.assert_array_equal(xps.general.shirley(np.arange(50), flat), flat)
+        np.testing.assert_array_equal(xps.general.tougaard(np.arange(50), flat), flat)
+
+    def test_KratosAsciiFile_regions(self):
+        # Write a file of three regions, the last one holding the sample data
+        with open(wdir + "/test_data/KratosAsciiFile_sample.txt") as f:
+            lines = f.read().splitlines()
+        blocks = [
+            [lines[0] + 'Survey'] + lines[1:],
+            [lines[0] + 'C 1s', lines[1]] + lines[2:52],
+            lines,
+        ]
+        export_to = './test_data.txt'
+        with open(export_to, 'w') as f:
+            f.write('\n'.join(line for block in blocks for line in block) + '\n')
+        test = xps.KratosAsciiFile(export_to, "Iron Acetate", "Survey")
+        # Assert every region is indexed and the last one is loaded
+        self.assertEqual(test.region_names, ['Survey', 'C 1s', ''])
+        self.assertEqual([entry['line'] for entry in test.regions], [1, 1104, 1156])
+        self.assertEqual(test.header_lines, 1156)
+        self.assertEqual(len(test.dataframe), 1101)
+        # Assert regions are read on demand as their own objects
+        carbon = test.dataset('C 1s')
+        self.assertEqual(carbon.scan_type, 'C 1s')
+        self.assertEqual(len(carbon.dataframe), 50)
+        self.assertIs(test.dataset(1), carbon)
+        pd.testing.assert_frame_equal(test.dataset(0).dataframe, test.dataframe)
+        self.assertRaises(KeyError, test.dataset, 'O 1s')
+        os.remove(export_to)
+
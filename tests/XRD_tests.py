@@ -1,12 +1,19 @@
 """Unit tests for XRD.py"""
 
-import unittest, sys, os, numpy as np, pandas as pd
+import unittest, sys, os, zipfile, numpy as np, pandas as pd
+from unittest import mock
 
 wdir = os.path.dirname(__file__) # Find the current working directory
 sys.path.append("..")
 sys.path.append(".")
 import cabanapy.XRD as xrd
 
+def write_icdd(filename, lines, formula='LiF'):
+    """Writes a minimal ICDD PDF .xml card with the (2theta, intensity in thousandths, d) of lines"""
+    peaks = ''.join('<theta>{0}</theta><intensity><intensity>{1}</intensity><h>1</h><k>1</k><l>1</l><da>{2}</da></intensity>'.format(*line) for line in lines)
+    with open(filename, 'w') as f:
+        f.write('<pdf_data><chemical_formula>{0}</chemical_formula><pdf_number>00-004-0857</pdf_number><graphs>{1}</graphs></pdf_data>'.format(formula, peaks))
+
 class XRD_functions_test(unittest.TestCase):
     """Tests for the generic functions in XRD.py. These functions are either used by other functions or used directly"""
 
@@ -25,6 +32,195 @@ class XRD_functions_test(unittest.TestCase):
             self.assertEqual(175, get_data['y'][i])
             # Destroy the test file
             os.remove('./test_data.csv')
+
+    def test_compare_patterns(self):
+        two_theta = np.arange(10, 80, 0.02)
+        references = [
+            ([20, 35, 50], [100, 40, 60]),
+            ([25, 40, 62], [100, 70, 30]),
+            ([30, 45, 70], [50, 100, 20])
+        ]
+        profiles = xrd.simulate_patterns(two_theta, references, fwhm=0.1)
+        # Assert one simulated profile per reference on the measured grid with unit-scaled peaks
+        self.assertEqual(profiles.shape, (3, len(two_theta)))
+        self.assertAlmostEqual(profiles[0].max(), 100, delta=1)
+        measured = 2*profiles[1] + 0.5*profiles[2]
+        # Assert the majority phase scores best
+        self.assertEqual(xrd.compare_patterns(two_theta, measured, references).idxmin(), 1)
+        self.assertEqual(xrd.compare_patterns(two_theta, measured, references, method="correlation").idxmax(), 1)
+        # Assert the mixture scale factors are recovered
+        scales = xrd.refine_scale_factors(two_theta, measured, references)
+        np.testing.assert_allclose(scales.loc[0, [0, 1, 2]].values.astype(float), [0, 2, 0.5], atol=1e-6)
+        # Assert references whose positions and intensities do not pair up are rejected
+        with self.assertRaises(ValueError):
+            xrd.simulate_patterns(two_theta, [([20, 35, 50], [100, 40])])
+        reference = xrd._ReferenceFile()
+        reference.peak_data = ([20, 35, 50], [100, 40], [], [], [], [], [2.1, 1.3, 0.9])
+        with self.assertRaises(ValueError):
+            reference.sticks()
+
+    def test_export_patterns(self):
+        patterns = [
+            (np.arange(10, 80, 0.5), np.arange(140.)),
+            (np.array([20., 35., 50.]), np.array([100., 40., 60.]))
+        ]
+        for fmt, export_to in [('npz', './test_data.npz'), ('csv', './test_data_csv'), ('xy', './test_data_xy')]:
+            names = xrd.export_patterns((pattern for pattern in patterns), export_to, fmt=fmt)
+            # Assert every pattern is written under its own name
+            self.assertEqual(names, ['pattern_0000', 'pattern_0001'])
+            if fmt == 'npz':
+                with np.load(export_to) as archive:
+                    np.testing.assert_array_equal(archive['pattern_0000'][1], patterns[0][1])
+                    np.testing.assert_array_equal(archive['pattern_0001'][0], patterns[1][0])
+                os.remove(export_to)
+            else:
+                get_data = np.genfromtxt(os.path.join(export_to, 'pattern_0001.' + fmt), delimiter=',' if fmt == 'csv' else None, skip_header=0 if fmt == 'csv' else 1)
+                np.testing.assert_array_equal(get_data[:, 1], patterns[1][1])
+                # Destroy the test files
+                for name in names:
+                    os.remove(os.path.join(export_to, name + '.' + fmt))
+                os.rmdir(export_to)
+
+    @unittest.skipUnless(xrd.h5py, 'h5py is not installed')
+    def test_export_patterns_h5(self):
+        export_to = './test_data.h5'
+        writer = xrd.PatternWriter(export_to, chunk_size=50)
+        writer.write(np.arange(10, 80, 0.5), np.arange(140.), 'first', attrs={'temperature': 295})
+        writer.write(np.array([20., 35., 50.]), np.array([100., 40., 60.]), 'first')
+        writer.close()
+        # Assert every pattern is written to its own group with its attributes
+        with xrd.h5py.File(export_to, 'r') as f:
+            self.assertEqual(sorted(f.keys()), ['first', 'first_1'])
+            np.testing.assert_array_equal(f['first/intensity'][:], np.arange(140.))
+            self.assertEqual(f['first/intensity'].chunks, (50,))
+            self.assertEqual(f['first'].attrs['temperature'], 295)
+            np.testing.assert_array_equal(f['first_1/two_theta'][:], [20., 35., 50.])
+        os.remove(export_to)
+
+    def test_export_patterns_h5_missing(self):
+        h5py, xrd.h5py = xrd.h5py, None
+        try:
+            # Assert HDF5 export without h5py fails before writing anything
+            with self.assertRaisesRegex(ImportError, 'h5py'):
+                xrd.export_patterns([(np.arange(3.), np.arange(3.))], './test_data.h5')
+            self.assertFalse(os.path.exists('./test_data.h5'))
+        finally:
+            xrd.h5py = h5py
+
+class XRD_init_tests(unittest.TestCase):
+    """Tests to assert filetypes are initialized loaded correctly"""
+
+    def test_BM11CSVfile_init(self):
+        sample_data = [
+            (np.linspace(0.5, 50, 1000), np.linspace(10, 1010, 1000), './test_bm11.csv') # Sample data creates sample file
+        ]
+        for two_theta, intensity, export_to in sample_data:
+            with open(export_to, 'w') as f:
+                f.write('# 11-BM mail-in sample\n# Temperature 295 K\n## 2theta, intensity, sigma\n')
+                np.savetxt(f, np.column_stack((two_theta, intensity, np.sqrt(intensity))), delimiter=',')
+            test = xrd.BM11CSVfile(export_to, "Test Data")
+            # Assert header_lines has been established correctly
+            self.assertEqual(test.header_lines, 3)
+            # Assert the dataframe is indexed by 2theta
+            self.assertEqual(test.dataframe.index.name, ' 2theta')
+            self.assertEqual(test.dataframe.columns.values.tolist(), [' intensity', ' sigma'])
+            # Assert number of rows is as expected
+            self.assertEqual(len(test.dataframe), 1000)
+            # Assert normalization spans 0 to 100 and leaves the raw data untouched
+            x, y = test.norm_dataframe()
+            self.assertAlmostEqual(y.min(), 0)
+            self.assertAlmostEqual(y.max(), 100)
+            self.assertEqual(test.intensity[0], 10)
+            # Destroy the test file
+            os.remove(export_to)
+
+    def test_BM11CSVfile_compare(self):
+        two_theta = np.arange(10, 80, 0.02)
+        write_icdd('./test_ref1.xml', [(20, 1000, 4.4), (35, 400, 2.6), (50, 600, 1.8)])
+        write_icdd('./test_ref2.xml', [(25, 1000, 3.6), (40, 700, 2.3), (62, 300, 1.5)], formula='NaCl')
+        references = [xrd.ICDDXmlFile('./test_ref1.xml'), xrd.ICDDXmlFile('./test_ref2.xml')]
+        intensity = 2*xrd.simulate_patterns(two_theta, references)[1] + 5
+        export_to = './test_bm11.csv'
+        with open(export_to, 'w') as f:
+            f.write('## 2theta, intensity, sigma\n')
+            np.savetxt(f, np.column_stack((two_theta, intensity, np.sqrt(intensity))), delimiter=',')
+        test = xrd.BM11CSVfile(export_to, "Test Data")
+        two_theta, intensity = test._pattern()
+        weights = np.linspace(1, 2, len(two_theta))
+        # Assert the weights are cropped with the pattern
+        mask = (30 <= two_theta) & (two_theta <= 60)
+        with mock.patch.object(xrd.ET, 'parse', side_effect=AssertionError('the card is parsed again')):
+            score = test.compare(references, between=[30, 60], weights=weights)
+            scales = test.refine_scales(references, between=[30, 60], weights=weights)
+        pd.testing.assert_series_equal(score, xrd.compare_patterns(two_theta[mask], intensity[mask], references, weights=weights[mask]))
+        pd.testing.assert_frame_equal(scales, xrd.refine_scale_factors(two_theta[mask], intensity[mask], references, weights=weights[mask]))
+        for name in [export_to, './test_ref1.xml', './test_ref2.xml']:
+            os.remove(name)
+
+    def test_BM11CSVfile_subtract_background(self):
+        two_theta = np.linspace(10, 80, 3500)
+        baseline = 200 - 1.5*two_theta
+        intensity = baseline + 1000*np.exp(-0.5*((two_theta - 35)/0.1)**2)
+        export_to = './test_bm11.csv'
+        with open(export_to, 'w') as f:
+            f.write('## 2theta, intensity, sigma\n')
+            np.savetxt(f, np.column_stack((two_theta, intensity, np.sqrt(intensity))), delimiter=',')
+        test = xrd.BM11CSVfile(export_to, "Test Data")
+        for method, kwargs in [('snip', {'iterations': 40}), ('asls', {'lam': 1e7}), ('rolling_ball', {'radius': 40})]:
+            bg = test.subtract_background(method=method, **kwargs)
+            # Assert the background and subtracted columns are added
+            self.assertEqual(len(bg), 3500)
+            np.testing.assert_allclose(test.dataframe['subtracted_intensity'].values, intensity - bg, atol=1e-6)
+            # Assert the background follows the baseline under the peak and leaves the peak
+            peak = np.argmax(intensity)
+            self.assertLess(abs(bg[peak] - baseline[peak]), 20)
+            self.assertGreater(test.dataframe['subtracted_intensity'].values[peak], 950)
+        # Assert asls needs at least one iteration
+        with self.assertRaises(ValueError):
+            test.subtract_background(method='asls', niter=0)
+        os.remove(export_to)
+
+    def test_BrukerBrmlFile_init(self):
+        raw_data = (
+            '<RawData><DataRoutes><DataRoute>'
+            '<ScanInformation ScanName="Coupled TwoTheta/Theta"><TimePerStep>0.5</TimePerStep>'
+            '<ScanAxes><ScanAxisInfo AxisId="TwoTheta"><Start>10</Start><Stop>10.08</Stop><Increment>0.02</Increment></ScanAxisInfo></ScanAxes>'
+            '<MeasurementPoints>5</MeasurementPoints></ScanInformation>'
+            + ''.join('<Datum>0.5,1,{0},{1},{2}</Datum>'.format(10 + 0.02*i, 5 + 0.01*i, 100 + i) for i in range(5)) +
+            '</DataRoute></DataRoutes>'
+            '<FixedInformation><Sample><InfoData><InfoItem Name="SampleName" Value="LiF" /></InfoData></Sample></FixedInformation>'
+            '</RawData>'
+        )
+        export_to = './test_data.brml'
+        with zipfile.ZipFile(export_to, 'w') as zf:
+            zf.writestr('Experiment0/RawData0.xml', raw_data)
+        for metadata_only in [False, True]:
+            test = xrd.BrukerBrmlFile(export_to, "Test Data", metadata_only=metadata_only)
+            # Assert the metadata is as expected
+            self.assertEqual(test.sample_name, 'LiF')
+            self.assertEqual(test.scan_parameters['MeasurementPoints'], 5)
+            self.assertEqual(test.scan_parameters['TwoTheta']['Increment'], 0.02)
+            # Assert the data is only parsed on access in metadata-only mode
+            self.assertEqual(test._tree is None, metadata_only)
+            two_theta, counts = test.dataframe
+            self.assertEqual(len(two_theta), 5)
+            self.assertEqual(counts[-1], 104)
+        # Assert the metadata-only parse stops at the first data point when the metadata comes first: the file is cut off in the data
+        raw_data = (
+            '<RawData><FixedInformation><Sample><InfoData><InfoItem Name="SampleName" Value="LiF" /></InfoData></Sample></FixedInformation>'
+            '<DataRoutes><DataRoute>'
+            '<ScanInformation ScanName="Coupled TwoTheta/Theta"><MeasurementPoints>5000</MeasurementPoints></ScanInformation>'
+            + ''.join('<Datum>0.5,1,{0},{1},{2}</Datum>'.format(10 + 0.02*i, 5 + 0.01*i, 100 + i) for i in range(3)) +
+            '<Datum>0.5,1,10.0'
+        )
+        with zipfile.ZipFile(export_to, 'w') as zf:
+            zf.writestr('Experiment0/RawData0.xml', raw_data)
+        test = xrd.BrukerBrmlFile(export_to, "Test Data", metadata_only=True)
+        self.assertEqual(test.sample_name, 'LiF')
+        self.assertEqual(test.scan_parameters['MeasurementPoints'], 5000)
+        self.assertIsNone(test._tree)
+        # Destroy the test file
+        os.remove(export_to)
             
 # class XRD_init_tests(unittest.TestCase):
 #     """Tests to assert filetypes are initialized loaded correctly"""